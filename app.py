@@ -1,12 +1,19 @@
 # app.py
 import streamlit as st
-import base64
+import time
+import uuid
 from pathlib import Path
 from dotenv import load_dotenv, set_key
 
-from preprocess import preprocess_image_bytes
-from audio_agent import transcribe_audio_bytes
-from graph import build_jarvis_graph
+from preprocess import preprocess_image, tile_image, needs_tiling
+from audio_agent import stream_audio_bytes
+from config import WHISPER_WARMUP, VISION_TILED, VISION_MODEL, EXPLAIN_MODE
+from session_store import load_session, replay_session, session_index
+from metrics import start_http_exporter
+from llm import residency
+from ui_stream import ThrottledRenderer
+import transcription
+import resources
 
 
 # -------------------------------------------------------
@@ -18,6 +25,16 @@ if not ENV_PATH.exists():
 
 load_dotenv(ENV_PATH)
 
+# Load the Whisper model once per process, off the UI thread
+if WHISPER_WARMUP:
+    transcription.warmup(background=True)
+
+# Prometheus /metrics when METRICS_PORT is set (once per process)
+start_http_exporter()
+
+# Load pinned models (LLM_PINNED_MODELS) once per process
+residency.preload_pinned()
+
 
 # -------------------------------------------------------
 # STREAMLIT PAGE CONFIG
@@ -47,11 +64,10 @@ if st.sidebar.button("Save API Key"):
     st.sidebar.success("Saved to .env (no restart needed!)")
 
 if input_key:
-    try:
-        from langsmith import Client
-        Client(api_key=input_key).list_projects()
+    # checked once per key, not on every rerun
+    if resources.langsmith_key_valid(input_key):
         st.sidebar.markdown("### 🟢 Valid API Key")
-    except:
+    else:
         st.sidebar.markdown("### 🔴 Invalid API Key")
 else:
     st.sidebar.info("Tracing disabled. Enter a key to enable.")
@@ -66,11 +82,26 @@ with col1:
     uploaded_img = st.file_uploader("📷 Upload UI Image", type=["jpg", "jpeg", "png"])
     uploaded_audio = st.file_uploader("🎤 Upload Audio (optional)", type=["wav", "mp3"])
     user_prompt = st.text_area("📝 Additional Instructions")
+    tiled = st.checkbox("🧩 Tiled analysis for large / long screens", value=VISION_TILED)
+    explain_modes = {"on_demand": "When I ask for it", "deferred": "In the background after the code", "eager": "As part of the run"}
+    explain_mode = st.selectbox("📖 Explanation", list(explain_modes), format_func=explain_modes.get,
+                                index=list(explain_modes).index(EXPLAIN_MODE) if EXPLAIN_MODE in explain_modes else 0)
+    # follow-up edits patch the previous code instead of regenerating it
+    refine = st.checkbox("✏️ Refine the last result (instructions describe the change)",
+                         disabled="last_session" not in st.session_state)
     run_btn = st.button("🚀 Run Pipeline")
+    # follow-up runs in the same conversation see a summary of the earlier ones
+    if st.button("🆕 New conversation") or "conversation_id" not in st.session_state:
+        st.session_state["conversation_id"] = uuid.uuid4().hex
+        st.session_state.pop("last_session", None)
+        st.session_state.pop("conversation_image", None)
 
 with col2:
     st.subheader("📡 Live Output")
 
+    # Waiting for a model slot (cleared once tokens arrive)
+    ph_queue = st.empty()
+
     # Thinking placeholders
     ph_vision_think = st.empty()
     ph_coder_think = st.empty()
@@ -80,6 +111,14 @@ with col2:
     ph_vision = st.empty()
     ph_coder = st.empty()
     ph_explain = st.empty()
+    ph_explain_btn = st.empty()
+
+
+# The last run's session (for explaining it later; outputs survive reruns)
+last_session = st.session_state.get("last_session")
+last_view = load_session(last_session) if last_session else None
+explain_btn_shown = bool(last_view and not last_view["outputs"].get("explain"))
+explain_btn = explain_btn_shown and ph_explain_btn.button("📖 Explain this code", key="explain_btn")
 
 
 # Helper to convert uploaded file to bytes
@@ -90,26 +129,62 @@ def read_bytes(f):
     return f.read()
 
 
+# -------------------------------------------------------
+# SIDEBAR: PAST SESSIONS
+# -------------------------------------------------------
+# Reopening a result replays its stored outputs; no model is called
+st.sidebar.header("🗂️ Past Sessions")
+past_query = st.sidebar.text_input("Search instructions")
+same_design = st.sidebar.checkbox("Only the uploaded design", disabled=uploaded_img is None)
+past_hash = preprocess_image(read_bytes(uploaded_img)).sha256 if same_design and uploaded_img else None
+past = session_index.find(image_hash=past_hash, prompt=past_query or None, status=None, limit=20)
+if past:
+    past_labels = {
+        r["session_id"]: f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(r['created'] or r['updated']))} · "
+                         f"{(r['prompt'] or '(no instructions)')[:40]}"
+                         + ("" if r["status"] == "done" else f" · {r['status']}")
+        for r in past
+    }
+    past_pick = st.sidebar.selectbox("Session", list(past_labels), format_func=past_labels.get)
+    open_btn = st.sidebar.button("📂 Open session")
+else:
+    st.sidebar.caption("No past sessions found.")
+    past_pick, open_btn = None, False
+
+
 # -------------------------------------------------------
 # RUN PIPELINE
 # -------------------------------------------------------
-def run_pipeline(img_bytes, audio_bytes, user_prompt):
+def run_pipeline(img_bytes, audio_bytes, user_prompt, tiled=False, explain_mode=EXPLAIN_MODE, refine_from=None):
     ph_vision.info("🔍 Processing design...")
 
-    # Build graph
-    graph = build_jarvis_graph()
+    # the vision model loads while audio is transcribed and the image preprocessed
+    residency.prefetch(VISION_MODEL)
+
+    # Compiled once per process; rebuilt only if .env / model config changed
+    graph = resources.get_graph()
+    resources.get_llm_client()
 
     # Initial state messages
     initial_messages = []
+    timings = {}
 
     # AUDIO
     if audio_bytes:
+        ph_audio = st.empty()
+        t0 = time.perf_counter()
         try:
-            text = transcribe_audio_bytes(audio_bytes)
+            # show the transcript while later segments are still being decoded
+            segments = []
+            for segment in stream_audio_bytes(audio_bytes):
+                segments.append(segment)
+                ph_audio.info("🎤 " + " ".join(segments))
+            text = " ".join(segments)
             initial_messages.append({"role": "user", "content": text})
-            st.info("🎤 Audio transcribed.")
+            ph_audio.info(f"🎤 Audio transcribed: {text}")
         except Exception as e:
             st.error(f"Audio transcription error: {e}")
+        timings["transcription"] = round(time.perf_counter() - t0, 4)
 
     # USER TEXT
     if user_prompt:
@@ -120,64 +195,102 @@ def run_pipeline(img_bytes, audio_bytes, user_prompt):
         "messages": initial_messages,
         "user_image_b64": None,
         "user_audio_bytes": None,
-        "metadata": {"prompt": user_prompt},
+        "metadata": {"prompt": user_prompt, "timings": timings, "explain_mode": explain_mode,
+                     "conversation_id": st.session_state["conversation_id"], "refine_from": refine_from},
     }
 
     # IMAGE
     if img_bytes:
-        processed, h = preprocess_image_bytes(img_bytes)
-        b64 = base64.b64encode(processed).decode("utf-8")
-        state["user_image_b64"] = b64
-        state["metadata"]["image_hash"] = h
+        t0 = time.perf_counter()
+        processed = preprocess_image(img_bytes)
+        timings["preprocess"] = round(time.perf_counter() - t0, 4)
+        # a different design starts a new conversation: earlier turns are about another screen
+        if st.session_state.get("conversation_image") not in (None, processed.sha256):
+            st.session_state["conversation_id"] = uuid.uuid4().hex
+            state["metadata"]["conversation_id"] = st.session_state["conversation_id"]
+        st.session_state["conversation_image"] = processed.sha256
+        state["user_image_b64"] = processed.b64
+        state["metadata"]["image_hash"] = processed.sha256
+        state["metadata"]["image_phash"] = processed.phash
+        state["metadata"]["image_thumb"] = processed.thumb
+        if tiled and needs_tiling(img_bytes):
+            state["user_image_tiles"] = tile_image(img_bytes)
 
     # STREAM GRAPH
-    stream = graph.invoke_stream(state)
-
-    coder_acc = ""
-    explain_acc = ""
-
-    for phase, chunk, _sid in stream:
+    session_id = render_stream(graph.invoke_stream(state), completed="✨ Completed")
+    st.session_state["last_session"] = session_id
+    if explain_mode != "eager" and not explain_btn_shown:
+        ph_explain_btn.button("📖 Explain this code", key="explain_btn")
+
+
+def render_stream(stream, completed=None):
+    """Draw a (phase, chunk, session_id) stream into the output panels; returns the session id."""
+    # Chunks arrive token-by-token for every phase; coalesce them and repaint
+    # each panel at a bounded frame rate instead of once per token
+    renderer = ThrottledRenderer({
+        "vision_think": lambda text: ph_vision_think.markdown(f"### 🧠 Vision Thinking\n\n{text}"),
+        "coder_think": lambda text: ph_coder_think.markdown(f"### 🧠 Coder Thinking\n\n{text}"),
+        "explain_think": lambda text: ph_explain_think.markdown(f"### 🧠 Explain Thinking\n\n{text}"),
+        "vision": ph_vision.markdown,
+        "coder_patch": lambda text: ph_coder_think.markdown(f"### ✏️ Code Edits\n\n{text}"),
+        "coder": lambda text: ph_coder.code(text, language="python"),
+        "explain": ph_explain.markdown,
+    })
+
+    session_id, queued = None, False
+    for phase, chunk, session_id in stream:
 
         # --------------------------------------------------
-        # THINKING PHASES
+        # THINKING + FINAL STREAMING OUTPUT
         # --------------------------------------------------
-        if phase == "vision_think":
-            ph_vision_think.markdown(f"### 🧠 Vision Thinking\n\n{chunk}")
-            continue
-
-        if phase == "coder_think":
-            ph_coder_think.markdown(f"### 🧠 Coder Thinking\n\n{chunk}")
-            continue
-
-        if phase == "explain_think":
-            ph_explain_think.markdown(f"### 🧠 Explain Thinking\n\n{chunk}")
+        if phase in renderer:
+            if queued:
+                ph_queue.empty()
+                queued = False
+            renderer.push(phase, chunk)
             continue
 
         # --------------------------------------------------
-        # FINAL STREAMING OUTPUT
+        # QUEUED behind other sessions for a model slot
         # --------------------------------------------------
-        if phase == "vision":
-            ph_vision.markdown(chunk)
-
-        elif phase == "coder":
-            coder_acc += chunk
-            ph_coder.code(coder_acc, language="python")
+        if phase == "queue":
+            ph_queue.info(chunk)
+            queued = True
+            continue
 
-        elif phase == "explain":
-            explain_acc += chunk
-            ph_explain.markdown(explain_acc)
+        # every stage is complete (or failed): paint the final text
+        renderer.flush()
 
         # --------------------------------------------------
         # ERROR
         # --------------------------------------------------
-        elif phase == "error":
+        if phase == "error":
             st.error(chunk)
 
         # --------------------------------------------------
         # DONE
         # --------------------------------------------------
-        elif phase == "done":
-            ph_vision.success("✨ Completed")
+        elif phase == "done" and completed:
+            ph_vision.success(completed)
+
+    renderer.flush()
+    ph_queue.empty()
+    return session_id
+
+
+def show_session(view):
+    """Redraw a finished session's outputs (Streamlit clears the page on every rerun)."""
+    outputs = view.get("outputs", {})
+    for phase, ph, title in (("vision_think", ph_vision_think, "Vision"), ("coder_think", ph_coder_think, "Coder"),
+                             ("explain_think", ph_explain_think, "Explain")):
+        if outputs.get(phase):
+            ph.markdown(f"### 🧠 {title} Thinking\n\n{outputs[phase]}")
+    if outputs.get("vision"):
+        ph_vision.markdown(outputs["vision"])
+    if outputs.get("coder"):
+        ph_coder.code(outputs["coder"], language="python")
+    if outputs.get("explain"):
+        ph_explain.markdown(outputs["explain"])
 
 
 # -------------------------------------------------------
@@ -187,5 +300,21 @@ if run_btn:
     run_pipeline(
         read_bytes(uploaded_img),
         read_bytes(uploaded_audio),
-        user_prompt
+        user_prompt,
+        tiled,
+        explain_mode,
+        st.session_state.get("last_session") if refine else None,
     )
+elif open_btn:
+    # the reopened session becomes the one to explain or refine
+    st.session_state["last_session"] = past_pick
+    render_stream(replay_session(past_pick), completed=f"📂 Reopened session {past_pick[:8]}")
+    reopened = load_session(past_pick) or {}
+    if not reopened.get("outputs", {}).get("explain") and not explain_btn_shown:
+        ph_explain_btn.button("📖 Explain this code", key="explain_btn")
+elif last_view:
+    show_session(last_view)
+    if explain_btn:
+        # appended to the same session; replayed if a background run already finished it
+        ph_explain_btn.empty()
+        render_stream(resources.get_graph().invoke_explain(last_session))
@@ -1,11 +1,15 @@
 # audio_agent.py
-import tempfile
-from transcription import transcribe_local
+from typing import Generator
+from transcription import transcribe_stream
+
+
+def stream_audio_bytes(audio_bytes: bytes) -> Generator[str, None, None]:
+    """Yield transcript segments for uploaded audio, decoded in memory."""
+    for segment in transcribe_stream(audio_bytes):
+        segment = segment.strip()
+        if segment:
+            yield segment
+
 
 def transcribe_audio_bytes(audio_bytes: bytes) -> str:
-    tf = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-    tf.write(audio_bytes)
-    tf.flush()
-    tf.close()
-    text = transcribe_local(tf.name)
-    return text
+    return " ".join(stream_audio_bytes(audio_bytes))
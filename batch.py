@@ -0,0 +1,213 @@
+# batch.py
+"""
+Headless batch runner: push a directory (or JSONL manifest) of design images
+through the LangGraph pipeline with a worker pool.
+
+    python batch.py designs/ --instructions "Use data-testid locators" --workers 4
+    python batch.py --manifest jobs.jsonl --model-concurrency qwen3-vl:latest=1
+
+Manifest lines look like {"image": "login.png", "instructions": "..."}; relative
+paths are resolved against the manifest's directory. One result JSON per job is
+written to the output directory; jobs whose result already exists are skipped,
+so an interrupted run can simply be started again.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple
+
+from config import OUTPUT_DIR, EXPLAIN_MODE
+from scheduler import scheduler, priority, BATCH, parse_limits
+from preprocess import preprocess_image, tile_image, needs_tiling
+from graph import build_jarvis_graph
+from session_store import load_session
+from metrics import start_http_exporter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+class Job(NamedTuple):
+    image: Path
+    instructions: str
+
+    @property
+    def job_id(self) -> str:
+        h = hashlib.sha256(self.image.read_bytes())
+        h.update(b"|" + self.instructions.encode("utf-8"))
+        return h.hexdigest()[:16]
+
+
+def load_jobs(directory: str = None, manifest: str = None, instructions: str = "") -> List[Job]:
+    jobs = []
+    if manifest:
+        base = Path(manifest).parent
+        with open(manifest, encoding="utf-8") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                path = Path(rec["image"])
+                jobs.append(Job(path if path.is_absolute() else base / path, rec.get("instructions", instructions)))
+    if directory:
+        for path in sorted(Path(directory).iterdir()):
+            if path.suffix.lower() in IMAGE_SUFFIXES:
+                jobs.append(Job(path, instructions))
+    return jobs
+
+
+def result_path(out_dir: Path, job: Job, job_id: str) -> Path:
+    return out_dir / f"{job.image.stem}_{job_id}.json"
+
+
+def run_job(graph, job: Job, tiled: bool = False, explain_mode: str = "eager") -> Dict[str, Any]:
+    start = time.time()
+    raw = job.image.read_bytes()
+    processed = preprocess_image(raw)
+    preprocess_seconds = round(time.time() - start, 4)
+    state = {
+        "messages": [{"role": "user", "content": job.instructions}] if job.instructions else [],
+        "user_image_b64": processed.b64,
+        "user_image_tiles": tile_image(raw) if tiled and needs_tiling(raw) else None,
+        "user_audio_bytes": None,
+        "metadata": {"prompt": job.instructions, "image_hash": processed.sha256, "image_phash": processed.phash,
+                     "image_thumb": processed.thumb,
+                     "timings": {"preprocess": preprocess_seconds}, "explain_mode": explain_mode},
+    }
+
+    session_id, error = None, None
+    # batch calls queue behind interactive ones and are never rejected for waiting
+    with priority(BATCH):
+        for phase, chunk, session_id in graph.invoke_stream(state):
+            if phase == "error":
+                error = chunk
+
+    view = load_session(session_id) or {}
+    return {
+        "image": str(job.image),
+        "instructions": job.instructions,
+        "image_hash": processed.sha256,
+        "session_id": session_id,
+        "status": "error" if error else "done",
+        "error": error,
+        "outputs": view.get("outputs", {}),
+        "metrics": view.get("metrics", {}),
+        "elapsed": time.time() - start,
+    }
+
+
+def write_result(fp: Path, result: Dict[str, Any]):
+    tmp = fp.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, fp)
+
+
+def run_batch(jobs: List[Job], out_dir: Path, workers: int = 2, tiled: bool = False,
+              explain_mode: str = "eager") -> Dict[str, Any]:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    graph = build_jarvis_graph()
+
+    todo = []
+    skipped = 0
+    for job in jobs:
+        job_id = job.job_id
+        fp = result_path(out_dir, job, job_id)
+        if fp.exists():
+            try:
+                if json.loads(fp.read_text(encoding="utf-8")).get("status") == "done":
+                    skipped += 1
+                    continue
+            except Exception:
+                pass  # unreadable partial result: run it again
+        todo.append((job, fp))
+    logger.info("%d jobs: %d to run, %d already done", len(jobs), len(todo), skipped)
+
+    latencies, failed = [], 0
+    start = time.time()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+    try:
+        futures = {pool.submit(run_job, graph, job, tiled, explain_mode): (job, fp) for job, fp in todo}
+        for fut in as_completed(futures):
+            job, fp = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as e:
+                logger.exception("Job %s crashed", job.image)
+                result = {"image": str(job.image), "instructions": job.instructions, "status": "error", "error": str(e)}
+            write_result(fp, result)
+            if result["status"] == "done":
+                latencies.append(result["elapsed"])
+            else:
+                failed += 1
+            logger.info("[%d/%d] %s %s", len(latencies) + failed, len(todo), result["status"], job.image.name)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; finished results are kept, re-run to resume")
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    wall = time.time() - start
+    report = {
+        "jobs": len(jobs),
+        "completed": len(latencies),
+        "failed": failed,
+        "skipped": skipped,
+        "wall_seconds": round(wall, 2),
+        "images_per_minute": round(len(latencies) / wall * 60, 2) if wall > 0 else 0.0,
+        "latency_mean": round(statistics.mean(latencies), 2) if latencies else None,
+        "latency_p50": round(statistics.median(latencies), 2) if latencies else None,
+        "latency_p95": round(sorted(latencies)[int(0.95 * (len(latencies) - 1))], 2) if latencies else None,
+    }
+    (out_dir / "_report.json").write_text(json.dumps(report, indent=2), encoding="utf-8")
+    return report
+
+
+def _parse_limits(items: List[str]) -> Dict[str, int]:
+    for item in items or []:
+        model, _, n = item.rpartition("=")
+        if not model or not n.isdigit():
+            raise argparse.ArgumentTypeError(f"expected MODEL=N, got {item!r}")
+    return parse_limits(",".join(items or []))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a directory or manifest of designs through the pipeline.")
+    parser.add_argument("directory", nargs="?", help="directory of .png/.jpg designs")
+    parser.add_argument("--manifest", help="JSONL file of {\"image\", \"instructions\"}")
+    parser.add_argument("--instructions", default="", help="instructions applied to every image without its own")
+    parser.add_argument("--workers", type=int, default=2, help="jobs in flight at once")
+    parser.add_argument("--model-concurrency", nargs="*", metavar="MODEL=N",
+                        help="max concurrent calls per model, e.g. qwen3-vl:latest=1")
+    parser.add_argument("--tiled", action="store_true", help="analyse large screens as overlapping regions")
+    parser.add_argument("--explain-mode", choices=("eager", "on_demand"),
+                        default="eager" if EXPLAIN_MODE == "eager" else "on_demand",
+                        help="explain each result in the run, or leave it to be explained later")
+    parser.add_argument("--out", default=str(OUTPUT_DIR / "batch"), help="result directory")
+    args = parser.parse_args(argv)
+
+    if not args.directory and not args.manifest:
+        parser.error("give a directory or --manifest")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    for model, n in _parse_limits(args.model_concurrency).items():
+        scheduler.set_limit(model, n)
+
+    start_http_exporter()
+    jobs = load_jobs(args.directory, args.manifest, args.instructions)
+    report = run_batch(jobs, Path(args.out), workers=args.workers, tiled=args.tiled,
+                       explain_mode=args.explain_mode)
+    print(json.dumps(report, indent=2))
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+# bench.py
+"""
+Pipeline benchmark against a local stand-in Ollama server.
+
+    python bench.py --runs 5 --token-rate 80 --first-token-latency 0.3 --out bench.json
+
+Starts an Ollama-compatible HTTP server (/api/chat, /api/generate, /api/tags)
+with configurable token rate, first-token latency and failure injection, points
+the pipeline at it, then measures each agent on its own and the whole graph via
+invoke_stream: time to first token and duration per phase, tokens/s, end-to-end
+latency and peak memory. The JSON report is meant to be diffed between versions.
+Runs in a scratch working directory so caches and session files start empty.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+
+class FakeOllama:
+    """Minimal streaming Ollama API. Every reply is unique so no cache can hit."""
+
+    def __init__(self, token_rate: float = 50.0, first_token_latency: float = 0.2, tokens: int = 120,
+                 error_rate: float = 0.0, drop_rate: float = 0.0, seed: int = 0):
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors_injected": 0, "drops_injected": 0, "tokens_sent": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%d" % self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-ollama", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _roll(self, rate: float) -> bool:
+        with self.lock:
+            return self.rng.random() < rate
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, status: int, obj: Dict[str, Any]):
+                body = json.dumps(obj).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _chunk(self, obj: Dict[str, Any]):
+                line = (json.dumps(obj) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+
+            def do_GET(self):
+                self._json(200, {"models": []})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with fake.lock:
+                    fake.stats["requests"] += 1
+                    req_no = fake.stats["requests"]
+                model = body.get("model", "fake")
+                if fake._roll(fake.error_rate):
+                    with fake.lock:
+                        fake.stats["errors_injected"] += 1
+                    self._json(503, {"error": "injected failure"})
+                    return
+                if self.path == "/api/generate" and not body.get("prompt"):
+                    # load / keep_alive request
+                    self._json(200, {"model": model, "response": "", "done": True})
+                    return
+
+                stream = body.get("stream", True)
+                prefix = ""
+                msgs = body.get("messages") or []
+                if msgs and msgs[-1].get("role") == "assistant":
+                    prefix = msgs[-1].get("content", "")
+                words = [f"tok{req_no}_{i} " for i in range(fake.tokens)]
+                start_at = len(prefix.split())
+                drop_at = fake.rng.randrange(start_at, fake.tokens) if fake._roll(fake.drop_rate) else None
+
+                time.sleep(fake.first_token_latency)
+                if not stream:
+                    text = "".join(words[start_at:])
+                    with fake.lock:
+                        fake.stats["tokens_sent"] += fake.tokens - start_at
+                    self._json(200, {"model": model, "message": {"role": "assistant", "content": text}, "done": True,
+                                     "prompt_eval_count": 10, "eval_count": fake.tokens - start_at})
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                delay = 1.0 / fake.token_rate if fake.token_rate > 0 else 0.0
+                for i in range(start_at, fake.tokens):
+                    if i == drop_at:
+                        with fake.lock:
+                            fake.stats["drops_injected"] += 1
+                        self.close_connection = True
+                        return
+                    self._chunk({"model": model, "created_at": "", "done": False,
+                                 "message": {"role": "assistant", "content": words[i]}})
+                    with fake.lock:
+                        fake.stats["tokens_sent"] += 1
+                    if delay:
+                        time.sleep(delay)
+                self._chunk({"model": model, "created_at": "", "done": True, "done_reason": "stop",
+                             "message": {"role": "assistant", "content": ""},
+                             "prompt_eval_count": 10, "eval_count": fake.tokens - start_at})
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {
+        "mean": round(statistics.mean(ordered), 4),
+        "p50": round(statistics.median(ordered), 4),
+        "p95": round(ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)], 4),  # nearest rank
+        "min": round(ordered[0], 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def _state(run: int, prompt: str) -> Dict[str, Any]:
+    return {
+        "messages": [{"role": "user", "content": f"{prompt} (bench run {run})"}],
+        "user_image_b64": None,
+        "user_audio_bytes": None,
+        "metadata": {"prompt": f"{prompt} (bench run {run})", "image_hash": f"bench-{run}-{time.time_ns()}",
+                     "explain_mode": "eager"},
+    }
+
+
+def bench_agents(runs: int, prompt: str) -> Dict[str, Any]:
+    """Each node called directly (no graph), fed the previous node's output."""
+    from vision_agent import vision_node
+    from coder_agent import coder_node
+    from explain_agent import explain_node
+
+    timings = {"vision": [], "coder": [], "explain": []}
+    for run in range(runs):
+        state = _state(run, prompt)
+        for name, node in (("vision", vision_node), ("coder", coder_node), ("explain", explain_node)):
+            start = time.perf_counter()
+            out = node(state)
+            timings[name].append(time.perf_counter() - start)
+            state = dict(state, messages=list(state["messages"]) + out["messages"])
+    return {name: _summary(v) for name, v in timings.items()}
+
+
+def bench_graph(runs: int, prompt: str) -> Dict[str, Any]:
+    """End to end through build_jarvis_graph().invoke_stream."""
+    from graph import build_jarvis_graph
+
+    graph = build_jarvis_graph()
+    e2e, ttft_any, errors = [], [], 0
+    phase_ttft: Dict[str, List[float]] = {}
+    phase_duration: Dict[str, List[float]] = {}
+    phase_rate: Dict[str, List[float]] = {}
+
+    for run in range(runs):
+        start = time.perf_counter()
+        first: Dict[str, float] = {}
+        last: Dict[str, float] = {}
+        chunks: Dict[str, int] = {}
+        for phase, chunk, _sid in graph.invoke_stream(_state(run, prompt)):
+            now = time.perf_counter() - start
+            if phase == "error":
+                errors += 1
+                continue
+            if phase == "done":
+                continue
+            if not first:
+                ttft_any.append(now)
+            first.setdefault(phase, now)
+            last[phase] = now
+            chunks[phase] = chunks.get(phase, 0) + 1
+        e2e.append(time.perf_counter() - start)
+        for phase in first:
+            phase_ttft.setdefault(phase, []).append(first[phase])
+            duration = last[phase] - first[phase]
+            phase_duration.setdefault(phase, []).append(duration)
+            if duration > 0:
+                phase_rate.setdefault(phase, []).append(chunks[phase] / duration)
+
+    return {
+        "end_to_end_seconds": _summary(e2e),
+        "time_to_first_token_seconds": _summary(ttft_any),
+        "errors": errors,
+        "phases": {
+            phase: {
+                "ttft_seconds": _summary(phase_ttft[phase]),
+                "duration_seconds": _summary(phase_duration.get(phase, [])),
+                "chunks_per_second": _summary(phase_rate.get(phase, [])),
+            }
+            for phase in sorted(phase_ttft)
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a fake Ollama server.")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--prompt", default="Login page with email, password and a sign-in button")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second per stream")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens", type=int, default=120, help="tokens per reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of streams cut mid-way")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-agents", action="store_true", help="only benchmark the full graph")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report Python heap peak via tracemalloc (slows everything down)")
+    parser.add_argument("--workdir", help="scratch directory (default: a fresh temp dir)")
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    fake = FakeOllama(args.token_rate, args.first_token_latency, args.tokens,
+                      args.error_rate, args.drop_rate, args.seed).start()
+    # must be in place before config/llm are imported
+    os.environ["OLLAMA_HOST"] = fake.url
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="jarvis-bench-"))
+
+    if args.trace_memory:
+        tracemalloc.start()
+    report: Dict[str, Any] = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "workdir", "trace_memory")},
+    }
+    started = time.perf_counter()
+    if not args.skip_agents:
+        report["agents"] = bench_agents(args.runs, args.prompt)
+    report["graph"] = bench_graph(args.runs, args.prompt)
+    report["wall_seconds"] = round(time.perf_counter() - started, 3)
+    report["server"] = dict(fake.stats)
+    report["server"]["tokens_per_second"] = round(fake.stats["tokens_sent"] / report["wall_seconds"], 2)
+    report["memory"] = {
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 2),
+    }
+    if args.trace_memory:
+        report["memory"]["python_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+    fake.stop()
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fp:
+            fp.write(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
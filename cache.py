@@ -1,79 +1,247 @@
 # cache.py
-import hashlib, json, logging
-from pathlib import Path
+import hashlib, json, logging, threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from config import CACHE_LRU_SIZE
+from cache_store import CacheStore
+from semantic_index import semantic_index
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-try:
-    import chromadb
-    from chromadb.config import Settings
-except Exception:
-    chromadb = None
 
-DB_DIR = Path("db")
-CHROMA_DIR = DB_DIR / "chroma"
-FS_CACHE_DIR = DB_DIR / "fs_cache"
-FS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+class _Uncached(str):
+    """A get_or_compute result to return without storing it under the requested key."""
+
+
+def content_hash(*parts: str) -> str:
+    """sha256 over the given strings; used to address a stage by its actual inputs."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update((part or "").encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
 
 class SimpleCache:
-    def __init__(self):
-        self.use_chroma = False
-        if chromadb:
-            try:
-                client = chromadb.PersistentClient(path=str(CHROMA_DIR))
-                self.col = client.get_or_create_collection("responses")
-                self.use_chroma = True
-                logger.info("Chromadb enabled.")
-            except Exception:
-                logger.exception("Chromadb init failed; falling back to FS cache.")
-                self.use_chroma = False
-
-    def _key(self, image_hash: str, prompt: str) -> str:
-        s = (image_hash or "") + "|" + (prompt or "")
+    """
+    Two-tier exact-key response cache.
+
+    Keys are sha256(image_hash|prompt|model|stage). A bounded in-process LRU sits
+    in front of the persistent store (cache_store.CacheStore: compressed, size-bounded SQLite).
+    get_or_compute() adds single-flight: concurrent callers with the same key
+    wait for the one in-flight computation instead of all calling the model.
+    """
+
+    def __init__(self, lru_size: int = CACHE_LRU_SIZE):
+        self.lru_size = lru_size
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.stats_counters = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "semantic_hits": 0,
+                               "single_flight_waits": 0}
+
+        self._store: Optional[CacheStore] = None
+
+    def _ensure_store(self) -> Optional[CacheStore]:
+        # opened on the first persistent lookup, not at import
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    try:
+                        self._store = CacheStore()
+                    except Exception:
+                        logger.exception("Cache store init failed; running with the in-process LRU only")
+                        self._store = False
+        return self._store or None
+
+    def _key(self, image_hash: str, prompt: str, model: str = "", stage: str = "") -> str:
+        s = "|".join([image_hash or "", prompt or "", model or "", stage or ""])
         return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
-    def get(self, image_hash: str, prompt: str):
-        key = self._key(image_hash, prompt)
-        if self.use_chroma:
-            try:
-                res = self.col.query(query_texts=[prompt], n_results=1)
-                if res and res.get("metadatas"):
-                    md = res["metadatas"][0]
-                    return md.get("response")
-            except Exception:
-                logger.exception("Chromadb query failed")
-        fp = FS_CACHE_DIR / f"{key}.json"
-        if fp.exists():
-            try:
-                return json.loads(fp.read_text(encoding="utf-8")).get("response")
-            except Exception:
-                logger.exception("FS cache read failed")
+    # ---------------- in-process LRU ----------------
+
+    def _lru_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._lru.get(key)
+            if value is not None:
+                self._lru.move_to_end(key)
+            return value
+
+    def _lru_put(self, key: str, value: str):
+        if self.lru_size <= 0:
+            return
+        with self._lock:
+            self._lru[key] = value
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    # ---------------- persistent store ----------------
+
+    def _store_get(self, key: str) -> Optional[str]:
+        store = self._ensure_store()
+        if store is None:
+            return None
+        try:
+            return store.get(key)
+        except Exception:
+            logger.exception("Cache store read failed")
+            return None
+
+    def _store_set(self, key: str, value: str, meta: dict):
+        store = self._ensure_store()
+        if store is None:
+            return
+        try:
+            store.set(key, value, meta)
+        except Exception:
+            logger.exception("Cache store write failed")
+
+    # ---------------- public API ----------------
+
+    def get(self, image_hash: str, prompt: str, model: str = "", stage: str = "") -> Optional[str]:
+        key = self._key(image_hash, prompt, model, stage)
+        value = self._lru_get(key)
+        if value is not None:
+            self._count("memory_hits", stage)
+            return value
+        value = self._store_get(key)
+        if value is not None:
+            self._count("persistent_hits", stage)
+            self._lru_put(key, value)
+            return value
+        self._count("misses", stage)
         return None
 
-    def set(self, image_hash: str, prompt: str, response: str):
-        key = self._key(image_hash, prompt)
-        if self.use_chroma:
+    def set(self, image_hash: str, prompt: str, response: str, model: str = "", stage: str = ""):
+        key = self._key(image_hash, prompt, model, stage)
+        response = str(response)
+        self._lru_put(key, response)
+        self._store_set(key, response, {"prompt": prompt or "", "image_hash": image_hash or "",
+                                        "model": model or "", "stage": stage or ""})
+
+    def get_or_compute(self, image_hash: str, prompt: str, compute: Callable[[], str],
+                       model: str = "", stage: str = "") -> str:
+        """
+        Return the cached value, or run compute() once for all concurrent callers
+        with the same key and cache its (non-empty) result, unless compute()
+        returns it wrapped in _Uncached.
+        """
+        key = self._key(image_hash, prompt, model, stage)
+        while True:
+            value = self.get(image_hash, prompt, model, stage)
+            if value is not None:
+                return value
+            with self._lock:
+                event = self._inflight.get(key)
+                leader = event is None
+                if leader:
+                    event = self._inflight[key] = threading.Event()
+            if not leader:
+                self._count("single_flight_waits")
+                event.wait()
+                # leader finished (or failed, in which case we take over)
+                continue
             try:
-                self.col.add(
-                    ids=[key],
-                    metadatas=[{"response": {"thinking":[response.thinking] if hasattr(response, 'thinking') else response,
-                               "thinking":[response.content] if hasattr(response, 'content') else response
-                               }, "prompt": prompt, "image_hash": image_hash}],
-                               
-                    documents={"thinking":[response.thinking] if hasattr(response, 'thinking') else response,
-                               "thinking":[response.content] if hasattr(response, 'content') else response
-                               }
-                )
-                return
-            except Exception:
-                logger.exception("Chromadb add failed")
-        
-        # Fallback to File System Cache
-        fp = FS_CACHE_DIR / f"{key}.json"
+                value = compute()
+                if value and not isinstance(value, _Uncached):
+                    self.set(image_hash, prompt, value, model, stage)
+                return value
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+    # ---------------- per-stage, content-addressed ----------------
+    # A stage is keyed by everything its output depends on: the upstream output
+    # (or image hash), the user instructions, the model and the prompt template
+    # version. Values are JSON {"thinking", "content"}.
+
+    def _decode_stage(self, stage: str, raw: Optional[str]) -> Optional[Tuple[str, str]]:
+        if not raw:
+            return None
         try:
-            fp.write_text(json.dumps({"response": response, "prompt": prompt, "image_hash": image_hash}, ensure_ascii=False, indent=2), encoding="utf-8")
+            obj = json.loads(raw)
+            return obj.get("thinking", ""), obj.get("content", "")
         except Exception:
-            logger.exception("FS cache write failed")
+            logger.exception("Corrupt %s stage cache entry", stage)
+            return None
+
+    def get_stage(self, stage: str, version: str, model: str, upstream: str,
+                  instructions: str) -> Optional[Tuple[str, str]]:
+        """Return cached (thinking, content) for a stage, or None."""
+        raw = self.get(content_hash(upstream), instructions, model=model, stage=f"{stage}:{version}")
+        return self._decode_stage(stage, raw)
+
+    def get_or_compute_stage(self, stage: str, version: str, model: str, upstream: str, instructions: str,
+                             compute: Callable[[], Tuple[str, str]],
+                             semantic_query: Optional[str] = None, semantic_context: str = "") -> Tuple[str, str]:
+        """
+        Return cached (thinking, content) for a stage, or run compute() (single-flight)
+        and cache its result.
+
+        With semantic reuse enabled, a miss may be served by the result for a
+        near-identical `semantic_query` (default: the instructions) given with
+        the same upstream and `semantic_context` (the rest of the instructions,
+        e.g. conversation history). Such a hit is returned, not cached under
+        this request's key.
+        """
+        upstream_hash, stage_key = content_hash(upstream), f"{stage}:{version}"
+        query = instructions if semantic_query is None else semantic_query
+        partition = semantic_index.partition(stage_key, model, upstream_hash, semantic_context)
+
+        def run() -> str:
+            reused = self._semantic_reuse(stage, partition, query)
+            if reused:
+                return _Uncached(reused)
+            thinking, content = compute()
+            if not content:
+                return ""
+            semantic_index.add(partition, query, self._key(upstream_hash, instructions, model, stage_key))
+            return json.dumps({"thinking": thinking, "content": content}, ensure_ascii=False)
+
+        raw = self.get_or_compute(upstream_hash, instructions, run, model=model, stage=stage_key)
+        return self._decode_stage(stage, raw) or ("", "")
+
+    def _semantic_reuse(self, stage: str, partition: str, query: str) -> Optional[str]:
+        """The cached result for a near-identical query on the same input, if any."""
+        if not semantic_index.enabled:
+            return None
+        try:
+            match = semantic_index.find(partition, query)
+        except Exception:
+            logger.exception("Semantic index lookup failed")
+            return None
+        if match is None:
+            return None
+        cached = self._decode_stage(stage, self._lru_get(match.key) or self._store_get(match.key))
+        if not cached:
+            return None
+        self._count("semantic_hits", stage)
+        metrics.observe("jarvis_semantic_similarity", match.similarity, stage=stage)
+        logger.info("Reusing %s result for similar instructions (similarity %.3f, distance %.3f)",
+                    stage, match.similarity, match.distance)
+        thinking, content = cached
+        note = f"[reused the result for similar instructions (similarity {match.similarity:.3f}): {match.instructions[:120]!r}]"
+        return json.dumps({"thinking": f"{note}\n\n{thinking}", "content": content}, ensure_ascii=False)
+
+    def _count(self, name: str, stage: str = ""):
+        with self._lock:
+            self.stats_counters[name] += 1
+        metrics.record_cache(name, stage)
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self.stats_counters)
+            out["memory_entries"] = len(self._lru)
+        lookups = out["memory_hits"] + out["persistent_hits"] + out["misses"]
+        # semantic hits are lookups that missed on the exact key
+        out["hit_rate"] = (out["memory_hits"] + out["persistent_hits"] + out["semantic_hits"]) / lookups if lookups else 0.0
+        return out
+
 
 cache = SimpleCache()
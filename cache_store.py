@@ -0,0 +1,279 @@
+# cache_store.py
+"""
+Single-file persistent store behind the response cache.
+
+Values are zlib-compressed in one SQLite database (WAL mode, so several
+processes can read and write it safely). The store is bounded: once the
+compressed size passes CACHE_MAX_BYTES the least recently used entries are
+evicted, and entries older than CACHE_TTL_SECONDS (if set) expire. Entries of
+the old db/fs_cache and Chroma caches are not imported (their keys predate the
+per-stage key format and could never be hit); purge-legacy deletes them.
+
+    python cache_store.py stats
+    python cache_store.py list --stage coder --limit 20
+    python cache_store.py inspect <key>
+    python cache_store.py evict | clear | purge-legacy
+"""
+import argparse
+import json
+import logging
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import DB_DIR, CACHE_MAX_BYTES, CACHE_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STORE_PATH = DB_DIR / "cache.sqlite3"
+FS_CACHE_DIR = DB_DIR / "fs_cache"
+CHROMA_DIR = DB_DIR / "chroma"
+
+EVICT_EVERY = 64  # writes between size checks
+TOUCH_INTERVAL = 60.0  # seconds; reads refresh an entry's LRU time at most this often
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key      TEXT PRIMARY KEY,
+    value    BLOB NOT NULL,
+    size     INTEGER NOT NULL,
+    raw_size INTEGER NOT NULL,
+    stage    TEXT NOT NULL DEFAULT '',
+    model    TEXT NOT NULL DEFAULT '',
+    created  REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits     INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+
+def _rows(items: Iterable[Tuple[str, str, Dict[str, Any]]]) -> List[Tuple]:
+    now = time.time()
+    rows = []
+    for key, value, meta in items:
+        raw = value.encode("utf-8")
+        blob = zlib.compress(raw, 6)
+        rows.append((key, blob, len(blob), len(raw), meta.get("stage") or "", meta.get("model") or "", now, now))
+    return rows
+
+
+class CacheStore:
+    """Compressed, size-bounded key/value store in SQLite; one connection per thread."""
+
+    def __init__(self, path: Path = STORE_PATH, max_bytes: int = CACHE_MAX_BYTES, ttl: float = CACHE_TTL_SECONDS):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    # ---------------- key/value ----------------
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._conn()
+        row = conn.execute("SELECT value, created, accessed FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created, accessed = row
+        now = time.time()
+        if self.ttl > 0 and now - created > self.ttl:
+            conn.execute("DELETE FROM entries WHERE key = ? AND created = ?", (key, created))
+            return None
+        if now - accessed > TOUCH_INTERVAL:
+            # keep reads cheap: refresh the LRU position only now and then
+            conn.execute("UPDATE entries SET accessed = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        try:
+            return zlib.decompress(value).decode("utf-8")
+        except zlib.error:
+            logger.exception("Corrupt cache entry %s; dropping it", key)
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+
+    def set(self, key: str, value: str, meta: Optional[Dict[str, Any]] = None):
+        self.set_many([(key, value, meta or {})])
+
+    def set_many(self, items: Iterable[Tuple[str, str, Dict[str, Any]]]):
+        rows = _rows(items)
+        if not rows:
+            return
+        self._write("INSERT OR REPLACE", rows)
+        with self._lock:
+            self._writes += len(rows)
+            due = self._writes >= EVICT_EVERY
+            if due:
+                self._writes = 0
+        if due:
+            self.evict()
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _write(self, verb: str, rows: List[Tuple]):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                f"{verb} INTO entries (key, value, size, raw_size, stage, model, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # ---------------- eviction ----------------
+
+    def evict(self) -> int:
+        """Drop expired entries, then LRU entries until under 90% of max_bytes. Returns rows removed."""
+        conn = self._conn()
+        removed = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.ttl > 0:
+                removed += conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,)).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if self.max_bytes > 0 and total > self.max_bytes:
+                target = total - int(self.max_bytes * 0.9)
+                freed = 0
+                victims = []
+                for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed"):
+                    victims.append((key,))
+                    freed += size
+                    if freed >= target:
+                        break
+                conn.executemany("DELETE FROM entries WHERE key = ?", victims)
+                removed += len(victims)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if removed:
+            logger.info("Evicted %d cache entries", removed)
+        return removed
+
+    def clear(self):
+        self._conn().execute("DELETE FROM entries")
+        self._conn().execute("VACUUM")
+
+    # ---------------- legacy caches ----------------
+
+    @staticmethod
+    def purge_legacy() -> int:
+        """
+        Delete the caches used before this store (db/fs_cache, db/chroma). They
+        are not imported: their keys predate the per-stage key format, so no
+        lookup could ever hit them.
+        """
+        count = 0
+        if FS_CACHE_DIR.is_dir():
+            count += sum(1 for _ in FS_CACHE_DIR.glob("*.json"))
+            shutil.rmtree(FS_CACHE_DIR)
+        if CHROMA_DIR.is_dir():
+            count += sum(1 for p in CHROMA_DIR.rglob("*") if p.is_file())
+            shutil.rmtree(CHROMA_DIR)
+        return count
+
+    # ---------------- inspection ----------------
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._conn()
+        entries, size, raw, hits, oldest, newest = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(raw_size), 0), COALESCE(SUM(hits), 0), "
+            "MIN(created), MAX(created) FROM entries").fetchone()
+        by_stage = {stage or "(none)": {"entries": n, "bytes": b} for stage, n, b in conn.execute(
+            "SELECT stage, COUNT(*), SUM(size) FROM entries GROUP BY stage ORDER BY stage")}
+        return {
+            "path": str(self.path),
+            "entries": entries,
+            "bytes": size,
+            "raw_bytes": raw,
+            "compression_ratio": round(raw / size, 2) if size else None,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": hits,
+            "oldest": oldest,
+            "newest": newest,
+            "file_bytes": self.path.stat().st_size if self.path.exists() else 0,
+            "by_stage": by_stage,
+        }
+
+    def list(self, stage: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        sql = "SELECT key, stage, model, size, raw_size, created, accessed, hits FROM entries"
+        args: Tuple = ()
+        if stage:
+            sql += " WHERE stage = ? OR stage LIKE ?"
+            args = (stage, f"{stage}:%")
+        sql += " ORDER BY accessed DESC LIMIT ?"
+        cols = ("key", "stage", "model", "size", "raw_size", "created", "accessed", "hits")
+        return [dict(zip(cols, row)) for row in self._conn().execute(sql, args + (limit,))]
+
+    def inspect(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT key, stage, model, size, raw_size, created, accessed, hits, value FROM entries "
+            "WHERE key = ? OR key LIKE ? LIMIT 1", (key, f"{key}%")).fetchone()
+        if row is None:
+            return None
+        cols = ("key", "stage", "model", "size", "raw_size", "created", "accessed", "hits")
+        out = dict(zip(cols, row[:-1]))
+        out["value"] = zlib.decompress(row[-1]).decode("utf-8", errors="replace")
+        return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and maintain the persistent response cache.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="size, entry counts and compression by stage")
+    p_list = sub.add_parser("list", help="most recently used entries")
+    p_list.add_argument("--stage")
+    p_list.add_argument("--limit", type=int, default=50)
+    p_inspect = sub.add_parser("inspect", help="show one entry (key or key prefix)")
+    p_inspect.add_argument("key")
+    sub.add_parser("evict", help="apply TTL and size limits now")
+    sub.add_parser("clear", help="delete every entry")
+    sub.add_parser("purge-legacy", help="delete the old db/fs_cache and db/chroma caches (never imported: "
+                                        "their keys predate the per-stage format)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    store = CacheStore()
+    if args.cmd == "stats":
+        out = store.stats()
+    elif args.cmd == "list":
+        out = store.list(args.stage, args.limit)
+    elif args.cmd == "inspect":
+        out = store.inspect(args.key)
+        if out is None:
+            print(f"no entry {args.key!r}", file=sys.stderr)
+            return 1
+    elif args.cmd == "evict":
+        out = {"removed": store.evict()}
+    elif args.cmd == "clear":
+        store.clear()
+        out = {"cleared": True}
+    else:
+        out = {"removed_files": CacheStore.purge_legacy()}
+    print(json.dumps(out, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,32 @@
 # coder_agent.py
-from typing import Dict, Any
-from llm import stream_ollama, run_ollama
+from typing import Dict, Any, Tuple
+from llm_calls import LLMCall, run_calls
+from cache import cache
 from config import CODER_MODEL
+from streaming import emit
+from prompt_budget import context_block, compact_code, compact_vision, stage_budget
+from patching import parse_edits, apply_edits, PatchError
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Bump when the prompts below change so cached stage outputs are not reused.
+PROMPT_VERSION = "v2"
+
+# Fixed text first, request-specific context after: think and gen share the
+# prefix (system + context + think task), so Ollama can reuse its prompt cache.
+SYSTEM_PROMPT = "You are a senior test automation engineer writing production-ready Selenium + PyTest code in Python using the Page Object Model (POM)."
+THINK_TASK = "Write your internal plan: file list, folder layout, major functions and edge-case notes. Do not write the code yet."
+GEN_TASK = "Now generate the runnable code (conftest, POM classes, tests) following your plan. Include comments and instructions to run."
+PATCH_TASK = (
+    "Apply the change request below to the current code. Do NOT rewrite the code: reply only with edit blocks, "
+    "one per change, each in exactly this form:\n"
+    "<<<<<<< SEARCH\n<lines copied exactly from the current code, enough to be unique>\n=======\n"
+    "<the lines that replace them>\n>>>>>>> REPLACE\n"
+    "To add code, SEARCH for the lines next to where it goes and repeat them in the replacement."
+)
+
 def coder_node(state: Dict[str, Any]):
     messages = state.get("messages", []) or []
 
@@ -21,28 +41,88 @@ def coder_node(state: Dict[str, Any]):
             break
 
     user_text = state.get("metadata", {}).get("prompt", "")
+    # earlier turns of this conversation (already token-bounded by memory.context)
+    history = state.get("metadata", {}).get("history", "")
+    # refine mode: the code of the session being refined
+    refine = state.get("metadata", {}).get("refine") or {}
+    previous_code = refine.get("coder", "")
+
+    def analyse(regenerate: bool = False) -> Tuple[str, str]:
+        # THINK: plan code structure, tests, files. GEN: the actual code, from the plan.
+        # regenerate: a refinement whose patch failed; the new code must still build on
+        # the previous code and the instructions it was written for.
+        if regenerate:
+            instructions = [
+                ("Original instructions", refine.get("prompt", ""), None),
+                ("Previous code", previous_code, compact_code),
+                ("Change request (apply it to the previous code)", user_text, None),
+            ]
+        else:
+            instructions = [("User instructions", user_text, None)]
+        context = context_block("coder", CODER_MODEL, [
+            *([("Earlier in this conversation", history, None)] if history else []),
+            *instructions,
+            ("Vision analysis", vision_text, compact_vision),
+        ])
+        think_prompt = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": context},
+            {"role": "user", "content": THINK_TASK},
+        ]
+
+        def gen_prompt(deps):
+            return think_prompt + [
+                {"role": "assistant", "content": deps["think"]},
+                {"role": "user", "content": GEN_TASK},
+            ]
+
+        out = run_calls([
+            LLMCall("think", CODER_MODEL, lambda deps: think_prompt, phase="coder_think",
+                    on_error="[Coder thinking failed]"),
+            LLMCall("gen", CODER_MODEL, gen_prompt, depends_on=("think",), phase="coder"),
+        ])
+        return out["think"], out["gen"]
+
+    def patch() -> Tuple[str, str]:
+        # PATCH: the model writes only edits to the previous code; they are applied
+        # and checked here, and only the edits are streamed (on "coder_patch").
+        # The whole code is sent because SEARCH texts must match it exactly.
+        patch_prompt = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Current code:\n{previous_code}"},
+            {"role": "user", "content": f"{PATCH_TASK}\n\nChange request:\n{user_text}"},
+        ]
+        edits_text = run_calls([LLMCall("patch", CODER_MODEL, lambda deps: patch_prompt, phase="coder_patch")])["patch"]
+        try:
+            code = apply_edits(previous_code, parse_edits(edits_text))
+        except PatchError as e:
+            logger.warning("Patch for session %s not applied (%s); regenerating", refine.get("session_id"), e)
+            emit("coder_patch", f"\n\n[patch not applied: {e} — regenerating the full code]\n")
+            return analyse(regenerate=True)
+        emit("coder", code)
+        return f"[edits applied to session {refine.get('session_id')}]\n\n{edits_text}", code
+
+    # Stage cache keyed on this stage's actual inputs: unchanged upstream output
+    # (and instructions) means no model call at all.
+    streamed = False
+
+    def compute() -> Tuple[str, str]:
+        nonlocal streamed
+        streamed = True
+        return patch() if previous_code else analyse()
+
+    if previous_code:
+        thinking, acc = cache.get_or_compute_stage("coder_patch", PROMPT_VERSION, CODER_MODEL, previous_code,
+                                                     user_text, compute)
+    else:
+        thinking, acc = cache.get_or_compute_stage("coder", f"{PROMPT_VERSION}:b{stage_budget('coder')}", CODER_MODEL,
+                                                     vision_text, f"{history}\n\n{user_text}" if history else user_text,
+                                                     compute, semantic_query=user_text, semantic_context=history)
 
-    # THINK (synchronous): ask the model to 'plan' code structure, tests, files — return a single block
-    think_prompt = [
-        {"role": "system", "content": "You are a senior test automation engineer. Provide a full plan for generating production-ready Selenium + PyTest code in Python using POM. This is your internal thinking — produce file list, folder layout, major functions, and edge-case notes."},
-        {"role": "user", "content": f"Vision analysis:\n{vision_text}\n\nUser instructions:\n{user_text}"}
-    ]
-    try:
-        thinking_raw = run_ollama(think_prompt, CODER_MODEL)
-        thinking = str(thinking_raw)
-    except Exception as e:
-        logger.exception("Coder thinking failed: %s", e)
-        thinking = "[Coder thinking failed]"
-
-    # GEN (streamed): generate the actual code (this may be long) — stream and accumulate
-    gen_prompt = [
-        {"role": "system", "content": "You are a senior test automation engineer. Now generate runnable code (conftest, POM classes, tests). Include comments and instructions to run."},
-        {"role": "user", "content": f"Plan:\n{thinking}\n\nNow produce the code output."}
-    ]
-
-    acc = ""
-    for chunk in stream_ollama(gen_prompt, CODER_MODEL):
-        acc += chunk
+    if not streamed:
+        thinking = f"[cached code plan]\n\n{thinking}"
+        emit("coder_think", thinking)
+        emit("coder", acc)
 
     return {
         "messages": [
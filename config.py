@@ -23,3 +23,82 @@ WHISPER_MODEL = os.getenv("WHISPER_MODEL", "large")
 
 # LangSmith (loaded automatically)
 LANGSMITH_API_KEY = os.getenv("LANGSMITH_API_KEY")
+
+# Whisper model registry
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "auto")  # auto | faster | whisper
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "cpu")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "default")
+WHISPER_NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", "2"))  # concurrent transcriptions per faster-whisper model
+WHISPER_IDLE_SECONDS = float(os.getenv("WHISPER_IDLE_SECONDS", "900"))  # 0 = never evict
+WHISPER_WARMUP = os.getenv("WHISPER_WARMUP", "0").lower() in ("1", "true", "yes")
+
+# Response cache
+CACHE_LRU_SIZE = int(os.getenv("CACHE_LRU_SIZE", "256"))  # in-process entries in front of the persistent store
+
+# Semantic reuse: a stage result is reused for near-identical instructions on the same input
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0"))  # min cosine similarity, e.g. 0.98; 0 (default) disables
+SEMANTIC_EMBED_MODEL = os.getenv("SEMANTIC_EMBED_MODEL", "")  # Ollama embedding model; empty = local hashed n-grams
+SEMANTIC_BATCH_SIZE = int(os.getenv("SEMANTIC_BATCH_SIZE", "16"))  # new entries embedded together
+
+# Perceptual-hash index for near-duplicate designs (256-bit dHash; 0 disables reuse)
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "24"))
+# A hash match is only reused if no 8x8 block of the 128px thumbnails differs by more than this (0-255 mean)
+PHASH_MAX_BLOCK_DIFF = float(os.getenv("PHASH_MAX_BLOCK_DIFF", "6"))
+
+# Max model calls a single agent may have in flight at once
+LLM_MAX_PARALLEL_CALLS = int(os.getenv("LLM_MAX_PARALLEL_CALLS", "4"))
+
+# Ollama client (pooled async connection, timeouts in seconds)
+OLLAMA_HOST = os.getenv("OLLAMA_HOST")  # None -> ollama's default (localhost:11434)
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "120"))  # includes model load
+LLM_IDLE_TIMEOUT = float(os.getenv("LLM_IDLE_TIMEOUT", "60"))  # max gap between tokens
+LLM_TOTAL_TIMEOUT = float(os.getenv("LLM_TOTAL_TIMEOUT", "300"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "16"))
+
+# Image preprocessing
+PREPROCESS_TARGET_BYTES = int(os.getenv("PREPROCESS_TARGET_BYTES", "350000"))  # adaptive encoder aims below this
+PREPROCESS_MEMO_SIZE = int(os.getenv("PREPROCESS_MEMO_SIZE", "32"))  # results memoized by raw-upload hash
+
+# Tiled vision analysis for large / long screens
+VISION_TILED = os.getenv("VISION_TILED", "0").lower() in ("1", "true", "yes")
+VISION_TILE_SIZE = int(os.getenv("VISION_TILE_SIZE", "1024"))
+VISION_TILE_OVERLAP = int(os.getenv("VISION_TILE_OVERLAP", "128"))
+VISION_TILE_MAX_WIDTH = int(os.getenv("VISION_TILE_MAX_WIDTH", "2048"))  # page is downscaled to this width first
+
+# Metrics: serve Prometheus text on this port when set (e.g. 9108)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Live output: max repaints per second per panel while tokens stream in
+UI_MAX_FPS = float(os.getenv("UI_MAX_FPS", "8"))
+
+# LLM scheduler: per-model concurrent calls ("model=n,model=n"), others get the default
+LLM_MODEL_CONCURRENCY = os.getenv("LLM_MODEL_CONCURRENCY", "")
+LLM_DEFAULT_CONCURRENCY = int(os.getenv("LLM_DEFAULT_CONCURRENCY", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))  # waiting calls per model before new ones are rejected
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "120"))  # max wait for interactive calls; 0 = no limit
+
+# Prompt budgets (estimated tokens of upstream context per stage prompt)
+PROMPT_BUDGET_CODER = int(os.getenv("PROMPT_BUDGET_CODER", "3000"))
+PROMPT_BUDGET_EXPLAIN = int(os.getenv("PROMPT_BUDGET_EXPLAIN", "2500"))
+
+# Model residency: keep the next stage's model loaded and avoid swaps
+MAX_LOADED_MODELS = int(os.getenv("MAX_LOADED_MODELS", "0"))  # match OLLAMA_MAX_LOADED_MODELS; 0 = no limit
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE")  # e.g. "10m"; None -> Ollama's default
+LLM_PINNED_MODELS = [m.strip() for m in os.getenv("LLM_PINNED_MODELS", "").split(",") if m.strip()]
+LLM_SWAP_AFTER = float(os.getenv("LLM_SWAP_AFTER", "15"))  # max seconds a call waits for the loaded model to drain
+
+# Explain stage: "eager" (part of every run), "deferred" (background, after the
+# code is final) or "on_demand" (only when asked for)
+EXPLAIN_MODE = os.getenv("EXPLAIN_MODE", "on_demand")
+
+# Conversation memory (per conversation id, persisted under db/memory)
+MEMORY_MAX_ITEMS = int(os.getenv("MEMORY_MAX_ITEMS", "12"))  # recent turns kept verbatim
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "400"))  # rolling summary of older turns
+MEMORY_CONTEXT_TOKENS = int(os.getenv("MEMORY_CONTEXT_TOKENS", "800"))  # history handed to the agents
+
+# Persistent response cache (SQLite, zlib-compressed values)
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # compressed size before LRU eviction
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "0"))  # 0 = entries never expire
@@ -1,12 +1,24 @@
 # explain_agent.py
-from typing import Dict, Any
-from llm import stream_ollama, run_ollama
+from typing import Dict, Any, Tuple
+from llm_calls import LLMCall, run_calls
+from cache import cache
 from config import EXPLAIN_MODEL
+from streaming import emit
+from prompt_budget import context_block, compact_code, stage_budget
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Bump when the prompts below change so cached stage outputs are not reused.
+PROMPT_VERSION = "v2"
+
+# Fixed text first, request-specific context after: think and gen share the
+# prefix (system + code + think task), so Ollama can reuse its prompt cache.
+SYSTEM_PROMPT = "You are a technical writer explaining generated Selenium + PyTest test code to the engineers who will run and maintain it."
+THINK_TASK = "Write your internal explanation plan: what you will explain and the sections to include (assumptions, how to run, edge cases)."
+GEN_TASK = "Now produce the full explanation following your plan, including how to run the code and the assumptions it makes."
+
 def explain_node(state: Dict[str, Any]):
     messages = state.get("messages", []) or []
 
@@ -19,27 +31,44 @@ def explain_node(state: Dict[str, Any]):
             coder_text = m.get("content", "") or ""
             break
 
-    # THINK: create an internal analysis/explain plan
-    think_prompt = [
-        {"role": "system", "content": "You are a technical writer. Produce an internal explanation plan describing what you will explain and sections to include (assumptions, how to run, edge cases)."},
-        {"role": "user", "content": f"Code:\n{coder_text}"}
-    ]
-    try:
-        thinking_raw = run_ollama(think_prompt, EXPLAIN_MODEL)
-        thinking = str(thinking_raw)
-    except Exception as e:
-        logger.exception("Explain thinking failed: %s", e)
-        thinking = "[Explain thinking failed]"
-
-    # GEN (streamed): generate final explanation
-    gen_prompt = [
-        {"role": "system", "content": "You are a technical writer. Now produce the full explanation, including how to run the code and assumptions."},
-        {"role": "user", "content": f"Plan:\n{thinking}\n\nNow produce the explanation."}
-    ]
-
-    acc = ""
-    for chunk in stream_ollama(gen_prompt, EXPLAIN_MODEL):
-        acc += chunk
+    def analyse() -> Tuple[str, str]:
+        # THINK: an internal explanation plan. GEN: the explanation, from the plan.
+        # long code is reduced to file names, imports and signatures
+        context = context_block("explain", EXPLAIN_MODEL, [("Code", coder_text, compact_code)])
+        think_prompt = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": context},
+            {"role": "user", "content": THINK_TASK},
+        ]
+
+        def gen_prompt(deps):
+            return think_prompt + [
+                {"role": "assistant", "content": deps["think"]},
+                {"role": "user", "content": GEN_TASK},
+            ]
+
+        out = run_calls([
+            LLMCall("think", EXPLAIN_MODEL, lambda deps: think_prompt, phase="explain_think",
+                    on_error="[Explain thinking failed]"),
+            LLMCall("gen", EXPLAIN_MODEL, gen_prompt, depends_on=("think",), phase="explain"),
+        ])
+        return out["think"], out["gen"]
+
+    # Stage cache keyed on this stage's actual inputs: unchanged upstream output
+    # (and instructions) means no model call at all.
+    streamed = False
+
+    def compute() -> Tuple[str, str]:
+        nonlocal streamed
+        streamed = True
+        return analyse()
+
+    thinking, acc = cache.get_or_compute_stage("explain", f"{PROMPT_VERSION}:b{stage_budget('explain')}", EXPLAIN_MODEL, coder_text, "", compute)
+
+    if not streamed:
+        thinking = f"[cached explanation plan]\n\n{thinking}"
+        emit("explain_think", thinking)
+        emit("explain", acc)
 
     return {
         "messages": [
@@ -1,58 +1,156 @@
 # graph.py
 import os
 import uuid
-import json
 import logging
-from pathlib import Path
+import functools
+import threading
+import weakref
 from typing import TypedDict, Annotated, Dict, Any, List, Generator, Tuple
 
 from dotenv import load_dotenv
 
 from langgraph.graph import StateGraph, END, add_messages
-from langsmith import traceable  # decorator; may raise if langsmith not installed
-# Note: we use decorator-level LangSmith tracing only (not LangGraph tracer)
+# Note: we use decorator-level LangSmith tracing only (not LangGraph tracer);
+# langsmith itself is imported when the graph is built, not at import time.
 
 from vision_agent import vision_node
 from coder_agent import coder_node
 from explain_agent import explain_node
 from memory import ConversationMemory
+from session_store import SessionJournal
+from metrics import metrics
+from llm import residency
+from config import VISION_MODEL, CODER_MODEL, EXPLAIN_MODEL, EXPLAIN_MODE
+from session_store import load_session, replay_session
+from scheduler import priority, BATCH
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-OUTPUT_DIR = Path("outputs")
-OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-
 
 class JarvisState(TypedDict):
     messages: Annotated[List[Dict[str, Any]], add_messages]
     user_image_b64: str | None
+    user_image_tiles: List[Dict[str, Any]] | None  # [{"box": [l, t, r, b], "b64": ...}] for tiled vision
     user_audio_bytes: bytes | None
     metadata: Dict[str, Any] | None
 
 
-def _write_session(session_id: str, partial: Dict[str, Any]):
-    fp = OUTPUT_DIR / f"session_{session_id}.json"
-    obj = {}
-    if fp.exists():
-        try:
-            obj = json.loads(fp.read_text(encoding="utf-8"))
-        except Exception:
-            obj = {}
-    obj.update(partial)
-    fp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
-
-
 def maybe_trace(fn, name: str):
     """
     Apply langsmith.traceable decorator if available.
     """
     try:
+        from langsmith import traceable
         return traceable(name=name, run_type="llm")(fn)
     except Exception:
         return fn
 
 
+def instrument(fn, name: str):
+    """
+    Time a node and attribute the model calls / cache lookups inside it to the
+    node and to the session id carried in state metadata.
+    """
+    @functools.wraps(fn)
+    def wrapper(state):
+        session_id = (state.get("metadata") or {}).get("session_id")
+        with metrics.node_scope(session_id, name):
+            return fn(state)
+    return wrapper
+
+
+# model used by each node, and the node that runs after it
+STAGE_MODELS = {"vision": VISION_MODEL, "coder": CODER_MODEL, "explain": EXPLAIN_MODEL}
+NEXT_STAGE = {"vision": "coder", "coder": "explain"}
+
+
+EXPLAIN_MODES = ("eager", "deferred", "on_demand")
+
+
+def explain_mode(state) -> str:
+    mode = (state.get("metadata") or {}).get("explain_mode") or EXPLAIN_MODE
+    return mode if mode in EXPLAIN_MODES else "eager"
+
+
+def route_after_coder(state) -> str:
+    """Explain inside the run only in eager mode; otherwise the code is the final output."""
+    return "explain" if explain_mode(state) == "eager" else END
+
+
+def preload_next(fn, name: str):
+    """
+    Ask the server to load the next stage's model while this node runs, so the
+    next node does not start with a model load.
+    """
+    @functools.wraps(fn)
+    def wrapper(state):
+        nxt = NEXT_STAGE.get(name)
+        if nxt != "explain" or explain_mode(state) != "on_demand":
+            residency.prefetch(STAGE_MODELS.get(nxt), current=STAGE_MODELS.get(name))
+        return fn(state)
+    return wrapper
+
+
+# one explanation run per session at a time; a lock lives only while someone holds or waits on it
+_explain_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_explain_locks_guard = threading.Lock()
+
+
+def _explain_lock(session_id: str) -> threading.Lock:
+    with _explain_locks_guard:
+        return _explain_locks.setdefault(session_id, threading.Lock())
+
+
+def _refine_source(session_id: str) -> Dict[str, Any]:
+    """Outputs of the session a refinement starts from ({} if it is gone)."""
+    view = load_session(session_id)
+    if not view or not view["outputs"].get("coder"):
+        logger.warning("Cannot refine session %s: no generated code; running a full generation", session_id)
+        return {}
+    outputs = view["outputs"]
+    return {
+        "session_id": session_id,
+        "image_hash": (view.get("meta") or {}).get("image_hash"),
+        "prompt": (view.get("meta") or {}).get("prompt") or "",
+        "vision": outputs.get("vision", ""),
+        "vision_think": outputs.get("vision_think", ""),
+        "coder": outputs["coder"],
+    }
+
+
+def _user_texts(state):
+    for m in state.get("messages") or []:
+        role = getattr(m, "type", None) or (m.get("role") if isinstance(m, dict) else None)
+        content = getattr(m, "content", None) or (m.get("content") if isinstance(m, dict) else None)
+        if role in ("user", "human") and content:
+            yield role, content
+
+
+def _is_follow_up(memory: ConversationMemory, metadata: Dict[str, Any], user_text: str) -> bool:
+    """
+    Whether a run builds on the previous turn, so its prompt (and stage cache key)
+    should carry the conversation history: a refinement, or new instructions for
+    the same design. A re-run of the same request or a different design is not.
+    """
+    if metadata.get("refine_from"):
+        return True
+    previous = memory.last("user")
+    if previous is None:
+        return False
+    return previous.get("image_hash") == metadata.get("image_hash") and previous["content"] != user_text
+
+
+def _iter_messages(payload):
+    """(node name, content) for each message in an "updates" stream payload."""
+    for update in (payload or {}).values():
+        for m in (update or {}).get("messages", []):
+            node_name = getattr(m, "name", None) or (m.get("name") if isinstance(m, dict) else None)
+            content = getattr(m, "content", "") or (m.get("content") if isinstance(m, dict) else "")
+            if node_name is not None:
+                yield node_name, content
+
+
 def build_jarvis_graph():
     # reload .env (app.py may have updated it)
     load_dotenv(".env")
@@ -60,56 +158,151 @@ def build_jarvis_graph():
 
     # Add nodes - here we use wrappers that accept state and return dict {"messages":[...]}
     # We decorate with traceable if available (node-level tracing)
-    graph.add_node("vision", maybe_trace(vision_node, "vision_node"))
-    graph.add_node("coder", maybe_trace(coder_node, "coder_node"))
-    graph.add_node("explain", maybe_trace(explain_node, "explain_node"))
+    graph.add_node("vision", maybe_trace(instrument(preload_next(vision_node, "vision"), "vision"), "vision_node"))
+    graph.add_node("coder", maybe_trace(instrument(preload_next(coder_node, "coder"), "coder"), "coder_node"))
+    explain = maybe_trace(instrument(explain_node, "explain"), "explain_node")
+    graph.add_node("explain", explain)
 
     graph.set_entry_point("vision")
     graph.add_edge("vision", "coder")
-    graph.add_edge("coder", "explain")
+    graph.add_conditional_edges("coder", route_after_coder, {"explain": "explain", END: END})
     graph.add_edge("explain", END)
 
     app = graph.compile()
 
-        # inside graph.build_jarvis_graph()
+    # explain on its own, for deferred / on-demand explanations of a finished session
+    explain_graph = StateGraph(JarvisState)
+    explain_graph.add_node("explain", explain)
+    explain_graph.set_entry_point("explain")
+    explain_graph.add_edge("explain", END)
+    explain_app = explain_graph.compile()
+
+    # inside graph.build_jarvis_graph()
     def invoke_stream(initial_state: JarvisState) -> Generator[Tuple[str, str, str], None, None]:
+        """
+        Run the graph and yield (phase, chunk, session_id) as tokens arrive.
+        Nodes push their tokens via streaming.emit ("custom" mode); node completion
+        ("updates" mode) is used to persist the final per-node output.
+        """
         session_id = uuid.uuid4().hex
-        memory = ConversationMemory()
+        metadata = dict(initial_state.get("metadata") or {}, session_id=session_id)
+        # earlier runs of the same conversation, in short form, for follow-up instructions
+        memory = ConversationMemory.load(metadata.get("conversation_id"))
+        user_text = "\n".join(c for role, c in _user_texts(initial_state)) or metadata.get("prompt") or ""
+        metadata["history"] = memory.context() if _is_follow_up(memory, metadata, user_text) else ""
+        memory.add("user", user_text, image_hash=metadata.get("image_hash"))
+        if metadata.get("refine_from"):
+            refine = _refine_source(metadata["refine_from"])
+            if refine and metadata.get("image_hash") not in (None, refine["image_hash"]):
+                logger.info("New design uploaded; refining from scratch instead of patching %s", metadata["refine_from"])
+                refine = {}
+            metadata["refine"] = refine
+        initial_state = dict(initial_state, metadata=metadata)
+        journal = SessionJournal(session_id)
+        journal.meta(prompt=metadata.get("prompt"), image_hash=metadata.get("image_hash"),
+                     timings=metadata.get("timings"), conversation_id=metadata.get("conversation_id"),
+                     refine_from=metadata.get("refine_from"), models=STAGE_MODELS)
 
         try:
-            final_state = app.invoke(initial_state)
+            for mode, payload in app.stream(initial_state, stream_mode=["custom", "updates"]):
+                if mode == "custom":
+                    phase, chunk = payload
+                    if phase != "queue":  # transient wait notices are for the live UI only
+                        journal.chunk(phase, chunk)
+                    yield (phase, chunk, session_id)
+                    continue
+
+                # mode == "updates": {node_name: {"messages": [...]}}
+                for node_name, content in _iter_messages(payload):
+                    if not node_name.endswith("_think"):
+                        memory.add(node_name, content)
+                    journal.final(node_name, content)
+            journal.metrics(metrics.pop_session(session_id))
+            journal.close(status="done")
+            memory.save()
+            if explain_mode(initial_state) == "deferred":
+                explain_in_background(session_id)
         except Exception as e:
             logger.exception("Graph execution failed: %s", e)
+            journal.metrics(metrics.pop_session(session_id))
+            journal.close(status="error", error=str(e))
             yield ("error", str(e), session_id)
             return
+        finally:
+            # no-op unless the consumer went away mid-stream (e.g. Streamlit rerun)
+            journal.close(status="aborted")
 
-        for m in final_state.get("messages", []):
-            node_name = getattr(m, "name", None) or (m.get("name") if isinstance(m, dict) else None)
-            content = getattr(m, "content", "") or (m.get("content") if isinstance(m, dict) else "")
+        yield ("done", "completed", session_id)
+
+    def invoke_explain(session_id: str) -> Generator[Tuple[str, str, str], None, None]:
+        """
+        Explain the code of a finished session and append the explanation to it.
+        Yields (phase, chunk, session_id) like invoke_stream; an explanation that
+        already exists is replayed from the session instead of regenerated.
+        """
+        with _explain_lock(session_id):
+            view = load_session(session_id)
+            if not view or not view["outputs"].get("coder"):
+                yield ("error", f"No generated code in session {session_id}", session_id)
+                return
+            if view["outputs"].get("explain"):
+                for phase in ("explain_think", "explain"):
+                    yield (phase, view["outputs"].get(phase, ""), session_id)
+                yield ("done", "completed", session_id)
+                return
+
+            journal = SessionJournal(session_id, resume=True)
+            journal.meta(explain_status="running")
+            state = {
+                "messages": [{"role": "assistant", "name": "coder", "content": view["outputs"]["coder"]}],
+                "user_image_b64": None,
+                "user_audio_bytes": None,
+                "metadata": dict(view.get("meta") or {}, session_id=session_id, explain_mode="eager"),
+            }
+            try:
+                for mode, payload in explain_app.stream(state, stream_mode=["custom", "updates"]):
+                    if mode == "custom":
+                        phase, chunk = payload
+                        if phase != "queue":
+                            journal.chunk(phase, chunk)
+                        yield (phase, chunk, session_id)
+                        continue
+                    for node_name, content in _iter_messages(payload):
+                        journal.final(node_name, content)
+                        if node_name == "explain":
+                            memory = ConversationMemory.load(view["meta"].get("conversation_id"))
+                            memory.add(node_name, content)
+                            memory.save()
+                journal.metrics(metrics.pop_session(session_id), key="explain")
+                journal.meta(explain_status="done")
+                journal.close(status=view.get("status") or "done")
+            except Exception as e:
+                logger.exception("Explain failed for session %s: %s", session_id, e)
+                journal.metrics(metrics.pop_session(session_id), key="explain")
+                journal.meta(explain_status="error", explain_error=str(e))
+                journal.close(status=view.get("status") or "done")
+                yield ("error", str(e), session_id)
+                return
+            finally:
+                journal.meta(explain_status="aborted")
+                journal.close(status=view.get("status") or "done")
 
-            if node_name is None:
-                continue
-
-            # If it's a 'thinking' message, emit it as a single block phase: e.g. "vision_think"
-            if node_name.endswith("_think"):
-                # store and yield whole thinking body once
-                memory.add(node_name, content)
-                _write_session(session_id, {f"{node_name}_partial": memory.recent(10)})
-                yield (node_name, content, session_id)
-                continue
-
-            # Otherwise it's a final node output; chunk and stream
-            if node_name in ("vision", "coder", "explain"):
-                chunk_size = 1024 if node_name == "coder" else 512
-                for i in range(0, len(content), chunk_size):
-                    chunk = content[i:i + chunk_size]
-                    memory.add(node_name, chunk)
-                    _write_session(session_id, {f"{node_name}_partial": memory.recent(10)})
-                    yield (node_name, chunk, session_id)
-
-        _write_session(session_id, {"status": "done"})
         yield ("done", "completed", session_id)
 
+    def explain_in_background(session_id: str) -> threading.Thread:
+        """Run invoke_explain on a daemon thread, behind interactive model calls."""
+        def run():
+            with priority(BATCH):
+                for phase, chunk, _ in invoke_explain(session_id):
+                    if phase == "error":
+                        logger.warning("Deferred explain for %s failed: %s", session_id, chunk)
+
+        thread = threading.Thread(target=run, name=f"explain-{session_id[:8]}", daemon=True)
+        thread.start()
+        return thread
 
     app.invoke_stream = invoke_stream
+    app.invoke_explain = invoke_explain
+    app.explain_in_background = explain_in_background
+    app.replay_session = replay_session
     return app
@@ -0,0 +1,138 @@
+# image_index.py
+import json
+import logging
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+from config import DB_DIR, PHASH_MAX_DISTANCE, PHASH_MAX_BLOCK_DIFF
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INDEX_PATH = DB_DIR / "phash_index.jsonl"
+THUMB_DIR = DB_DIR / "phash_thumbs"
+BLOCK = 8  # thumbnail pixels per side of a compared block
+SHIFT = 2  # thumbnail pixels of misalignment tolerated when comparing
+
+_SAFE_HASH = re.compile(r"^[0-9a-f]+$")
+
+
+def max_block_diff(a: bytes, b: bytes, max_shift: int = SHIFT) -> float:
+    """
+    Largest mean absolute difference (0-255) over BLOCK x BLOCK blocks of two
+    square greyscale thumbnails, at the best alignment within +-max_shift
+    pixels (residual crop/scale differences). A changed label is a small but
+    dense change, which a whole-image mean would average away.
+    """
+    if len(a) != len(b) or not a:
+        return 255.0
+    size = int(len(a) ** 0.5)
+    im_a, im_b = Image.frombytes("L", (size, size), a), Image.frombytes("L", (size, size), b)
+    best = 255.0
+    for dy in range(-max_shift, max_shift + 1):
+        for dx in range(-max_shift, max_shift + 1):
+            # overlapping window of a and b shifted by (dx, dy), trimmed to whole blocks
+            w = (size - abs(dx)) // BLOCK * BLOCK
+            h = (size - abs(dy)) // BLOCK * BLOCK
+            box_a = (max(dx, 0), max(dy, 0), max(dx, 0) + w, max(dy, 0) + h)
+            box_b = (max(-dx, 0), max(-dy, 0), max(-dx, 0) + w, max(-dy, 0) + h)
+            diff = ImageChops.difference(im_a.crop(box_a), im_b.crop(box_b))
+            blocks = diff.resize((w // BLOCK, h // BLOCK), Image.BOX)
+            best = min(best, float(blocks.getextrema()[1]))
+    return best
+
+
+class PerceptualIndex:
+    """
+    Persisted map of perceptual hash -> exact image hash, used to find designs
+    that are visually near-identical to one already analysed.
+
+    The index is an append-only JSONL file loaded at startup; lookups are a
+    linear XOR/popcount scan, which stays well under a millisecond for the
+    tens of thousands of screens we expect. A hash match is only returned once
+    the stored thumbnail confirms it block by block: screens sharing a layout
+    but not their labels can still hash alike.
+    """
+
+    def __init__(self, path: Path = INDEX_PATH, max_distance: int = PHASH_MAX_DISTANCE,
+                 max_block_diff: float = PHASH_MAX_BLOCK_DIFF, thumb_dir: Path = THUMB_DIR):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_block_diff = max_block_diff
+        self.thumb_dir = thumb_dir
+        self.thumb_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[int, int]] = {}  # image_hash -> (phash as int, bits)
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open(encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        rec = json.loads(line)
+                        self._entries[rec["image_hash"]] = (int(rec["phash"], 16), len(rec["phash"]) * 4)
+                    except (ValueError, KeyError):
+                        continue
+        except Exception:
+            logger.exception("Perceptual index load failed")
+
+    def _thumb_path(self, image_hash: str) -> Optional[Path]:
+        return self.thumb_dir / f"{image_hash}.bin" if _SAFE_HASH.match(image_hash or "") else None
+
+    def add(self, phash: str, image_hash: str, thumb: Optional[bytes] = None):
+        if not phash or not image_hash:
+            return
+        with self._lock:
+            if image_hash in self._entries:
+                return
+            self._entries[image_hash] = (int(phash, 16), len(phash) * 4)
+            try:
+                fp = self._thumb_path(image_hash)
+                if thumb and fp is not None:
+                    fp.write_bytes(thumb)
+                with self.path.open("a", encoding="utf-8") as fp:
+                    fp.write(json.dumps({"phash": phash, "image_hash": image_hash}) + "\n")
+            except Exception:
+                logger.exception("Perceptual index write failed")
+
+    def find(self, phash: str, thumb: Optional[bytes] = None,
+             max_distance: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """
+        Return (image_hash, distance) of the closest indexed design within
+        max_distance whose thumbnail matches `thumb`; None without a thumbnail.
+        """
+        if not phash or not thumb:
+            return None
+        limit = self.max_distance if max_distance is None else max_distance
+        if limit <= 0:
+            return None
+        target, bits = int(phash, 16), len(phash) * 4
+        candidates = []
+        with self._lock:
+            for image_hash, (value, value_bits) in self._entries.items():
+                if value_bits != bits:
+                    # indexed with an older hash size
+                    continue
+                d = bin(target ^ value).count("1")
+                if d <= limit:
+                    candidates.append((d, image_hash))
+        for d, image_hash in sorted(candidates):
+            fp = self._thumb_path(image_hash)
+            if fp is None or not fp.exists():
+                continue
+            diff = max_block_diff(thumb, fp.read_bytes())
+            if diff <= self.max_block_diff:
+                return image_hash, d
+            logger.info("Perceptual match %s (distance %d) rejected: block difference %.1f",
+                        image_hash[:12], d, diff)
+        return None
+
+
+image_index = PerceptualIndex()
@@ -1,8 +1,28 @@
 # llm.py
+import asyncio
 import logging
+import queue
+import random
+import threading
 import time
 import json
-from typing import List, Dict, Generator, Any, Optional
+from typing import List, Dict, Generator, AsyncGenerator, Any, Optional
+
+from config import (
+    OLLAMA_HOST,
+    LLM_CONNECT_TIMEOUT,
+    LLM_FIRST_TOKEN_TIMEOUT,
+    LLM_IDLE_TIMEOUT,
+    LLM_TOTAL_TIMEOUT,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BACKOFF,
+    LLM_MAX_CONNECTIONS,
+    MAX_LOADED_MODELS,
+    LLM_KEEP_ALIVE,
+    LLM_PINNED_MODELS,
+)
+from metrics import metrics
+from scheduler import scheduler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -10,9 +30,18 @@ logger.setLevel(logging.INFO)
 # Try to import Ollama or other streaming client. If you use another client adapt the code.
 try:
     import ollama
+    import httpx
 except Exception:
     ollama = None
 
+
+class LLMError(RuntimeError):
+    """A model call failed after exhausting retries (or with a non-retryable error)."""
+
+
+class LLMTimeout(LLMError):
+    pass
+
 def _extract_text_from_chunk(chunk: Any) -> str:
     """
     Normalize various chunk shapes into a plain string.
@@ -22,6 +51,7 @@ def _extract_text_from_chunk(chunk: Any) -> str:
       - dicts like {'choices':[{'delta':{'content':'...'}}]}
       - dicts containing 'content' or 'text'
       - other dicts -> json.dumps
+      - ChatResponse objects -> message.content
     """
     if chunk is None:
         return ""
@@ -58,59 +88,365 @@ def _extract_text_from_chunk(chunk: Any) -> str:
             return json.dumps(chunk, ensure_ascii=False)
         except Exception:
             return str(chunk)
+    # ollama>=0.4 returns pydantic ChatResponse objects: chunk.message.content
+    msg = getattr(chunk, "message", None)
+    if msg is not None and getattr(msg, "content", None) is not None:
+        return str(msg.content)
     # fallback to str()
     return str(chunk)
 
-def stream_ollama(messages: List[Dict[str, str]], model: str, timeout: int = 300) -> Generator[str, None, None]:
+def _is_retryable(e: BaseException) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if ollama is not None:
+        if isinstance(e, httpx.TransportError):  # connect/read errors, dropped streams
+            return True
+        if isinstance(e, ollama.ResponseError):
+            return e.status_code in (408, 429, 500, 502, 503, 504)
+    return False
+
+
+class AsyncOllamaClient:
     """
-    Stream string chunks from the LLM. Always yields plain strings.
-    Adapt to your streaming client if necessary.
+    Async Ollama client shared by the whole process.
+
+    One ollama.AsyncClient (and so one pooled httpx connection pool) lives on a
+    dedicated event-loop thread; sync callers bridge to it via stream()/chat().
+    Every call enforces connect, first-token, inter-token and total timeouts,
+    retries with jittered backoff on retryable errors only, and when a stream
+    breaks part-way it resumes by sending the partial answer back as an
+    assistant prefix, so already-streamed text is neither regenerated nor repeated.
     """
-    logger.info("Start stream for model=%s", model)
-    start = time.time()
 
-    if ollama:
+    def __init__(self, host: Optional[str] = OLLAMA_HOST):
+        self.host = host
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ollama-client", daemon=True).start()
+                self._client = ollama.AsyncClient(
+                    host=self.host,
+                    # read timeouts are enforced per token below; httpx only bounds the connect
+                    timeout=httpx.Timeout(None, connect=LLM_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                        max_keepalive_connections=LLM_MAX_CONNECTIONS),
+                )
+                self._loop = loop
+            return self._loop
+
+    async def astream(self, messages: List[Dict[str, str]], model: str,
+                      total_timeout: float = LLM_TOTAL_TIMEOUT, usage: Optional[Dict[str, int]] = None,
+                      **kwargs) -> AsyncGenerator[str, None]:
+        """Yield text chunks; token counts from the final chunk(s) are added to `usage`."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + total_timeout
+        produced = ""
+        attempt = 0
+        while True:
+            # resume: the model continues a trailing assistant message
+            msgs = messages if not produced else list(messages) + [{"role": "assistant", "content": produced}]
+            it = None
+            try:
+                stream = await self._client.chat(model=model, messages=msgs, stream=True, **kwargs)
+                it = stream.__aiter__()
+                first = True
+                while True:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise LLMTimeout(f"model={model} exceeded total timeout of {total_timeout:.0f}s")
+                    wait = min(remaining, LLM_FIRST_TOKEN_TIMEOUT if first else LLM_IDLE_TIMEOUT)
+                    try:
+                        chunk = await asyncio.wait_for(it.__anext__(), timeout=wait)
+                    except StopAsyncIteration:
+                        return
+                    except asyncio.TimeoutError:
+                        if wait == remaining:
+                            raise LLMTimeout(f"model={model} exceeded total timeout of {total_timeout:.0f}s")
+                        raise asyncio.TimeoutError(f"no {'first ' if first else ''}token within {wait:g}s")
+                    first = False
+                    if usage is not None and getattr(chunk, "done", False):
+                        usage["prompt_tokens"] = getattr(chunk, "prompt_eval_count", None) or 0
+                        usage["completion_tokens"] = usage.get("completion_tokens", 0) + (getattr(chunk, "eval_count", None) or 0)
+                    text = _extract_text_from_chunk(chunk)
+                    if text:
+                        produced += text
+                        yield text
+            except LLMTimeout:
+                raise
+            except Exception as e:
+                remaining = deadline - loop.time()
+                if not _is_retryable(e) or attempt >= LLM_MAX_RETRIES or remaining <= 0:
+                    raise LLMError(f"model={model}: {type(e).__name__}: {e}") from e
+                attempt += 1
+                backoff = min(LLM_RETRY_BACKOFF * 2 ** (attempt - 1), 8.0) * random.uniform(0.5, 1.0)
+                logger.warning("LLM call failed (%s: %s); retry %d/%d in %.2fs, resuming after %d chars",
+                               type(e).__name__, e, attempt, LLM_MAX_RETRIES, backoff, len(produced))
+                await asyncio.sleep(min(backoff, remaining))
+            finally:
+                if it is not None:
+                    try:
+                        await it.aclose()
+                    except Exception:
+                        pass
+
+    async def achat(self, messages: List[Dict[str, str]], model: str,
+                    total_timeout: float = LLM_TOTAL_TIMEOUT, usage: Optional[Dict[str, int]] = None,
+                    **kwargs) -> str:
+        parts = []
+        async for text in self.astream(messages, model, total_timeout, usage, **kwargs):
+            parts.append(text)
+        return "".join(parts)
+
+    def stream(self, messages: List[Dict[str, str]], model: str,
+               total_timeout: float = LLM_TOTAL_TIMEOUT, usage: Optional[Dict[str, int]] = None,
+               **kwargs) -> Generator[str, None, None]:
+        """Sync bridge: iterate astream() from any thread."""
+        loop = self._ensure_loop()
+        q: "queue.Queue" = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for text in self.astream(messages, model, total_timeout, usage, **kwargs):
+                    q.put(text)
+            except asyncio.CancelledError:
+                q.put(LLMError(f"model={model}: request cancelled (client closed)"))
+                raise
+            except Exception as e:
+                q.put(e)
+            finally:
+                q.put(done)
+
+        fut = asyncio.run_coroutine_threadsafe(pump(), loop)
         try:
-            stream_iter = ollama.chat(model=model, messages=messages, stream=True)
-            for chunk in stream_iter:
-                text = _extract_text_from_chunk(chunk)
-                # ensure string type
-                if not isinstance(text, str):
-                    text = str(text)
-                yield text
+            while True:
+                try:
+                    item = q.get(timeout=1.0)
+                except queue.Empty:
+                    # pump() always ends with `done`; a finished future with nothing queued
+                    # means its loop went away before it could say so
+                    if fut.done() and q.empty():
+                        raise LLMError(f"model={model}: stream ended without a result")
+                    continue
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # consumer stopped early: cancel the request and free the connection
+            fut.cancel()
+
+    def chat(self, messages: List[Dict[str, str]], model: str,
+             total_timeout: float = LLM_TOTAL_TIMEOUT, usage: Optional[Dict[str, int]] = None,
+             **kwargs) -> str:
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self.achat(messages, model, total_timeout, usage, **kwargs), loop).result()
+
+    async def aloaded(self) -> List[str]:
+        """Names of the models the server currently holds in memory."""
+        res = await self._client.ps()
+        return [m.model or m.name for m in (res.models or [])]
+
+    async def apreload(self, model: str, keep_alive=None):
+        """Load `model` without generating anything (an empty generate request)."""
+        await self._client.generate(model=model, prompt="", keep_alive=keep_alive)
+
+    async def aembed(self, model: str, texts: List[str], **kwargs) -> List[List[float]]:
+        """One embedding per text, in a single request."""
+        res = await self._client.embed(model=model, input=list(texts), **kwargs)
+        return [list(v) for v in res.embeddings]
+
+    def submit(self, coro_fn, *args, **kwargs):
+        """Run an async method on the client loop; returns a concurrent.futures.Future."""
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args, **kwargs), loop)
+
+    def close(self, timeout: float = 10.0):
+        """
+        Cancel in-flight calls, wait for them to unwind (so stream() consumers
+        get an LLMError and release their scheduler slots), then stop the loop thread.
+        """
+        with self._lock:
+            loop, self._loop, self._client = self._loop, None, None
+        if loop is None:
+            return
+
+        async def shutdown():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=timeout)
         except Exception as e:
-            logger.exception("Streaming client failed, falling back to final sync call: %s", e)
-            # fallback to sync call if streaming fails
+            logger.warning("Ollama client shutdown did not finish cleanly: %s", e)
+        loop.call_soon_threadsafe(loop.stop)
+
+
+client = AsyncOllamaClient() if ollama else None
+
+
+def _model_tag(model: str) -> str:
+    # Ollama reports "name:tag"; a bare name means ":latest"
+    return model if ":" in model else f"{model}:latest"
+
+
+class ModelResidency:
+    """
+    Keeps the models the pipeline is about to use loaded on the Ollama server.
+
+    prefetch() loads the next stage's model while the current stage runs, when
+    the server has room for both (MAX_LOADED_MODELS; never evicting the model
+    in use). Pinned models are kept loaded indefinitely (keep_alive=-1) and are
+    exempt from the scheduler's swap avoidance.
+    """
+
+    def __init__(self, max_loaded: int = MAX_LOADED_MODELS, keep_alive=LLM_KEEP_ALIVE, pinned=LLM_PINNED_MODELS):
+        self.max_loaded = max_loaded
+        self.default_keep_alive = keep_alive
+        self.pinned = set()
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._pinned_preloaded = False
+        for model in pinned:
+            self.pin(model, preload=False)
+
+    def keep_alive(self, model: str):
+        return -1 if model in self.pinned else self.default_keep_alive
+
+    def pin(self, model: str, preload: bool = True):
+        """Keep `model` loaded until unpinned."""
+        self.pinned.add(model)
+        scheduler.pin(model)
+        if preload:
+            self.prefetch(model)
+
+    def unpin(self, model: str):
+        self.pinned.discard(model)
+        scheduler.pin(model, False)
+        if client:
+            # a keep_alive of the default lets the server unload it again
+            self._submit(model, lambda: client.apreload(model, self.default_keep_alive), "unpin")
+
+    def preload_pinned(self):
+        """Load the pinned models; only the first call per process does anything."""
+        if self._pinned_preloaded:
+            return
+        self._pinned_preloaded = True
+        for model in self.pinned:
+            self.prefetch(model)
+
+    def prefetch(self, model: Optional[str], current: Optional[str] = None):
+        """Start loading `model` in the background; `current` is the model in use now."""
+        if not client or not model:
+            return None
+
+        async def run():
+            loaded = {_model_tag(m) for m in await client.aloaded()}
+            if _model_tag(model) in loaded:
+                return "resident"
+            needed = loaded | {_model_tag(m) for m in (current, model) if m}
+            if self.max_loaded > 0 and model not in self.pinned and len(needed) > self.max_loaded:
+                # loading it now would evict a model that is (about to be) in use
+                return "no_room"
+            await client.apreload(model, self.keep_alive(model))
+            return "loaded"
+
+        return self._submit(model, run, "prefetch")
+
+    def _submit(self, model: str, make_coro, action: str):
+        with self._lock:
+            if model in self._inflight:
+                return None
+            self._inflight.add(model)
+        start = time.perf_counter()
+
+        def done(fut):
+            with self._lock:
+                self._inflight.discard(model)
             try:
-                resp = ollama.chat(model=model, messages=messages)
-                # try to extract content
-                if isinstance(resp, dict):
-                    content = _extract_text_from_chunk(resp)
-                    yield content
-                else:
-                    yield str(resp)
-            except Exception:
-                yield "[LLM ERROR]"
-    else:
-        # Simulated fallback for offline dev: yield text slowly
-        text = f"[SIMULATED STREAM: model={model}] " + "This is a simulated streaming response for local development."
-        for token in text.split():
-            yield token + " "
-            time.sleep(0.01)
+                result = fut.result()
+            except Exception as e:
+                result = "error"
+                logger.warning("Model %s of %s failed: %s", action, model, e)
+            metrics.inc("jarvis_model_prefetch_total", model=model, action=action, result=result or "ok")
+            if result == "loaded":
+                metrics.observe("jarvis_model_load_seconds", time.perf_counter() - start, model=model)
+                logger.info("Preloaded model %s (%.2fs)", model, time.perf_counter() - start)
 
-    logger.info("Stream finished (%.2fs)", time.time() - start)
+        fut = client.submit(make_coro)
+        fut.add_done_callback(done)
+        return fut
 
-def run_ollama(messages: List[Dict[str, str]], model: str, timeout: int = 60) -> str:
+
+residency = ModelResidency()
+
+
+def _keep_alive(model: str) -> Dict[str, Any]:
+    # every request resets the server's unload timer, so pinned models must say so each time
+    keep_alive = residency.keep_alive(model)
+    return {} if keep_alive is None else {"keep_alive": keep_alive}
+
+
+def _simulated_stream(model: str) -> Generator[str, None, None]:
+    # Simulated fallback for offline dev: yield text slowly
+    text = f"[SIMULATED STREAM: model={model}] " + "This is a simulated streaming response for local development."
+    for token in text.split():
+        yield token + " "
+        time.sleep(0.01)
+
+
+def stream_ollama(messages: List[Dict[str, str]], model: str, timeout: int = LLM_TOTAL_TIMEOUT) -> Generator[str, None, None]:
     """
-    Synchronous call that returns a single string response.
+    Stream string chunks from the LLM. Always yields plain strings.
+    `timeout` bounds the whole call; raises LLMError once retries are exhausted.
+    Waits for a slot from the process-wide scheduler first (SchedulerOverloaded if it is full).
+    Queue wait, time to first token, generation time and token counts are recorded in metrics.
     """
-    if ollama:
+    logger.info("Start stream for model=%s", model)
+    start = time.time()
+    usage: Dict[str, int] = {}
+    chunks, first_at, outcome = 0, None, "error"
+
+    queued = time.perf_counter()
+    with scheduler.slot(model):
+        sent = time.perf_counter()
         try:
-            resp = ollama.chat(model=model, messages=messages)
-            # attempt to extract meaningful text
-            return _extract_text_from_chunk(resp)
-        except Exception as e:
-            logger.exception("run_ollama failed: %s", e)
-            return "[LLM SYNC ERROR]"
-    # fallback simulation
-    return "[SIMULATED SYNC RESPONSE]"
+            source = (client.stream(messages, model, total_timeout=timeout, usage=usage, **_keep_alive(model))
+                      if client else _simulated_stream(model))
+            for text in source:
+                if first_at is None:
+                    first_at = time.perf_counter()
+                chunks += 1
+                yield text
+            outcome = "ok"
+        except GeneratorExit:
+            outcome = "cancelled"
+            raise
+        finally:
+            end = time.perf_counter()
+            metrics.record_llm_call(
+                model, outcome,
+                queue_wait=sent - queued,
+                ttft=(first_at - sent) if first_at is not None else None,
+                generation=end - (first_at or end),
+                chunks=chunks,
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0 if client else chunks),
+            )
+
+    logger.info("Stream finished (%.2fs)", time.time() - start)
+
+def embed_ollama(texts: List[str], model: str, timeout: float = LLM_TOTAL_TIMEOUT) -> List[List[float]]:
+    """Embed a batch of texts with an Ollama embedding model (one scheduled request)."""
+    if not client:
+        raise LLMError("embedding needs an Ollama client")
+    with scheduler.slot(model):
+        return client.submit(client.aembed, model, texts, **_keep_alive(model)).result(timeout=timeout)
@@ -0,0 +1,86 @@
+# llm_calls.py
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llm import stream_ollama
+from streaming import emit
+from config import LLM_MAX_PARALLEL_CALLS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@dataclass
+class LLMCall:
+    """
+    One model call inside an agent, declared with its dependencies.
+
+    `messages` receives the outputs of the calls named in `depends_on` and
+    returns the chat messages to send. Tokens are streamed out on `phase` (if
+    set). If `on_error` is set, a failure yields that text instead of raising.
+    """
+    name: str
+    model: str
+    messages: Callable[[Dict[str, str]], List[Dict[str, str]]]
+    depends_on: Tuple[str, ...] = ()
+    phase: Optional[str] = None
+    on_error: Optional[str] = None
+
+
+def _run_one(call: LLMCall, deps: Dict[str, str]) -> str:
+    try:
+        acc = ""
+        for chunk in stream_ollama(call.messages(deps), call.model):
+            acc += chunk
+            if call.phase:
+                emit(call.phase, chunk)
+        return acc
+    except Exception as e:
+        if call.on_error is None:
+            raise
+        logger.exception("LLM call %r failed: %s", call.name, e)
+        return call.on_error
+
+
+def run_calls(calls: List[LLMCall], max_workers: int = LLM_MAX_PARALLEL_CALLS) -> Dict[str, str]:
+    """
+    Run a set of calls, starting each as soon as its dependencies are done, with
+    independent calls in flight concurrently. Returns {call name: output}.
+    """
+    by_name = {c.name: c for c in calls}
+    for c in calls:
+        missing = [d for d in c.depends_on if d not in by_name]
+        if missing:
+            raise ValueError(f"LLM call {c.name!r} depends on unknown calls {missing}")
+
+    results: Dict[str, str] = {}
+    pending = list(calls)
+    running = {}
+
+    if len(calls) == 1 or max_workers <= 1:
+        # nothing to overlap: run in order on the caller's thread
+        while pending:
+            ready = next((c for c in pending if all(d in results for d in c.depends_on)), None)
+            if ready is None:
+                raise ValueError("LLM call dependencies contain a cycle")
+            pending.remove(ready)
+            results[ready.name] = _run_one(ready, {d: results[d] for d in ready.depends_on})
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls)), thread_name_prefix="llm-call") as pool:
+        while pending or running:
+            for c in [c for c in pending if all(d in results for d in c.depends_on)]:
+                pending.remove(c)
+                deps = {d: results[d] for d in c.depends_on}
+                # copy the context so the graph's stream writer is visible in the worker
+                ctx = contextvars.copy_context()
+                running[pool.submit(ctx.run, _run_one, c, deps)] = c.name
+            if not running:
+                raise ValueError("LLM call dependencies contain a cycle")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                results[running.pop(fut)] = fut.result()
+    return results
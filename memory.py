@@ -1,21 +1,185 @@
 # memory.py
-from typing import List, Dict, Any
-import time, logging
+import json
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional
+
+from config import DB_DIR, MEMORY_MAX_ITEMS, MEMORY_SUMMARY_TOKENS, MEMORY_CONTEXT_TOKENS
+from prompt_budget import estimate_tokens, compact_code, compact_vision, truncate_tokens
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+MEMORY_DIR = DB_DIR / "memory"
+MEMORY_DIR.mkdir(parents=True, exist_ok=True)
+
+_SAFE_ID = re.compile(r"[^A-Za-z0-9_-]")
+
+# serialises read-merge-write of one conversation's file within the process
+_save_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_save_locks_guard = threading.Lock()
+_DEF = re.compile(r"^\s*(?:class|def|async def)\s+(\w+)", re.M)
+
+
+def _digest(role: str, content: str) -> str:
+    """Short form of one turn: what later turns need to know, not the full text."""
+    if role == "coder":
+        return compact_code(content)
+    if role == "vision":
+        return compact_vision(content)
+    return content.strip()
+
+
+def _one_line(role: str, content: str, limit: int = 200) -> str:
+    """A single summary line for a turn that falls out of the ring buffer."""
+    if role == "coder":
+        names = list(dict.fromkeys(_DEF.findall(content)))
+        text = "wrote " + ", ".join(names[:12]) if names else content
+    elif role == "vision":
+        items = [l.replace("**", "").strip("-*• ").strip() for l in compact_vision(content).splitlines() if l.strip() and not l.startswith("#")]
+        text = f"{len(items)} components: " + "; ".join(items[:6]) if items else content
+    else:
+        text = content
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
 class ConversationMemory:
-    def __init__(self, max_items: int = 12):
+    """
+    Memory of one conversation (a user's successive runs).
+
+    The most recent `max_items` turns are kept verbatim in a ring buffer; each
+    turn pushed out of it is folded into a rolling summary (one line per turn,
+    oldest lines dropped beyond `summary_tokens`), so nothing is recomputed or
+    copied as the conversation grows. With a conversation id the memory is
+    persisted under db/memory and reloaded by the next run; save() merges this
+    instance's new turns into whatever was stored meanwhile (e.g. by a
+    background explanation), so concurrent runs do not drop each other's turns.
+    """
+
+    def __init__(self, conversation_id: Optional[str] = None, max_items: int = MEMORY_MAX_ITEMS,
+                 summary_tokens: int = MEMORY_SUMMARY_TOKENS):
+        self.conversation_id = conversation_id
         self.max_items = max_items
-        self.items: List[Dict[str, Any]] = []
+        self.summary_tokens = summary_tokens
+        self.items: Deque[Dict[str, Any]] = deque(maxlen=max_items)
         self.summary: str = ""
+        self._new: List[Dict[str, Any]] = []  # turns added since load, not yet saved
+        self._lock = threading.Lock()
+
+    # ---------------- persistence ----------------
+
+    @staticmethod
+    def path_for(conversation_id: str) -> Path:
+        return MEMORY_DIR / f"{_SAFE_ID.sub('_', conversation_id)}.json"
+
+    @classmethod
+    def load(cls, conversation_id: Optional[str], **kwargs) -> "ConversationMemory":
+        """The stored memory of a conversation, or an empty one."""
+        mem = cls(conversation_id, **kwargs)
+        if conversation_id:
+            mem._read()
+        return mem
+
+    def _read(self):
+        fp = self.path_for(self.conversation_id)
+        if not fp.exists():
+            return
+        try:
+            data = json.loads(fp.read_text(encoding="utf-8"))
+            self.summary = data.get("summary", "")
+            for item in data.get("items", []):
+                self._push(item)
+        except Exception:
+            logger.exception("Conversation memory read failed for %s", self.conversation_id)
+
+    def save(self):
+        """Append the turns added since load to the stored memory (re-read under a lock) and write it."""
+        if not self.conversation_id:
+            return
+        with _save_locks_guard:
+            save_lock = _save_locks.setdefault(self.conversation_id, threading.Lock())
+        with save_lock:
+            with self._lock:
+                new = list(self._new)
+            merged = ConversationMemory(self.conversation_id, self.max_items, self.summary_tokens)
+            merged._read()
+            for item in new:
+                merged._push(item)
+            data = {"conversation_id": self.conversation_id, "summary": merged.summary, "items": list(merged.items)}
+            fp = self.path_for(self.conversation_id)
+            tmp = fp.with_suffix(f".json.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+                os.replace(tmp, fp)
+            except Exception:
+                logger.exception("Conversation memory write failed for %s", self.conversation_id)
+                return
+            with self._lock:
+                del self._new[:len(new)]
+                self.items, self.summary = merged.items, merged.summary
+
+    # ---------------- updates ----------------
+
+    def _push(self, item: Dict[str, Any]):
+        if len(self.items) == self.items.maxlen:
+            oldest = self.items[0]
+            self._fold(oldest["role"], oldest["content"])
+        self.items.append(item)
+
+    def _fold(self, role: str, content: str):
+        line = f"- {role}: {_one_line(role, content)}"
+        lines = (self.summary.splitlines() if self.summary else []) + [line]
+        while len(lines) > 1 and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+
+    def add(self, role: str, content: str, **extra):
+        if not content:
+            return
+        item = {"role": role, "content": content, "ts": time.time(), **extra}
+        with self._lock:
+            self._push(item)
+            self._new.append(item)
+
+    def last(self, role: str) -> Optional[Dict[str, Any]]:
+        """The most recent turn of `role` still in the ring buffer."""
+        with self._lock:
+            return next((item for item in reversed(self.items) if item["role"] == role), None)
+
+    def recent(self, n: int = 5) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.items)[-n:]
 
-    def add(self, role: str, content: str):
-        self.items.append({"role": role, "content": content, "ts": time.time()})
-        if len(self.items) > self.max_items:
-            # naive policy: keep last half and mark summary
-            self.summary = "[older messages summarized]"
-            self.items = self.items[-(self.max_items // 2):]
+    # ---------------- context for the agents ----------------
 
-    def recent(self, n: int = 5):
-        return self.items[-n:]
\ No newline at end of file
+    def context(self, max_tokens: int = MEMORY_CONTEXT_TOKENS, model: str = "") -> str:
+        """
+        Earlier turns for a prompt, within max_tokens: the newest turns (in
+        short form) first fill the budget, then the summary of older ones.
+        """
+        with self._lock:
+            items, summary = list(self.items), self.summary
+        if not items and not summary:
+            return ""
+        parts: List[str] = []
+        used = 0
+        for item in reversed(items):
+            block = f"[{item['role']}]\n{_digest(item['role'], item['content'])}"
+            cost = estimate_tokens(block, model)
+            if used + cost > max_tokens:
+                if not parts:
+                    # always carry the latest turn, cut to fit
+                    parts.append(truncate_tokens(block, max_tokens, model))
+                break
+            parts.append(block)
+            used += cost
+        if summary and used + estimate_tokens(summary, model) <= max_tokens:
+            parts.append(f"[earlier turns]\n{summary}")
+        return "\n\n".join(reversed(parts))
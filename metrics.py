@@ -0,0 +1,242 @@
+# metrics.py
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import METRICS_PORT
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HELP = {
+    "jarvis_node_seconds": ("histogram", "Wall time of one graph node run."),
+    "jarvis_llm_queue_wait_seconds": ("histogram", "Time an LLM call waited for a model slot."),
+    "jarvis_llm_queue_depth": ("gauge", "LLM calls waiting for a model slot."),
+    "jarvis_llm_active_calls": ("gauge", "LLM calls holding a model slot."),
+    "jarvis_llm_rejected_total": ("counter", "LLM calls rejected by the scheduler."),
+    "jarvis_llm_ttft_seconds": ("histogram", "Time from sending an LLM request to its first token."),
+    "jarvis_llm_generation_seconds": ("histogram", "Time from first to last token of an LLM call."),
+    "jarvis_llm_calls_total": ("counter", "LLM calls by outcome."),
+    "jarvis_llm_prompt_tokens_total": ("counter", "Prompt tokens evaluated."),
+    "jarvis_llm_completion_tokens_total": ("counter", "Completion tokens generated."),
+    "jarvis_llm_chunks_total": ("counter", "Streamed chunks received."),
+    "jarvis_prompt_compactions_total": ("counter", "Upstream outputs compacted to fit a stage's prompt budget."),
+    "jarvis_model_prefetch_total": ("counter", "Background model preload / keep-alive requests by result."),
+    "jarvis_model_load_seconds": ("histogram", "Time to preload a model ahead of its stage."),
+    "jarvis_cache_lookups_total": ("counter", "Response cache lookups by result."),
+    "jarvis_preprocess_seconds": ("histogram", "Image preprocessing time."),
+    "jarvis_transcription_seconds": ("histogram", "Audio transcription time."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# set by the graph's node wrapper so model calls inside a node are attributed to it
+_session: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("metrics_session", default=None)
+_node: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("metrics_node", default=None)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """
+    In-process metrics: counters and latency histograms with labels, rendered in
+    Prometheus text format, plus a per-session summary of what each run cost.
+    """
+
+    def __init__(self, max_sessions: int = 256):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self.max_sessions = max_sessions
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram()
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # ---------------- per-session summaries ----------------
+
+    def _session_summary(self, session_id: str) -> Dict[str, Any]:
+        summary = self._sessions.get(session_id)
+        if summary is None:
+            if len(self._sessions) >= self.max_sessions:
+                # drop the oldest unclaimed summary
+                self._sessions.pop(next(iter(self._sessions)))
+            summary = self._sessions[session_id] = {"nodes": {}, "llm_calls": [], "cache": {}}
+        return summary
+
+    def record_node(self, node: str, seconds: float):
+        self.observe("jarvis_node_seconds", seconds, node=node)
+        session_id = _session.get()
+        if session_id:
+            with self._lock:
+                self._session_summary(session_id)["nodes"][node] = round(seconds, 4)
+
+    def record_llm_call(self, model: str, outcome: str, queue_wait: float, ttft: Optional[float],
+                        generation: float, chunks: int, prompt_tokens: int = 0, completion_tokens: int = 0):
+        node = _node.get()
+        self.inc("jarvis_llm_calls_total", model=model, node=node, outcome=outcome)
+        self.observe("jarvis_llm_queue_wait_seconds", queue_wait, model=model)
+        if ttft is not None:
+            self.observe("jarvis_llm_ttft_seconds", ttft, model=model, node=node)
+        self.observe("jarvis_llm_generation_seconds", generation, model=model, node=node)
+        self.inc("jarvis_llm_chunks_total", chunks, model=model, node=node)
+        self.inc("jarvis_llm_prompt_tokens_total", prompt_tokens, model=model, node=node)
+        self.inc("jarvis_llm_completion_tokens_total", completion_tokens, model=model, node=node)
+        session_id = _session.get()
+        if session_id:
+            with self._lock:
+                self._session_summary(session_id)["llm_calls"].append({
+                    "node": node, "model": model, "outcome": outcome,
+                    "queue_wait": round(queue_wait, 4),
+                    "ttft": round(ttft, 4) if ttft is not None else None,
+                    "generation": round(generation, 4),
+                    "chunks": chunks, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                })
+
+    def record_cache(self, result: str, stage: str = ""):
+        stage = (stage or "").split(":")[0] or None
+        self.inc("jarvis_cache_lookups_total", result=result, stage=stage)
+        session_id = _session.get()
+        if session_id:
+            with self._lock:
+                cache_summary = self._session_summary(session_id)["cache"]
+                cache_summary[result] = cache_summary.get(result, 0) + 1
+
+    @contextmanager
+    def node_scope(self, session_id: Optional[str], node: str):
+        """Attribute everything recorded inside to this session/node and time the node."""
+        s_token, n_token = _session.set(session_id), _node.set(node)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_node(node, time.perf_counter() - start)
+            _node.reset(n_token)
+            _session.reset(s_token)
+
+    def pop_session(self, session_id: str) -> Dict[str, Any]:
+        """Return (and forget) a session's summary, with totals filled in."""
+        with self._lock:
+            summary = self._sessions.pop(session_id, None) or {"nodes": {}, "llm_calls": [], "cache": {}}
+        calls: List[Dict[str, Any]] = summary["llm_calls"]
+        summary["totals"] = {
+            "llm_calls": len(calls),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in calls),
+            "completion_tokens": sum(c["completion_tokens"] for c in calls),
+            "queue_wait": round(sum(c["queue_wait"] for c in calls), 4),
+            "node_seconds": round(sum(summary["nodes"].values()), 4),
+        }
+        return summary
+
+    # ---------------- export ----------------
+
+    def render_prometheus(self) -> str:
+        def fmt(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            items = labels + extra
+            if not items:
+                return ""
+            return "{" + ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+        with self._lock:
+            counters = dict(self._counters)
+            counters.update(self._gauges)
+            histograms = {k: (list(h.counts), h.sum, h.count) for k, h in self._histograms.items()}
+
+        lines = []
+        names = sorted({n for n, _ in counters} | {n for n, _ in histograms})
+        for name in names:
+            kind, help_text = HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{fmt(labels)} {value:g}")
+            for (n, labels), (counts, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, c in zip(LATENCY_BUCKETS, counts):
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', f'{bound:g}'),))} {c}")
+                lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{fmt(labels)} {total:g}")
+                lines.append(f"{name}_count{fmt(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+_exporter: Optional[ThreadingHTTPServer] = None
+
+
+def start_http_exporter(port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on `port` from a daemon thread. Idempotent; no-op when port is 0."""
+    global _exporter
+    if not port or _exporter is not None:
+        return _exporter
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        _exporter = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    except OSError:
+        logger.exception("Metrics exporter could not bind port %d", port)
+        return None
+    threading.Thread(target=_exporter.serve_forever, name="metrics-exporter", daemon=True).start()
+    logger.info("Metrics exporter listening on :%d/metrics", port)
+    return _exporter
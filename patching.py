@@ -0,0 +1,97 @@
+# patching.py
+"""
+Apply model-written SEARCH/REPLACE edit blocks to a previous code output.
+
+    <<<<<<< SEARCH
+    exact lines from the current code
+    =======
+    the lines that replace them
+    >>>>>>> REPLACE
+
+Each SEARCH text must occur exactly once in the current code (an exact match,
+or failing that a match that ignores trailing whitespace). Python code blocks
+that parsed before the edit must still parse after it.
+"""
+import ast
+import logging
+import re
+from typing import List, NamedTuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_BLOCK = re.compile(
+    r"^<{5,9} ?SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[^\n]*$",
+    re.S | re.M,
+)
+_FENCE = re.compile(r"```(?:py|python|python3)?[ \t]*\n(.*?)```", re.S)
+
+
+class PatchError(ValueError):
+    """The edit blocks are missing, ambiguous, do not match, or break the code."""
+
+
+class Edit(NamedTuple):
+    search: str
+    replace: str
+
+
+def parse_edits(text: str) -> List[Edit]:
+    edits = [Edit(m.group(1), m.group(2)) for m in _BLOCK.finditer(text or "")]
+    if not edits:
+        raise PatchError("no SEARCH/REPLACE blocks in the reply")
+    return edits
+
+
+def _rstrip_lines(text: str) -> str:
+    return "\n".join(line.rstrip() for line in text.splitlines())
+
+
+def _apply_one(source: str, edit: Edit) -> str:
+    if not edit.search.strip():
+        raise PatchError("empty SEARCH block")
+    count = source.count(edit.search)
+    if count == 1:
+        return source.replace(edit.search, edit.replace, 1)
+    if count > 1:
+        raise PatchError(f"SEARCH text occurs {count} times: {edit.search.strip().splitlines()[0][:80]!r}")
+
+    # tolerate trailing-whitespace differences: match on right-stripped lines
+    lines = source.splitlines(keepends=True)
+    target = _rstrip_lines(edit.search).split("\n")
+    while target and not target[-1]:
+        target.pop()
+    stripped = [l.rstrip() for l in lines]
+    hits = [i for i in range(len(lines) - len(target) + 1) if stripped[i:i + len(target)] == target]
+    if len(hits) != 1:
+        raise PatchError(f"SEARCH text not found: {edit.search.strip().splitlines()[0][:80]!r}")
+    i = hits[0]
+    replacement = edit.replace if edit.replace.endswith("\n") or not edit.replace else edit.replace + "\n"
+    return "".join(lines[:i]) + replacement + "".join(lines[i + len(target):])
+
+
+def _parses(code: str) -> bool:
+    try:
+        ast.parse(code)
+        return True
+    except SyntaxError:
+        return False
+
+
+def validate(before: str, after: str):
+    """Python blocks that parsed in `before` must still parse in `after`."""
+    was_valid = all(_parses(b) for b in _FENCE.findall(before))
+    if not was_valid:
+        return
+    for body in _FENCE.findall(after):
+        if not _parses(body):
+            raise PatchError("patched code no longer parses")
+
+
+def apply_edits(source: str, edits: List[Edit]) -> str:
+    """Apply edits in order; raises PatchError without partial results."""
+    result = source
+    for edit in edits:
+        result = _apply_one(result, edit)
+    validate(source, result)
+    return result
@@ -1,17 +1,199 @@
 # preprocess.py
-from PIL import Image, ImageOps
-import io, hashlib
-from typing import Tuple
+from PIL import Image, ImageChops, ImageOps
+import io, hashlib, base64, threading, math, time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
-def preprocess_image_bytes(img_bytes: bytes, max_size: int = 1024, quality: int = 100) -> Tuple[bytes, str]:
+from metrics import metrics
+from config import (
+    PREPROCESS_TARGET_BYTES,
+    PREPROCESS_MEMO_SIZE,
+    VISION_TILE_SIZE,
+    VISION_TILE_OVERLAP,
+    VISION_TILE_MAX_WIDTH,
+)
+
+JPEG_QUALITY_MAX = 90
+JPEG_QUALITY_MIN = 40
+THUMB_SIZE = 128
+
+
+class PreprocessedImage(NamedTuple):
+    data: bytes   # encoded bytes sent to the vision model
+    sha256: str   # exact hash of `data`
+    phash: str    # 256-bit perceptual dHash, hex
+    b64: str      # base64 of `data`, computed once
+    format: str   # "JPEG" or "PNG"
+    thumb: bytes  # THUMB_SIZE x THUMB_SIZE greyscale pixels, to confirm a perceptual match
+
+
+_memo: "OrderedDict[tuple, PreprocessedImage]" = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def dhash(im: Image.Image, hash_size: int = 16) -> str:
+    """
+    Difference hash: shrink to (hash_size+1) x hash_size greyscale and record
+    whether each pixel is brighter than its right neighbour. Re-saves, small
+    cursor/pixel edits and slightly different margins flip only a few bits.
+    16 x 16 rather than the classic 8 x 8: UI screens sharing a layout are
+    otherwise indistinguishable.
+    """
+    small = im.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    px = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = px[row * (hash_size + 1) + col]
+            right = px[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def trim_border(im: Image.Image, tolerance: int = 32) -> Image.Image:
+    """
+    Crop away a uniform border (the colour of the top-left pixel), so the same
+    screen exported with a different margin hashes and thumbnails alike. The
+    tolerance keeps JPEG ringing next to the content from moving the box.
+    """
+    grey = im.convert("L")
+    background = grey.getpixel((0, 0))
+    mask = ImageChops.difference(grey, Image.new("L", grey.size, background)).point(lambda v: 255 if v > tolerance else 0)
+    box = mask.getbbox()
+    return im.crop(box) if box and box != (0, 0, *im.size) else im
+
+
+def thumbnail(im: Image.Image, size: int = THUMB_SIZE) -> bytes:
+    """Raw size x size greyscale pixels (box-filtered), for a pixel-level comparison."""
+    return im.convert("L").resize((size, size), Image.BOX).tobytes()
+
+
+def _encode_jpeg(im: Image.Image, quality: int) -> bytes:
+    out = io.BytesIO()
+    im.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+def _encode_adaptive(im: Image.Image, target_bytes: int) -> Tuple[bytes, str]:
+    """
+    Flat UI screenshots (<= 256 colours) become a lossless palette PNG when that
+    fits the budget; everything else is JPEG at the highest quality that fits,
+    found by bisecting over a few cheap (non-optimized) encodes.
+    """
+    colors = im.getcolors(256)
+    if colors is not None:
+        out = io.BytesIO()
+        im.quantize(colors=len(colors)).save(out, format="PNG")
+        if out.tell() <= target_bytes:
+            return out.getvalue(), "PNG"
+
+    data = _encode_jpeg(im, JPEG_QUALITY_MAX)
+    if len(data) <= target_bytes:
+        return data, "JPEG"
+    lo, hi, best = JPEG_QUALITY_MIN, JPEG_QUALITY_MAX - 1, None
+    while lo <= hi:
+        q = (lo + hi) // 2
+        candidate = _encode_jpeg(im, q)
+        if len(candidate) <= target_bytes:
+            best, lo = candidate, q + 1
+        else:
+            hi = q - 1
+    return (best or _encode_jpeg(im, JPEG_QUALITY_MIN)), "JPEG"
+
+
+def preprocess_image(img_bytes: bytes, max_size: int = 1024, quality: Optional[int] = None,
+                     target_bytes: int = PREPROCESS_TARGET_BYTES) -> PreprocessedImage:
     """
-    Resize, convert to RGB JPEG, compress, and return (bytes, sha256).
+    Downscale, convert to RGB, encode and return the bytes with their sha256,
+    perceptual hash and base64.
+
+    Large JPEGs are reduced at decode time (draft mode) so a 4K export is never
+    fully decoded. With quality=None the format and quality are chosen to land
+    under target_bytes; a fixed quality forces JPEG. Results are memoized by a
+    hash of the raw upload, so Streamlit reruns skip the work entirely.
     """
+    start = time.perf_counter()
+    key = (hashlib.blake2b(img_bytes, digest_size=16).digest(), max_size, quality, target_bytes)
+    with _memo_lock:
+        hit = _memo.get(key)
+        if hit is not None:
+            _memo.move_to_end(key)
+    if hit is not None:
+        metrics.observe("jarvis_preprocess_seconds", time.perf_counter() - start, memo="hit")
+        return hit
+
     with Image.open(io.BytesIO(img_bytes)) as im:
+        if im.format == "JPEG":
+            # let libjpeg decode at 1/2, 1/4 or 1/8 scale, staying >= max_size
+            im.draft("RGB", (max_size, max_size))
         im = ImageOps.exif_transpose(im).convert("RGB")
-        im.thumbnail((max_size, max_size))
-        out = io.BytesIO()
-        im.save(out, format="JPEG", quality=quality, optimize=True)
-        data = out.getvalue()
+        im.thumbnail((max_size, max_size), reducing_gap=2.0)
+        if quality is None:
+            data, fmt = _encode_adaptive(im, target_bytes)
+        else:
+            data, fmt = _encode_jpeg(im, quality), "JPEG"
         h = hashlib.sha256(data).hexdigest()
-        return data, h
+        # the perceptual hash and thumbnail describe the content, not the margin around it
+        content = trim_border(im)
+        result = PreprocessedImage(data, h, dhash(content), base64.b64encode(data).decode("ascii"), fmt,
+                                   thumbnail(content))
+
+    if PREPROCESS_MEMO_SIZE > 0:
+        with _memo_lock:
+            _memo[key] = result
+            while len(_memo) > PREPROCESS_MEMO_SIZE:
+                _memo.popitem(last=False)
+    metrics.observe("jarvis_preprocess_seconds", time.perf_counter() - start, memo="miss")
+    return result
+
+
+def preprocess_image_bytes(img_bytes: bytes, max_size: int = 1024, quality: Optional[int] = None) -> Tuple[bytes, str]:
+    """
+    Resize, convert to RGB, compress, and return (bytes, sha256).
+    """
+    processed = preprocess_image(img_bytes, max_size, quality)
+    return processed.data, processed.sha256
+
+
+def _spans(length: int, size: int, overlap: int) -> List[Tuple[int, int]]:
+    """Evenly spaced [start, end) windows of `size` covering `length` with at least `overlap`."""
+    if length <= size:
+        return [(0, length)]
+    n = math.ceil((length - overlap) / (size - overlap))
+    return [(round(i * (length - size) / (n - 1)), round(i * (length - size) / (n - 1)) + size) for i in range(n)]
+
+
+def tile_image(img_bytes: bytes, tile_size: int = VISION_TILE_SIZE, overlap: int = VISION_TILE_OVERLAP,
+               max_width: int = VISION_TILE_MAX_WIDTH, quality: int = 85) -> List[Dict[str, Any]]:
+    """
+    Split a large screenshot into overlapping tiles for per-region analysis.
+
+    The page is first scaled down to at most max_width (never up), then cut into
+    a grid of tile_size windows. A page up to 1.5 tiles wide (e.g. a 1440px
+    desktop layout) is scaled to one tile's width instead, so it is cut into a
+    single column rather than two mostly-overlapping ones. Returns [{"box": [l, t, r, b], "b64": ...}] in
+    reading order, boxes in the scaled page's coordinates.
+    """
+    with Image.open(io.BytesIO(img_bytes)) as im:
+        if im.format == "JPEG":
+            im.draft("RGB", (max_width, im.height * max_width // max(im.width, 1)))
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        width = min(im.width, max_width)
+        if width <= tile_size * 1.5:
+            width = min(width, tile_size)
+        if im.width > width:
+            im = im.resize((width, round(im.height * width / im.width)), Image.LANCZOS, reducing_gap=2.0)
+
+        tiles = []
+        for top, bottom in _spans(im.height, tile_size, overlap):
+            for left, right in _spans(im.width, tile_size, overlap):
+                out = io.BytesIO()
+                im.crop((left, top, right, bottom)).save(out, format="JPEG", quality=quality)
+                tiles.append({"box": [left, top, right, bottom], "b64": base64.b64encode(out.getvalue()).decode("ascii")})
+        return tiles
+
+
+def needs_tiling(img_bytes: bytes, tile_size: int = VISION_TILE_SIZE) -> bool:
+    """True when the page is big enough that one downscaled image would lose detail."""
+    with Image.open(io.BytesIO(img_bytes)) as im:
+        return max(im.size) > tile_size * 1.5
@@ -0,0 +1,162 @@
+# prompt_budget.py
+import ast
+import logging
+import re
+from typing import Callable, List, Optional, Tuple
+
+from config import PROMPT_BUDGET_CODER, PROMPT_BUDGET_EXPLAIN
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STAGE_BUDGETS = {"coder": PROMPT_BUDGET_CODER, "explain": PROMPT_BUDGET_EXPLAIN}
+
+# Rough characters per token by model family (BPE vocabularies differ; code
+# tokenizes denser than prose). Erring low over-estimates, which is the safe side.
+CHARS_PER_TOKEN = (
+    ("coder", 3.2),
+    ("deepseek", 3.4),
+    ("qwen", 3.6),
+    ("llama", 3.8),
+)
+DEFAULT_CHARS_PER_TOKEN = 3.5
+
+_FENCE = re.compile(r"```([\w+-]*)[^\n]*\n(.*?)```", re.S)
+_LIST_ITEM = re.compile(r"^\s*(?:[-*•+]|\d+[.)])\s+")
+_FILENAME = re.compile(r"[\w./-]+\.(?:py|ini|cfg|toml|txt|json|ya?ml)\b")
+
+Compactor = Callable[[str], str]
+
+
+def estimate_tokens(text: str, model: str = "") -> int:
+    """Estimate how many tokens `model` will see for `text` (no tokenizer needed)."""
+    if not text:
+        return 0
+    ratio = next((r for family, r in CHARS_PER_TOKEN if family in (model or "").lower()), DEFAULT_CHARS_PER_TOKEN)
+    return int(len(text) / ratio) + 1
+
+
+def stage_budget(stage: str) -> int:
+    return STAGE_BUDGETS.get(stage, PROMPT_BUDGET_CODER)
+
+
+# ---------------- compaction ----------------
+
+def _signature(node, indent: str = "") -> List[str]:
+    lines = [f"{indent}@{ast.unparse(d)}" for d in node.decorator_list]
+    if isinstance(node, ast.ClassDef):
+        bases = ", ".join(ast.unparse(b) for b in node.bases)
+        lines.append(f"{indent}class {node.name}" + (f"({bases})" if bases else "") + ":")
+    else:
+        prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+        returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+        lines.append(f"{indent}{prefix} {node.name}({ast.unparse(node.args)}){returns}:")
+    doc = ast.get_docstring(node)
+    if doc:
+        lines.append(f'{indent}    """{doc.strip().splitlines()[0]}"""')
+    return lines
+
+
+def code_outline(source: str) -> Optional[str]:
+    """Class / function signatures (with first docstring lines) of Python source; None if it does not parse."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    lines = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(ast.unparse(node))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            lines += _signature(node)
+        elif isinstance(node, ast.ClassDef):
+            lines += _signature(node)
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    lines += _signature(item, "    ")
+                elif isinstance(item, (ast.Assign, ast.AnnAssign)):
+                    # class-level constants: POM locators live here
+                    lines.append("    " + ast.unparse(item))
+            lines.append("")
+    return "\n".join(lines).strip()
+
+
+def compact_code(text: str) -> str:
+    """
+    Reduce generated code (markdown with fenced blocks) to what an explainer
+    needs: file names, imports, signatures and short non-Python blocks
+    (run commands, config). Prose outside code blocks is kept as headings only.
+    """
+    out = []
+    pos = 0
+    for match in _FENCE.finditer(text):
+        before = text[pos:match.start()]
+        pos = match.end()
+        out += [l.strip() for l in before.splitlines() if l.lstrip().startswith("#") or _FILENAME.search(l)][-3:]
+        lang, body = match.group(1).lower(), match.group(2)
+        outline = code_outline(body) if lang in ("", "py", "python", "python3") else None
+        if outline is not None:
+            first = body.lstrip().splitlines()[0] if body.strip() else ""
+            header = [first] if first.startswith("#") and _FILENAME.search(first) else []
+            out.append("```python\n" + "\n".join(header + [outline]) + "\n```")
+        else:
+            lines = body.rstrip().splitlines()
+            out.append(f"```{lang}\n" + "\n".join(lines[:15]) + ("\n..." if len(lines) > 15 else "") + "\n```")
+    if pos == 0:
+        # no fences: the whole reply may be bare code
+        outline = code_outline(text)
+        return outline if outline is not None else text
+    return "\n".join(out)
+
+
+def compact_vision(text: str) -> str:
+    """Keep the structure of a vision analysis: headings and component/list lines."""
+    kept = [l.rstrip() for l in text.splitlines()
+            if l.lstrip().startswith("#") or _LIST_ITEM.match(l) or "|" in l]
+    return "\n".join(kept) if kept else text
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str = "") -> str:
+    """Keep the head and tail of `text` within max_tokens, marking the cut."""
+    tokens = estimate_tokens(text, model)
+    if tokens <= max_tokens:
+        return text
+    keep = int(len(text) * max_tokens / tokens)
+    head, tail = text[:keep * 2 // 3], text[len(text) - keep // 3:]
+    return f"{head}\n[… about {tokens - max_tokens} tokens omitted …]\n{tail}"
+
+
+def fit(text: str, max_tokens: int, model: str = "", compact: Optional[Compactor] = None, stage: str = "") -> str:
+    """Return `text` if it fits, else its compacted form, else that truncated."""
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    method = "truncate"
+    if compact is not None:
+        compacted = compact(text)
+        if len(compacted) < len(text):
+            method = "compact"
+            text = compacted
+    fitted = truncate_tokens(text, max_tokens, model)
+    if fitted is not text:
+        method = "compact+truncate" if method == "compact" else "truncate"
+    metrics.inc("jarvis_prompt_compactions_total", stage=stage or None, method=method)
+    return fitted
+
+
+def context_block(stage: str, model: str, sections: List[Tuple[str, str, Optional[Compactor]]]) -> str:
+    """
+    Build a stage's context message from (label, text, compactor) sections
+    within the stage budget. Sections without a compactor (user instructions)
+    are kept first, capped at a quarter of the budget; the rest share what is left.
+    """
+    budget = stage_budget(stage)
+    fixed = {label: fit(text, budget // 4, model, stage=stage) for label, text, c in sections if c is None}
+    remaining = budget - sum(estimate_tokens(t, model) for t in fixed.values())
+    flexible = [s for s in sections if s[2] is not None]
+    share = max(remaining, budget // 4) // max(len(flexible), 1)
+    parts = []
+    for label, text, compact in sections:
+        body = fixed[label] if compact is None else fit(text, share, model, compact, stage)
+        parts.append(f"{label}:\n{body or '(none)'}")
+    return "\n\n".join(parts)
@@ -0,0 +1,125 @@
+# resources.py
+"""
+Process-wide resources that should survive Streamlit reruns.
+
+Streamlit re-executes app.py on every interaction, but the Python process (and
+so this module) stays alive. The compiled graph, LLM client and the LangSmith
+key check are built once here and rebuilt only when the configuration they
+depend on changes (.env edited, or a relevant env var set). Model names are
+read from config at import time, so changing them needs a restart.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple
+
+from dotenv import dotenv_values
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ENV_PATH = Path(".env")
+
+# env vars baked into a built resource; changing one rebuilds it
+GRAPH_ENV = ("LANGSMITH_API_KEY", "LANGSMITH_TRACING", "LANGSMITH_PROJECT")
+CLIENT_ENV = ("OLLAMA_HOST",)
+
+KEY_CHECK_TTL = 600.0  # seconds a LangSmith key check result is trusted
+
+_lock = threading.Lock()
+_built: Dict[str, Tuple[str, Any]] = {}  # name -> (fingerprint, resource)
+_env_mtime = None
+# variables set by the real environment; .env never overrides these (as in config.py)
+_PROCESS_ENV = frozenset(os.environ)
+_key_checks: Dict[str, Tuple[float, bool]] = {}  # sha256(key) -> (checked at, valid)
+
+
+def _reload_env():
+    """
+    Re-read .env only when the file changed since the last read. Values from
+    .env are applied (and re-applied when edited) unless the process
+    environment set the variable itself.
+    """
+    global _env_mtime
+    try:
+        mtime = ENV_PATH.stat().st_mtime
+    except OSError:
+        return
+    if mtime != _env_mtime:
+        for name, value in dotenv_values(ENV_PATH).items():
+            if name not in _PROCESS_ENV and value is not None:
+                os.environ[name] = value
+        _env_mtime = mtime
+
+
+def config_fingerprint(names) -> str:
+    _reload_env()
+    h = hashlib.sha256()
+    for name in names:
+        h.update(f"{name}={os.getenv(name, '')}\x1f".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _get(name: str, env, build: Callable[[], Any], dispose: Callable[[Any], None] = None):
+    fingerprint = config_fingerprint(env)
+    with _lock:
+        current = _built.get(name)
+        if current and current[0] == fingerprint:
+            return current[1]
+        start = time.perf_counter()
+        resource = build()
+        _built[name] = (fingerprint, resource)
+        logger.info("Built %s (%.2fs)%s", name, time.perf_counter() - start, " after config change" if current else "")
+    if current and dispose:
+        try:
+            dispose(current[1])
+        except Exception:
+            logger.exception("Disposing old %s failed", name)
+    return resource
+
+
+def get_graph():
+    """The compiled Jarvis graph, compiled once per configuration."""
+    def build():
+        from graph import build_jarvis_graph
+        return build_jarvis_graph()
+    return _get("graph", GRAPH_ENV, build)
+
+
+def get_llm_client():
+    """The shared Ollama client, recreated if OLLAMA_HOST changes (None without ollama)."""
+    import llm
+
+    def build():
+        host = os.getenv("OLLAMA_HOST") or None
+        if llm.client is not None and llm.client.host != host:
+            llm.client = llm.AsyncOllamaClient(host)
+        return llm.client
+
+    def dispose(old):
+        if old is not None and old is not llm.client:
+            old.close()
+
+    return _get("llm_client", CLIENT_ENV, build, dispose)
+
+
+def langsmith_key_valid(api_key: str) -> bool:
+    """
+    Check a LangSmith API key against the server, remembering the answer per key
+    for KEY_CHECK_TTL seconds so reruns do not make a network round-trip each time.
+    """
+    digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    checked = _key_checks.get(digest)
+    if checked and time.monotonic() - checked[0] < KEY_CHECK_TTL:
+        return checked[1]
+    try:
+        from langsmith import Client
+        next(iter(Client(api_key=api_key).list_projects(limit=1)), None)
+        valid = True
+    except Exception:
+        valid = False
+    _key_checks[digest] = (time.monotonic(), valid)
+    return valid
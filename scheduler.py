@@ -0,0 +1,214 @@
+# scheduler.py
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    LLM_MODEL_CONCURRENCY,
+    LLM_DEFAULT_CONCURRENCY,
+    LLM_MAX_QUEUE,
+    LLM_QUEUE_TIMEOUT,
+    MAX_LOADED_MODELS,
+    LLM_SWAP_AFTER,
+)
+from metrics import metrics
+from streaming import emit
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Lower runs first.
+INTERACTIVE = 0
+BATCH = 10
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+# set around a unit of work (a UI run, a batch job); copied into the graph's
+# worker threads with the rest of the context
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+
+class SchedulerOverloaded(RuntimeError):
+    """Raised instead of queueing when a model's queue is full or the wait ran out."""
+
+
+@contextmanager
+def priority(level: int):
+    """Run the enclosed LLM calls at `level` (INTERACTIVE or BATCH)."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    """Parse "model=n,model=n" (model names may contain ':' but not '=' or ',')."""
+    limits = {}
+    for item in (spec or "").split(","):
+        model, _, n = item.strip().rpartition("=")
+        if model and n.strip().isdigit():
+            limits[model.strip()] = int(n)
+    return limits
+
+
+class _ModelQueue:
+    __slots__ = ("limit", "active", "waiting")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiting: List[Tuple[int, int, float]] = []  # heap of (priority, arrival seq, enqueued at)
+
+
+class LLMScheduler:
+    """
+    Process-wide admission control in front of the Ollama server.
+
+    Each model has a cap on concurrent calls. Calls over the cap wait in a
+    per-model priority queue (interactive before batch, then first come first
+    served) and are told their position on the "queue" stream phase. A call is
+    rejected with SchedulerOverloaded straight away when `max_queue` calls of
+    the same or higher priority are already waiting, and an interactive call
+    gives up after `queue_timeout` seconds; batch calls wait as long as needed.
+
+    With `max_models` set (the number of models the server can hold at once),
+    calls to a model that is not running wait while other models fill the
+    server, so calls for the loaded model run back-to-back instead of forcing
+    a swap per call. The loaded model stops taking new calls once another
+    model's caller has waited `swap_after` seconds (or is interactive behind
+    batch work). Pinned models are always resident and never wait for this.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, default_limit: int = LLM_DEFAULT_CONCURRENCY,
+                 max_queue: int = LLM_MAX_QUEUE, queue_timeout: float = LLM_QUEUE_TIMEOUT,
+                 max_models: int = MAX_LOADED_MODELS, swap_after: float = LLM_SWAP_AFTER):
+        self.default_limit = max(1, default_limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_models = max_models
+        self.swap_after = swap_after
+        self.pinned = set()
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._queues: Dict[str, _ModelQueue] = {}
+        for model, n in (limits or {}).items():
+            self.set_limit(model, n)
+
+    def _queue(self, model: str) -> _ModelQueue:
+        q = self._queues.get(model)
+        if q is None:
+            q = self._queues[model] = _ModelQueue(self.default_limit)
+        return q
+
+    def set_limit(self, model: str, limit: int):
+        """Allow at most `limit` concurrent calls to `model`."""
+        with self._cond:
+            self._queue(model).limit = max(1, limit)
+            self._cond.notify_all()
+
+    def pin(self, model: str, pinned: bool = True):
+        with self._cond:
+            (self.pinned.add if pinned else self.pinned.discard)(model)
+            self._cond.notify_all()
+
+    def _starved(self, model: str, level: int) -> bool:
+        """Has another model's caller waited long enough that `model` should drain?"""
+        now = time.monotonic()
+        for other, q in self._queues.items():
+            if other == model or other in self.pinned or not q.waiting:
+                continue
+            head_level, _, since = q.waiting[0]
+            if head_level < level or now - since >= self.swap_after:
+                return True
+        return False
+
+    def _resident_ok(self, model: str, q: _ModelQueue, level: int) -> bool:
+        # called with the condition held
+        if self.max_models <= 0 or model in self.pinned:
+            return True
+        if q.active:
+            # already loaded: keep feeding it unless someone else has waited too long
+            return not self._starved(model, level)
+        running = sum(1 for m, mq in self._queues.items() if mq.active and m not in self.pinned)
+        return running < max(1, self.max_models - len(self.pinned))
+
+    def _publish(self, model: str, q: _ModelQueue):
+        metrics.set_gauge("jarvis_llm_queue_depth", len(q.waiting), model=model)
+        metrics.set_gauge("jarvis_llm_active_calls", q.active, model=model)
+
+    def _reject(self, model: str, level: int, reason: str, message: str):
+        metrics.inc("jarvis_llm_rejected_total", model=model, priority=PRIORITY_NAMES.get(level, level), reason=reason)
+        logger.warning("Rejected %s call to %s: %s", PRIORITY_NAMES.get(level, level), model, reason)
+        raise SchedulerOverloaded(message)
+
+    @contextmanager
+    def slot(self, model: str):
+        """Hold one of `model`'s slots for the duration of a call."""
+        level = _priority.get()
+        with self._cond:
+            q = self._queue(model)
+            if q.active < q.limit and not q.waiting and self._resident_ok(model, q, level):
+                q.active += 1
+            else:
+                self._wait(model, q, level)
+            self._publish(model, q)
+        try:
+            yield
+        finally:
+            with self._cond:
+                q.active -= 1
+                self._publish(model, q)
+                self._cond.notify_all()
+
+    def _wait(self, model: str, q: _ModelQueue, level: int):
+        # called with the condition held
+        ahead = sum(1 for p, _, _ in q.waiting if p <= level)
+        if self.max_queue > 0 and ahead >= self.max_queue:
+            self._reject(model, level, "queue_full",
+                         f"{model} is busy ({ahead} requests waiting); try again shortly")
+
+        ticket = (level, next(self._seq), time.monotonic())
+        heapq.heappush(q.waiting, ticket)
+        self._publish(model, q)
+        deadline = time.monotonic() + self.queue_timeout if self.queue_timeout > 0 and level == INTERACTIVE else None
+        shown = None
+        try:
+            while True:
+                if q.waiting[0] == ticket and q.active < q.limit and self._resident_ok(model, q, level):
+                    heapq.heappop(q.waiting)
+                    q.active += 1
+                    # the next waiter may also fit (limit raised, several slots freed)
+                    self._cond.notify_all()
+                    return
+                position = 1 + sum(1 for t in q.waiting if t < ticket)
+                if position != shown:
+                    shown = position
+                    emit("queue", f"⏳ Waiting for {model}: position {position} in queue\n")
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    self._reject(model, level, "timeout",
+                                 f"{model} is busy; gave up after waiting {self.queue_timeout:g}s in queue")
+                if self.max_models > 0:
+                    # another model's drain-or-swap decision depends on time, not only on releases
+                    remaining = min(remaining, self.swap_after) if remaining is not None else self.swap_after
+                self._cond.wait(remaining)
+        except BaseException:
+            if ticket in q.waiting:
+                q.waiting.remove(ticket)
+                heapq.heapify(q.waiting)
+                self._publish(model, q)
+                self._cond.notify_all()
+            raise
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._cond:
+            return {m: {"limit": q.limit, "active": q.active, "waiting": len(q.waiting)}
+                    for m, q in self._queues.items()}
+
+
+scheduler = LLMScheduler(parse_limits(LLM_MODEL_CONCURRENCY))
@@ -0,0 +1,212 @@
+# semantic_index.py
+import atexit
+import base64
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+from array import array
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from config import DB_DIR, SEMANTIC_THRESHOLD, SEMANTIC_EMBED_MODEL, SEMANTIC_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INDEX_PATH = DB_DIR / "semantic_index.jsonl"
+NGRAM_DIM = 512
+
+_WORD = re.compile(r"\w+")
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+_NEGATIONS = frozenset({"no", "not", "never", "none", "nor", "without", "dont", "don't", "doesn't", "isn't",
+                        "shouldn't", "except", "excluding", "exclude", "avoid", "skip", "disable", "instead"})
+
+
+def _guard(text: str) -> Tuple[Tuple[str, ...], frozenset]:
+    """Numbers and negations of a text: two texts differing in these are never equivalent."""
+    text = (text or "").casefold()
+    negations = frozenset(w for w in re.findall(r"[\w']+", text) if w in _NEGATIONS)
+    return tuple(sorted(_NUMBER.findall(text))), negations
+
+
+def _bucket(feature: str) -> Tuple[int, float]:
+    h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+    return h % NGRAM_DIM, 1.0 if (h >> 63) & 1 else -1.0
+
+
+def ngram_embedding(text: str) -> array:
+    """
+    Local embedding: words and character trigrams hashed into NGRAM_DIM signed
+    buckets, L2-normalised. No model, so it is cheap and deterministic; it
+    captures rewording and typos, not paraphrase.
+    """
+    vec = [0.0] * NGRAM_DIM
+    for word in _WORD.findall((text or "").casefold()):
+        features = [f"w:{word}"] + [f"c:{g}" for g in (f"<{word}>"[i:i + 3] for i in range(len(word)))]
+        for feature in features:
+            i, sign = _bucket(feature)
+            vec[i] += sign
+    return _normalise(vec)
+
+
+def _normalise(vec: Sequence[float]) -> array:
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return array("f", (v / norm for v in vec))
+
+
+def _dot(a: array, b: array) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+class SemanticMatch(NamedTuple):
+    instructions: str
+    similarity: float
+    key: str  # cache key of the matched result
+
+    @property
+    def distance(self) -> float:
+        return 1.0 - self.similarity
+
+
+class SemanticIndex:
+    """
+    Persisted index of the instructions each cached stage result was computed
+    for, used to reuse a result when new instructions are near-identical.
+
+    Entries are partitioned by everything else the result depends on (stage and
+    prompt version, model, upstream content hash, any other prompt context such
+    as conversation history, embedder), so a lookup only compares the user's
+    instruction against the handful given for exactly the same input; the
+    partition is the approximate-neighbour step and the scan within it is exact.
+    Instructions whose numbers or negations differ never match.
+    New entries are embedded in batches (when SEMANTIC_BATCH_SIZE are pending,
+    or together with the next lookup). The index is an append-only JSONL file
+    loaded at startup.
+    """
+
+    def __init__(self, path: Path = INDEX_PATH, threshold: float = SEMANTIC_THRESHOLD,
+                 embed_model: str = SEMANTIC_EMBED_MODEL, batch_size: int = SEMANTIC_BATCH_SIZE):
+        self.path = path
+        self.threshold = threshold
+        self.embed_model = embed_model
+        self.batch_size = batch_size
+        self.embedder = f"ollama:{embed_model}" if embed_model else f"ngram{NGRAM_DIM}"
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._partitions: Dict[str, Dict[str, Tuple[array, str]]] = {}  # partition -> instructions -> (vector, key)
+        self._pending: List[Tuple[str, str, str]] = []
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open(encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        rec = json.loads(line)
+                        if rec["embedder"] != self.embedder:
+                            continue
+                        vec = array("f")
+                        vec.frombytes(base64.b64decode(rec["vector"]))
+                        self._partitions.setdefault(rec["partition"], {})[rec["instructions"]] = (vec, rec["key"])
+                    except (ValueError, KeyError):
+                        continue
+        except Exception:
+            logger.exception("Semantic index load failed")
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.threshold <= 1
+
+    def partition(self, stage: str, model: str, upstream_hash: str, context: str = "") -> str:
+        context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()[:16] if context else ""
+        return "|".join([stage or "", model or "", upstream_hash or "", context_hash, self.embedder])
+
+    # ---------------- embedding ----------------
+
+    def embed(self, texts: List[str]) -> List[array]:
+        if not texts:
+            return []
+        if not self.embed_model:
+            return [ngram_embedding(t) for t in texts]
+        from llm import embed_ollama
+        return [_normalise(v) for v in embed_ollama(texts, self.embed_model)]
+
+    # ---------------- updates ----------------
+
+    def add(self, partition: str, instructions: str, key: str):
+        """Queue the instructions the result cached under `key` was computed for; embedded with the next batch."""
+        if not self.enabled or not instructions.strip():
+            return
+        with self._lock:
+            if instructions in self._partitions.get(partition, {}):
+                return
+            self._pending.append((partition, instructions, key))
+            due = len(self._pending) >= self.batch_size
+        if due:
+            self.flush()
+
+    def flush(self, extra: Sequence[str] = ()) -> List[array]:
+        """Embed pending entries (plus `extra` texts, whose vectors are returned) in one batch."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending and not extra:
+                return []
+            try:
+                vectors = self.embed(list(extra) + [text for _, text, _ in pending])
+            except Exception:
+                logger.exception("Semantic embedding failed; %d pending entries dropped", len(pending))
+                return []
+            query_vectors, new_vectors = vectors[:len(extra)], vectors[len(extra):]
+            lines = []
+            with self._lock:
+                for (partition, text, key), vec in zip(pending, new_vectors):
+                    self._partitions.setdefault(partition, {})[text] = (vec, key)
+                    lines.append(json.dumps({"partition": partition, "embedder": self.embedder, "instructions": text,
+                                             "key": key, "vector": base64.b64encode(vec.tobytes()).decode("ascii")},
+                                            ensure_ascii=False))
+            if lines:
+                try:
+                    with self.path.open("a", encoding="utf-8") as fp:
+                        fp.write("\n".join(lines) + "\n")
+                except Exception:
+                    logger.exception("Semantic index write failed")
+            return query_vectors
+
+    # ---------------- lookup ----------------
+
+    def find(self, partition: str, instructions: str,
+             threshold: Optional[float] = None) -> Optional[SemanticMatch]:
+        """The most similar indexed instructions in the partition, if at least `threshold` similar."""
+        limit = self.threshold if threshold is None else threshold
+        if not 0 < limit <= 1 or not instructions.strip():
+            return None
+        with self._lock:
+            has_pending = any(p == partition for p, _, _ in self._pending)
+            candidates = dict(self._partitions.get(partition, {}))
+        if not candidates and not has_pending:
+            return None
+        vectors = self.flush([instructions])
+        if not vectors:
+            return None
+        if has_pending:
+            with self._lock:
+                candidates = dict(self._partitions.get(partition, {}))
+        query, guard = vectors[0], _guard(instructions)
+        best = None
+        for text, (vec, key) in candidates.items():
+            if text == instructions or _guard(text) != guard:
+                continue
+            sim = _dot(query, vec)
+            if sim >= limit and (best is None or sim > best.similarity):
+                best = SemanticMatch(text, sim, key)
+        return best
+
+
+semantic_index = SemanticIndex()
+atexit.register(semantic_index.flush)
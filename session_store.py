@@ -0,0 +1,408 @@
+# session_store.py
+import ast
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from config import OUTPUT_DIR, DB_DIR
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_CLOSE = object()
+
+INDEX_PATH = DB_DIR / "sessions.sqlite3"
+
+# stream order of a finished session's outputs
+REPLAY_PHASES = ("vision_think", "vision", "coder_think", "coder_patch", "coder", "explain_think", "explain")
+
+
+def journal_path(session_id: str) -> Path:
+    return OUTPUT_DIR / f"session_{session_id}.jsonl"
+
+
+def snapshot_path(session_id: str) -> Path:
+    return OUTPUT_DIR / f"session_{session_id}.json"
+
+
+def _new_view(session_id: str) -> Dict[str, Any]:
+    return {"session_id": session_id, "status": "running", "created": None, "meta": {}, "outputs": {}}
+
+
+def apply_record(view: Dict[str, Any], rec: Dict[str, Any]):
+    """
+    Fold one journal record into a session view. Streamed chunks are collected
+    per phase and only joined into the outputs by finish_view().
+    """
+    kind = rec.get("type")
+    if kind == "chunk":
+        pending = view.setdefault("_chunks", {})
+        if rec["phase"] not in pending:
+            pending[rec["phase"]] = [view["outputs"].get(rec["phase"], "")]
+        pending[rec["phase"]].append(rec.get("text", ""))
+    elif kind == "final":
+        # node completion carries the authoritative full text
+        view.get("_chunks", {}).pop(rec["phase"], None)
+        view["outputs"][rec["phase"]] = rec.get("text", "")
+    elif kind == "meta":
+        view["meta"].update(rec.get("data", {}))
+        if view["created"] is None:
+            view["created"] = rec.get("ts")
+    elif kind == "metrics":
+        if rec.get("key"):
+            view.setdefault("metrics", {})[rec["key"]] = rec.get("data", {})
+        else:
+            view["metrics"] = rec.get("data", {})
+    elif kind == "resume":
+        # a reopened session starts its new journal from the previous snapshot
+        view.update(rec.get("view", {}))
+    elif kind == "status":
+        view["status"] = rec.get("status")
+        if rec.get("error"):
+            view["error"] = rec["error"]
+
+
+def finish_view(view: Dict[str, Any]) -> Dict[str, Any]:
+    """Join the chunks collected by apply_record into the view's outputs."""
+    for phase, parts in view.pop("_chunks", {}).items():
+        view["outputs"][phase] = "".join(parts)
+    return view
+
+
+class SessionJournal:
+    """
+    Append-only JSONL log for one session.
+
+    Records are queued by the streaming loop and written by a background thread
+    in batches (adjacent chunks of the same phase are coalesced into one line),
+    so the hot path never touches the disk. close() writes a compact snapshot
+    (session_<id>.json) and removes the journal.
+
+    With resume=True a finished session is reopened to append to it (e.g. a
+    later explanation): the new journal starts from the previous view.
+    """
+
+    def __init__(self, session_id: str, flush_interval: float = 0.25, batch_size: int = 512,
+                 resume: bool = False):
+        self.session_id = session_id
+        self.path = journal_path(session_id)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.view = _new_view(session_id)
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._closed = False
+        previous = load_session(session_id) if resume else None
+        self._thread = threading.Thread(target=self._run, name=f"journal-{session_id[:8]}", daemon=True)
+        self._thread.start()
+        if previous:
+            self._put({"type": "resume", "view": previous})
+
+    # ---------------- producer side ----------------
+
+    def _put(self, rec: Dict[str, Any]):
+        if self._closed:
+            return
+        rec.setdefault("ts", time.time())
+        apply_record(self.view, rec)
+        self._queue.put(rec)
+
+    def meta(self, **data):
+        self._put({"type": "meta", "data": data})
+
+    def chunk(self, phase: str, text: str):
+        self._put({"type": "chunk", "phase": phase, "text": text})
+
+    def final(self, phase: str, text: str):
+        self._put({"type": "final", "phase": phase, "text": text})
+
+    def metrics(self, data: Dict[str, Any], key: Optional[str] = None):
+        rec = {"type": "metrics", "data": data}
+        if key:
+            rec["key"] = key
+        self._put(rec)
+
+    def close(self, status: str = "done", error: Optional[str] = None):
+        """Flush pending records, write the snapshot and drop the journal."""
+        if self._closed:
+            return
+        rec = {"type": "status", "status": status}
+        if error:
+            rec["error"] = error
+        self._put(rec)
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        try:
+            write_snapshot(finish_view(self.view))
+            self.path.unlink(missing_ok=True)
+        except Exception:
+            logger.exception("Session snapshot failed for %s", self.session_id)
+
+    # ---------------- writer thread ----------------
+
+    def _run(self):
+        done = False
+        with self.path.open("a", encoding="utf-8") as fp:
+            while not done:
+                batch = []
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                while True:
+                    if item is _CLOSE:
+                        done = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    try:
+                        fp.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in _coalesce(batch)))
+                        fp.flush()
+                    except Exception:
+                        logger.exception("Session journal write failed for %s", self.session_id)
+
+
+def _coalesce(batch):
+    out = []
+    for rec in batch:
+        prev = out[-1] if out else None
+        if prev and rec["type"] == "chunk" and prev["type"] == "chunk" and prev["phase"] == rec["phase"]:
+            prev["text"] += rec["text"]
+        else:
+            out.append(dict(rec))
+    return out
+
+
+def write_snapshot(view: Dict[str, Any]):
+    """Atomically write the compact session snapshot."""
+    fp = snapshot_path(view["session_id"])
+    tmp = fp.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(view, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, fp)
+    try:
+        session_index.add(view)
+    except Exception:
+        logger.exception("Session index update failed for %s", view["session_id"])
+
+
+def load_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Rebuild the current view of a session: replay the journal if the run is
+    still in progress (or was interrupted), otherwise read the snapshot.
+    """
+    jp = journal_path(session_id)
+    if jp.exists():
+        view = _new_view(session_id)
+        with jp.open(encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    apply_record(view, json.loads(line))
+                except json.JSONDecodeError:
+                    # torn last line from a crash mid-write
+                    logger.warning("Skipping corrupt journal line in %s", jp)
+        return finish_view(view)
+    sp = snapshot_path(session_id)
+    if sp.exists():
+        try:
+            return _normalise_snapshot(json.loads(sp.read_text(encoding="utf-8")), session_id, sp)
+        except Exception:
+            logger.exception("Session snapshot read failed for %s", session_id)
+    return None
+
+
+# text of a stringified ollama ChatResponse inside a legacy "_partial" message
+_LEGACY_TEXT = re.compile(r"message=Message\(role='assistant', content=('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")")
+
+
+def _legacy_text(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    raw = "".join(str(m.get("content", "")) for m in value or [] if isinstance(m, dict))
+    parts = []
+    for literal in _LEGACY_TEXT.findall(raw):
+        try:
+            parts.append(ast.literal_eval(literal))
+        except (ValueError, SyntaxError):
+            continue
+    return "".join(parts) if parts else raw
+
+
+def _normalise_snapshot(data: Dict[str, Any], session_id: str, path: Path) -> Dict[str, Any]:
+    """
+    A snapshot as a session view. Snapshots written before the journal existed
+    hold only "<phase>_partial" message lists (the tail of each stream); they
+    become a view with status "partial", dated by the file's modification time.
+    """
+    if "outputs" in data and "session_id" in data:
+        return data
+    view = _new_view(session_id)
+    view["status"] = "partial"
+    view["created"] = path.stat().st_mtime
+    view["meta"]["legacy_status"] = data.get("status")
+    for name, value in data.items():
+        if name.endswith("_partial"):
+            text = _legacy_text(value)
+            if text:
+                view["outputs"][name[:-len("_partial")]] = text
+    return view
+
+
+def replay_session(session_id: str) -> Generator[Tuple[str, str, str], None, None]:
+    """
+    Stream a stored session as (phase, chunk, session_id), like invoke_stream,
+    straight from its outputs: no model is called.
+    """
+    view = load_session(session_id)
+    outputs = (view or {}).get("outputs")
+    if not isinstance(outputs, dict):
+        yield ("error", f"Unknown session {session_id}" if not view else f"Session {session_id} has no outputs",
+               session_id)
+        return
+    for phase in REPLAY_PHASES:
+        if outputs.get(phase):
+            yield (phase, outputs[phase], session_id)
+    if view.get("status") == "error":
+        yield ("error", view.get("error") or "the original run failed", session_id)
+        return
+    yield ("done", "completed", session_id)
+
+
+class SessionIndex:
+    """
+    SQLite index of finished sessions (one row per snapshot) for finding past
+    results by design, instructions, date or model. The snapshots stay the
+    source of truth; the index is filled when a snapshot is written, and on
+    first use from the snapshots already in OUTPUT_DIR.
+    """
+
+    def __init__(self, path: Path = INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        if not self._ready:
+            # other threads wait here until the tables exist; a failed init is retried next time
+            with self._lock:
+                if not self._ready:
+                    try:
+                        self._init(conn)
+                    except BaseException:
+                        conn.close()
+                        raise
+                    self._ready = True
+        return conn
+
+    def _init(self, conn: sqlite3.Connection):
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id      TEXT PRIMARY KEY,
+                    created         REAL,
+                    updated         REAL NOT NULL,
+                    status          TEXT NOT NULL DEFAULT '',
+                    prompt          TEXT NOT NULL DEFAULT '',
+                    image_hash      TEXT NOT NULL DEFAULT '',
+                    conversation_id TEXT NOT NULL DEFAULT '',
+                    refine_from     TEXT NOT NULL DEFAULT '',
+                    models          TEXT NOT NULL DEFAULT '{}',
+                    has_explain     INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS sessions_image ON sessions (image_hash, created);
+                CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """)
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'backfilled'").fetchone():
+            return
+        count = 0
+        for fp in OUTPUT_DIR.glob("session_*.json"):
+            try:
+                session_id = fp.stem[len("session_"):]
+                self._upsert(conn, _normalise_snapshot(json.loads(fp.read_text(encoding="utf-8")), session_id, fp))
+                count += 1
+            except Exception:
+                logger.warning("Skipping unreadable session snapshot %s", fp.name)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', ?)", (str(time.time()),))
+        if count:
+            logger.info("Indexed %d existing sessions", count)
+
+    @staticmethod
+    def _upsert(conn: sqlite3.Connection, view: Dict[str, Any]):
+        meta = view.get("meta") or {}
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, created, updated, status, prompt, image_hash, "
+                "conversation_id, refine_from, models, has_explain) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (view["session_id"], view.get("created"), time.time(), view.get("status") or "",
+                 meta.get("prompt") or "", meta.get("image_hash") or "", meta.get("conversation_id") or "",
+                 meta.get("refine_from") or "", json.dumps(meta.get("models") or {}),
+                 int(bool(view.get("outputs", {}).get("explain")))))
+
+    def add(self, view: Dict[str, Any]):
+        conn = self._connect()
+        try:
+            self._upsert(conn, view)
+        finally:
+            conn.close()
+
+    def find(self, image_hash: Optional[str] = None, prompt: Optional[str] = None, since: Optional[float] = None,
+             until: Optional[float] = None, model: Optional[str] = None, status: Optional[str] = "done",
+             limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Past sessions, newest first. `prompt` matches a substring of the
+        instructions (case-insensitive), `model` any stage's model, and
+        since/until are epoch seconds.
+        """
+        where, args = [], []
+        if image_hash:
+            where.append("image_hash = ?")
+            args.append(image_hash)
+        if prompt:
+            where.append("prompt LIKE ? ESCAPE '\\'")
+            args.append("%" + prompt.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if since is not None:
+            where.append("created >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("created < ?")
+            args.append(until)
+        if model:
+            where.append("EXISTS (SELECT 1 FROM json_each(models) WHERE value = ?)")
+            args.append(model)
+        if status:
+            where.append("status = ?")
+            args.append(status)
+        sql = "SELECT * FROM sessions" + (" WHERE " + " AND ".join(where) if where else "")
+        sql += " ORDER BY created DESC LIMIT ?"
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, args + [limit]).fetchall()
+        finally:
+            conn.close()
+        out = []
+        for row in rows:
+            rec = dict(row)
+            rec["models"] = json.loads(rec["models"] or "{}")
+            rec["has_explain"] = bool(rec["has_explain"])
+            out.append(rec)
+        return out
+
+
+session_index = SessionIndex()
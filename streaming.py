@@ -0,0 +1,26 @@
+# streaming.py
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# LangGraph's custom stream mode lets nodes push data out while they are still running.
+try:
+    from langgraph.config import get_stream_writer
+except Exception:
+    get_stream_writer = None
+
+
+def emit(phase: str, chunk: str):
+    """
+    Push a (phase, chunk) pair onto the running graph's "custom" stream.
+    No-op when called outside a graph run (e.g. an agent invoked directly).
+    """
+    if not chunk or get_stream_writer is None:
+        return
+    try:
+        writer = get_stream_writer()
+    except Exception:
+        # not inside a LangGraph runnable context
+        return
+    writer((phase, chunk))
@@ -0,0 +1,80 @@
+# tests/test_cache_store.py
+import os
+
+import pytest
+
+import cache_store
+from cache_store import CacheStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_store.time, "time", clock)
+    return clock
+
+
+def _blob(n=1000):
+    # incompressible, so stored sizes are predictable
+    return os.urandom(n).hex()
+
+
+def test_round_trip_and_metadata(tmp_path):
+    store = CacheStore(tmp_path / "cache.sqlite3", max_bytes=0, ttl=0)
+    store.set("k1", "value", {"stage": "coder", "model": "m"})
+    assert store.get("k1") == "value"
+    assert store.get("missing") is None
+    assert store.inspect("k1")["stage"] == "coder"
+    assert store.stats()["by_stage"] == {"coder": {"entries": 1, "bytes": store.inspect("k1")["size"]}}
+
+
+def test_expired_entries_are_dropped(tmp_path, clock):
+    store = CacheStore(tmp_path / "cache.sqlite3", max_bytes=0, ttl=60)
+    store.set("old", "a")
+    clock.now += 30
+    store.set("new", "b")
+    clock.now += 40
+    assert store.get("old") is None
+    assert store.get("new") == "b"
+    store.set("old", "a")
+    clock.now += 61
+    assert store.evict() == 2
+    assert store.stats()["entries"] == 0
+
+
+def test_eviction_drops_least_recently_used_first(tmp_path, clock):
+    store = CacheStore(tmp_path / "cache.sqlite3", max_bytes=0, ttl=0)
+    for i in range(5):
+        store.set(f"k{i}", _blob())
+        clock.now += 1
+    clock.now += cache_store.TOUCH_INTERVAL + 1
+    assert store.get("k0")  # refreshes k0's LRU time
+    size = store.inspect("k1")["size"]
+    store.max_bytes = size * 4
+    # over the limit by one entry: shrink to 90%, i.e. drop the two oldest unread entries
+    assert store.evict() == 2
+    assert sorted(e["key"] for e in store.list()) == ["k0", "k3", "k4"]
+
+
+def test_writes_trigger_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_store, "EVICT_EVERY", 4)
+    store = CacheStore(tmp_path / "cache.sqlite3", max_bytes=1, ttl=0)
+    store.set_many([(f"k{i}", _blob(100), {}) for i in range(3)])
+    assert store.stats()["entries"] == 3
+    store.set("k3", _blob(100))
+    assert store.stats()["entries"] == 0
+
+
+def test_clear(tmp_path):
+    store = CacheStore(tmp_path / "cache.sqlite3", max_bytes=0, ttl=0)
+    store.set_many([("a", "1", {}), ("b", "2", {})])
+    store.clear()
+    assert store.stats()["entries"] == 0
@@ -0,0 +1,64 @@
+# tests/test_image_index.py
+import io
+
+from PIL import Image, ImageDraw, ImageOps
+
+from image_index import PerceptualIndex
+from preprocess import preprocess_image
+
+
+def _screen(title, first, second, margin=40):
+    im = Image.new("RGB", (800, 600), "white")
+    d = ImageDraw.Draw(im)
+    d.rectangle([margin, margin, 800 - margin, margin + 60], fill=(30, 60, 120))
+    d.text((margin + 20, margin + 20), title, fill="white")
+    for i, label in enumerate([first, second]):
+        d.text((200, 150 + i * 80), label, fill="black")
+        d.rectangle([200, 170 + i * 80, 600, 200 + i * 80], outline="gray")
+    d.rectangle([200, 330, 320, 370], fill=(0, 120, 0))
+    d.text((230, 345), "Submit", fill="white")
+    return im
+
+
+def _encode(im, fmt="PNG", **kwargs):
+    out = io.BytesIO()
+    im.save(out, format=fmt, **kwargs)
+    return out.getvalue()
+
+
+def _index(tmp_path, *images):
+    index = PerceptualIndex(path=tmp_path / "index.jsonl", thumb_dir=tmp_path / "thumbs")
+    for p in images:
+        index.add(p.phash, p.sha256, p.thumb)
+    return index
+
+
+def test_different_crop_margin_and_resave_are_reused(tmp_path):
+    base = _screen("Login", "Email", "Password")
+    original = preprocess_image(_encode(base))
+    index = _index(tmp_path, original)
+    variants = [
+        base.crop((8, 8, 792, 592)),
+        base.crop((20, 20, 780, 580)),
+        ImageOps.expand(base, 20, "white"),
+    ]
+    for variant in variants:
+        p = preprocess_image(_encode(variant))
+        found = index.find(p.phash, p.thumb)
+        assert found and found[0] == original.sha256
+    resaved = preprocess_image(_encode(base, "JPEG", quality=85))
+    found = index.find(resaved.phash, resaved.thumb)
+    assert found and found[0] == original.sha256
+
+
+def test_same_layout_with_other_labels_is_not_reused(tmp_path):
+    original = preprocess_image(_encode(_screen("Login", "Email", "Password")))
+    other = preprocess_image(_encode(_screen("Admin sign in", "Username", "Secret code")))
+    index = _index(tmp_path, original)
+    assert index.find(other.phash, other.thumb) is None
+
+
+def test_no_thumbnail_no_match(tmp_path):
+    original = preprocess_image(_encode(_screen("Login", "Email", "Password")))
+    index = _index(tmp_path, original)
+    assert index.find(original.phash, None) is None
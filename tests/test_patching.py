@@ -0,0 +1,60 @@
+# tests/test_patching.py
+import pytest
+
+from patching import Edit, PatchError, apply_edits, parse_edits
+
+CODE = """```python
+def login(page):
+    page.fill("#user", "alice")
+    page.click("#submit")
+
+
+def logout(page):
+    page.click("#submit")
+```
+"""
+
+
+def _block(search, replace):
+    return f"<<<<<<< SEARCH\n{search}=======\n{replace}>>>>>>> REPLACE\n"
+
+
+def test_parse_edits_reads_every_block():
+    text = "Here you go:\n" + _block("a\n", "b\n") + "and\n" + _block("c\n", "d\n")
+    assert parse_edits(text) == [Edit("a\n", "b\n"), Edit("c\n", "d\n")]
+
+
+def test_parse_edits_without_blocks_fails():
+    with pytest.raises(PatchError, match="no SEARCH/REPLACE"):
+        parse_edits("I rewrote the whole file for you.")
+
+
+def test_unique_search_is_replaced():
+    edits = parse_edits(_block('    page.fill("#user", "alice")\n', '    page.fill("#user", "bob")\n'))
+    assert 'page.fill("#user", "bob")' in apply_edits(CODE, edits)
+
+
+def test_trailing_whitespace_is_tolerated():
+    edits = [Edit('    page.fill("#user", "alice")   \n', '    page.fill("#user", "bob")\n')]
+    assert 'page.fill("#user", "bob")' in apply_edits(CODE, edits)
+
+
+def test_ambiguous_search_is_rejected():
+    with pytest.raises(PatchError, match="occurs 2 times"):
+        apply_edits(CODE, [Edit('    page.click("#submit")\n', '    page.click("#go")\n')])
+
+
+def test_missing_search_is_rejected():
+    with pytest.raises(PatchError, match="not found"):
+        apply_edits(CODE, [Edit("def register(page):\n", "def signup(page):\n")])
+
+
+def test_edit_that_breaks_the_code_is_rejected():
+    with pytest.raises(PatchError, match="no longer parses"):
+        apply_edits(CODE, [Edit("def logout(page):\n", "def logout(page:\n")])
+
+
+def test_failed_edit_leaves_no_partial_result():
+    edits = [Edit('"alice"', '"bob"'), Edit("missing\n", "x\n")]
+    with pytest.raises(PatchError):
+        apply_edits(CODE, edits)
@@ -0,0 +1,37 @@
+# tests/test_preprocess.py
+import io
+
+import pytest
+from PIL import Image
+
+from preprocess import needs_tiling, tile_image
+
+
+def _page(width, height):
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(out, format="PNG")
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("width", [1024, 1280, 1440, 1536])
+def test_page_up_to_one_and_a_half_tiles_wide_is_one_column(width):
+    tiles = tile_image(_page(width, 5000), tile_size=1024, overlap=128, max_width=2048)
+    assert {tuple(t["box"][::2]) for t in tiles} == {(0, 1024)}
+
+
+def test_desktop_page_is_scaled_to_one_column():
+    tiles = tile_image(_page(1440, 5000), tile_size=1024, overlap=128, max_width=2048)
+    # 1440x5000 -> 1024x3556: four rows of one tile
+    assert len(tiles) == 4
+
+
+def test_wide_page_is_cut_into_overlapping_columns():
+    tiles = tile_image(_page(2048, 1024), tile_size=1024, overlap=128, max_width=2048)
+    lefts = sorted(t["box"][0] for t in tiles)
+    assert len(lefts) == 3
+    assert all(b - a <= 1024 - 128 for a, b in zip(lefts, lefts[1:]))
+
+
+def test_small_page_is_not_tiled():
+    assert not needs_tiling(_page(1280, 1400), tile_size=1024)
+    assert needs_tiling(_page(1440, 5000), tile_size=1024)
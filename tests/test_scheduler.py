@@ -0,0 +1,94 @@
+# tests/test_scheduler.py
+import threading
+import time
+
+import pytest
+
+from scheduler import BATCH, INTERACTIVE, LLMScheduler, SchedulerOverloaded, parse_limits, priority
+
+
+def _waiter(sched, model, level, order, started):
+    def run():
+        with priority(level):
+            started.release()
+            with sched.slot(model):
+                order.append(level)
+    t = threading.Thread(target=run)
+    t.start()
+    started.acquire()
+    return t
+
+
+def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_parse_limits_keeps_tags():
+    assert parse_limits("llava:13b=2, qwen2.5-coder:7b=1,bad,x=y") == {"llava:13b": 2, "qwen2.5-coder:7b": 1}
+
+
+def test_interactive_calls_run_before_waiting_batch_calls():
+    sched = LLMScheduler(default_limit=1, max_queue=0, queue_timeout=0, max_models=0)
+    order, started = [], threading.Semaphore(0)
+    with sched.slot("m"):
+        threads = [_waiter(sched, "m", BATCH, order, started)]
+        _wait_for(lambda: sched.snapshot()["m"]["waiting"] == 1)
+        threads.append(_waiter(sched, "m", INTERACTIVE, order, started))
+        _wait_for(lambda: sched.snapshot()["m"]["waiting"] == 2)
+    for t in threads:
+        t.join(2)
+    assert order == [INTERACTIVE, BATCH]
+    assert sched.snapshot()["m"] == {"limit": 1, "active": 0, "waiting": 0}
+
+
+def test_full_queue_rejects_immediately():
+    sched = LLMScheduler(default_limit=1, max_queue=1, queue_timeout=0, max_models=0)
+    order, started = [], threading.Semaphore(0)
+    with sched.slot("m"):
+        t = _waiter(sched, "m", INTERACTIVE, order, started)
+        _wait_for(lambda: sched.snapshot()["m"]["waiting"] == 1)
+        with pytest.raises(SchedulerOverloaded, match="busy"):
+            with sched.slot("m"):
+                pass
+    t.join(2)
+    assert order == [INTERACTIVE]
+
+
+def test_batch_calls_do_not_count_against_interactive_admission():
+    sched = LLMScheduler(default_limit=1, max_queue=1, queue_timeout=0, max_models=0)
+    order, started = [], threading.Semaphore(0)
+    with sched.slot("m"):
+        threads = [_waiter(sched, "m", BATCH, order, started)]
+        _wait_for(lambda: sched.snapshot()["m"]["waiting"] == 1)
+        threads.append(_waiter(sched, "m", INTERACTIVE, order, started))
+        _wait_for(lambda: sched.snapshot()["m"]["waiting"] == 2)
+    for t in threads:
+        t.join(2)
+    assert order == [INTERACTIVE, BATCH]
+
+
+def test_interactive_wait_times_out_and_frees_its_place():
+    sched = LLMScheduler(default_limit=1, max_queue=0, queue_timeout=0.1, max_models=0)
+    with sched.slot("m"):
+        start = time.monotonic()
+        with pytest.raises(SchedulerOverloaded, match="gave up"):
+            with sched.slot("m"):
+                pass
+        assert time.monotonic() - start < 1.0
+        assert sched.snapshot()["m"]["waiting"] == 0
+    with sched.slot("m"):
+        assert sched.snapshot()["m"]["active"] == 1
+
+
+def test_raising_the_limit_admits_waiters():
+    sched = LLMScheduler(default_limit=1, max_queue=0, queue_timeout=0, max_models=0)
+    order, started = [], threading.Semaphore(0)
+    with sched.slot("m"):
+        t = _waiter(sched, "m", INTERACTIVE, order, started)
+        _wait_for(lambda: sched.snapshot()["m"]["waiting"] == 1)
+        sched.set_limit("m", 2)
+        t.join(2)
+        assert order == [INTERACTIVE]
@@ -0,0 +1,87 @@
+# tests/test_session_store.py
+import json
+
+import pytest
+
+import session_store
+from session_store import SessionIndex, SessionJournal, apply_record, finish_view, load_session, replay_session
+
+
+@pytest.fixture(autouse=True)
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(session_store, "OUTPUT_DIR", tmp_path)
+    monkeypatch.setattr(session_store, "session_index", SessionIndex(tmp_path / "sessions.sqlite3"))
+    return tmp_path
+
+
+def _fold(records):
+    view = session_store._new_view("s")
+    for rec in records:
+        apply_record(view, rec)
+    return finish_view(view)
+
+
+def test_chunks_are_joined_and_final_text_wins():
+    view = _fold([
+        {"type": "meta", "data": {"prompt": "login"}, "ts": 1.0},
+        {"type": "chunk", "phase": "vision", "text": "Lo"},
+        {"type": "chunk", "phase": "coder", "text": "def "},
+        {"type": "chunk", "phase": "vision", "text": "gin"},
+        {"type": "final", "phase": "coder", "text": "def test(): pass"},
+        {"type": "status", "status": "done"},
+    ])
+    assert view["outputs"] == {"vision": "Login", "coder": "def test(): pass"}
+    assert view["meta"] == {"prompt": "login"}
+    assert view["created"] == 1.0
+    assert view["status"] == "done"
+    assert "_chunks" not in view
+
+
+def test_chunks_after_resume_extend_the_previous_output():
+    view = _fold([
+        {"type": "resume", "view": {"status": "done", "outputs": {"explain": "Part 1. "}}},
+        {"type": "chunk", "phase": "explain", "text": "Part 2."},
+    ])
+    assert view["outputs"]["explain"] == "Part 1. Part 2."
+
+
+def test_unfinished_journal_is_replayed(output_dir):
+    journal = SessionJournal("abc", flush_interval=0.01)
+    journal.meta(prompt="login")
+    for word in ("one ", "two ", "three"):
+        journal.chunk("coder", word)
+    journal._queue.put(session_store._CLOSE)  # stop the writer without closing, as after a crash
+    journal._thread.join(2)
+    with session_store.journal_path("abc").open("a", encoding="utf-8") as fp:
+        fp.write('{"type": "chunk", "phase": "co')  # torn last line
+    view = load_session("abc")
+    assert view["outputs"]["coder"] == "one two three"
+    assert view["status"] == "running"
+
+
+def test_close_writes_snapshot_and_drops_journal():
+    journal = SessionJournal("abc")
+    journal.chunk("coder", "code")
+    journal.close(status="done")
+    assert not session_store.journal_path("abc").exists()
+    view = load_session("abc")
+    assert view["outputs"] == {"coder": "code"} and view["status"] == "done"
+    assert list(replay_session("abc")) == [("coder", "code", "abc"), ("done", "completed", "abc")]
+
+
+def test_legacy_snapshot_is_normalised():
+    legacy = {
+        "status": "completed",
+        "coder_partial": [{"role": "assistant", "content": "model='m' message=Message(role='assistant', "
+                                                            "content='def test():\\n    pass') done=True"}],
+        "vision_partial": "## Login screen",
+    }
+    session_store.snapshot_path("old").write_text(json.dumps(legacy), encoding="utf-8")
+    view = load_session("old")
+    assert view["status"] == "partial"
+    assert view["meta"]["legacy_status"] == "completed"
+    assert view["outputs"] == {"coder": "def test():\n    pass", "vision": "## Login screen"}
+
+
+def test_unknown_session_replays_an_error():
+    assert list(replay_session("missing")) == [("error", "Unknown session missing", "missing")]
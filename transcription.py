@@ -1,34 +1,286 @@
 # transcription.py
+import importlib.util
+import io
 import logging
+import subprocess
+import threading
+import time
+import wave
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Generator, Optional, Tuple
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-try:
-    from faster_whisper import WhisperModel
-    HAS_FAST = True
-except Exception:
-    HAS_FAST = False
+# Whisper backends pull in torch / ctranslate2: only check they exist here and
+# import them when a model is first loaded.
+HAS_FAST = importlib.util.find_spec("faster_whisper") is not None
+HAS_WHISPER = importlib.util.find_spec("whisper") is not None
+
+from metrics import metrics
+from config import (
+    WHISPER_MODEL,
+    WHISPER_BACKEND,
+    WHISPER_DEVICE,
+    WHISPER_COMPUTE_TYPE,
+    WHISPER_NUM_WORKERS,
+    WHISPER_IDLE_SECONDS,
+)
+
+ModelKey = Tuple[str, str, str]  # (backend, model size, compute type)
+
+SAMPLE_RATE = 16000  # both backends expect 16 kHz mono float32
+WINDOW_SECONDS = 30  # openai-whisper decodes in 30s windows anyway
+
+
+def _resolve_backend(backend: Optional[str]) -> str:
+    backend = backend or WHISPER_BACKEND
+    if backend == "auto":
+        if HAS_FAST:
+            return "faster"
+        if HAS_WHISPER:
+            return "whisper"
+        raise RuntimeError("Install faster-whisper or whisper for local transcription")
+    if backend == "faster" and not HAS_FAST:
+        raise RuntimeError("WHISPER_BACKEND=faster but faster-whisper is not installed")
+    if backend == "whisper" and not HAS_WHISPER:
+        raise RuntimeError("WHISPER_BACKEND=whisper but whisper is not installed")
+    return backend
+
+
+class _Entry:
+    def __init__(self, key: ModelKey):
+        self.key = key
+        self.model = None
+        self.load_lock = threading.Lock()
+        # openai-whisper models are not safe to call from several threads at once;
+        # faster-whisper handles concurrency itself (num_workers).
+        self.use_lock = threading.Lock() if key[0] == "whisper" else None
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class WhisperModelRegistry:
+    """
+    Process-wide registry of loaded Whisper models.
+
+    Each (backend, model size, compute type) is loaded once and shared by every
+    session; entries that have been idle for longer than `idle_seconds` are
+    dropped by a background reaper so the memory is returned.
+    """
+
+    def __init__(self, idle_seconds: float = WHISPER_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[ModelKey, _Entry] = {}
+        self._reaper: Optional[threading.Thread] = None
+
+    def key(self, backend: Optional[str] = None, size: Optional[str] = None,
+            compute_type: Optional[str] = None) -> ModelKey:
+        return (_resolve_backend(backend), size or WHISPER_MODEL, compute_type or WHISPER_COMPUTE_TYPE)
+
+    def _load(self, key: ModelKey):
+        backend, size, compute_type = key
+        logger.info("Loading whisper model backend=%s size=%s compute_type=%s", backend, size, compute_type)
+        start = time.time()
+        if backend == "faster":
+            from faster_whisper import WhisperModel
+            model = WhisperModel(size, device=WHISPER_DEVICE, compute_type=compute_type,
+                                 num_workers=WHISPER_NUM_WORKERS)
+        else:
+            import whisper
+            model = whisper.load_model(size, device=WHISPER_DEVICE)
+        logger.info("Whisper model loaded (%.2fs)", time.time() - start)
+        return model
+
+    @contextmanager
+    def acquire(self, backend: Optional[str] = None, size: Optional[str] = None,
+                compute_type: Optional[str] = None):
+        """
+        Yield a loaded model for exclusive-or-shared use (depending on backend).
+        The entry cannot be evicted while it is held.
+        """
+        key = self.key(backend, size, compute_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(key)
+            entry.in_use += 1
+
+        try:
+            # only one thread loads a given key; others wait for it
+            with entry.load_lock:
+                if entry.model is None:
+                    entry.model = self._load(key)
+            self._ensure_reaper()
+            with entry.use_lock or nullcontext():
+                yield entry.model
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+                if entry.model is None and entry.in_use == 0:
+                    # load failed; don't keep an empty entry around
+                    self._entries.pop(key, None)
+
+    def warmup(self, backend: Optional[str] = None, size: Optional[str] = None,
+               compute_type: Optional[str] = None, background: bool = False):
+        """
+        Load a model ahead of the first request. With background=True the load
+        runs in a daemon thread and this returns immediately.
+        """
+        def _run():
+            try:
+                with self.acquire(backend, size, compute_type):
+                    pass
+            except Exception:
+                logger.exception("Whisper warm-up failed")
+
+        if background:
+            threading.Thread(target=_run, name="whisper-warmup", daemon=True).start()
+        else:
+            _run()
+
+    def evict_idle(self) -> int:
+        """Drop models idle for longer than idle_seconds. Returns the number evicted."""
+        if self.idle_seconds <= 0:
+            return 0
+        now = time.monotonic()
+        evicted = 0
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.in_use == 0 and entry.model is not None and now - entry.last_used > self.idle_seconds:
+                    del self._entries[key]
+                    evicted += 1
+                    logger.info("Evicted idle whisper model %s", key)
+        return evicted
+
+    def loaded(self):
+        with self._lock:
+            return [k for k, e in self._entries.items() if e.model is not None]
+
+    def _ensure_reaper(self):
+        if self.idle_seconds <= 0 or self._reaper is not None:
+            return
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_loop, name="whisper-reaper", daemon=True)
+            self._reaper.start()
 
-try:
-    import whisper
-    HAS_WHISPER = True
-except Exception:
-    HAS_WHISPER = False
+    def _reap_loop(self):
+        interval = max(1.0, min(60.0, self.idle_seconds / 4))
+        while True:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception("Whisper reaper failed")
+
+
+registry = WhisperModelRegistry()
+_warmup_started = False
+
+
+def warmup(background: bool = True):
+    """
+    Load the configured Whisper model at process start. Safe to call on every
+    Streamlit rerun: only the first call per process does anything.
+    """
+    global _warmup_started
+    if _warmup_started:
+        return
+    _warmup_started = True
+    registry.warmup(background=background)
 
-from config import WHISPER_MODEL
 
 def transcribe_local(path: str) -> str:
     """
     Transcribe using faster-whisper or whisper. Returns text.
+    The model comes from the process-wide registry and stays warm between calls.
     """
     logger.info("Transcribing: %s", path)
-    if HAS_FAST:
-        model = WhisperModel(WHISPER_MODEL, device="cpu")
-        segments, _ = model.transcribe(path)
-        return " ".join([s.text for s in segments])
-    elif HAS_WHISPER:
-        model = whisper.load_model(WHISPER_MODEL)
+    backend, size, compute_type = registry.key()
+    with metrics.timer("jarvis_transcription_seconds", step="transcribe", backend=backend), \
+            registry.acquire(backend, size, compute_type) as model:
+        if backend == "faster":
+            segments, _ = model.transcribe(path)
+            # segments is lazy: decode while the model is held
+            return " ".join([s.text for s in segments])
         r = model.transcribe(path)
         return r.get("text", "")
-    else:
-        raise RuntimeError("Install faster-whisper or whisper for local transcription")
+
+
+def _decode_wav(audio_bytes: bytes):
+    """Fast path for 16-bit PCM WAV already at 16 kHz (stdlib + numpy only)."""
+    import numpy as np
+    with wave.open(io.BytesIO(audio_bytes)) as wf:
+        if wf.getsampwidth() != 2 or wf.getframerate() != SAMPLE_RATE:
+            return None
+        channels = wf.getnchannels()
+        pcm = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+    if channels > 1:
+        pcm = pcm.reshape(-1, channels).mean(axis=1)
+    return pcm.astype(np.float32) / 32768.0
+
+
+def _decode_ffmpeg(audio_bytes: bytes):
+    """Decode any container ffmpeg understands via stdin/stdout pipes (no temp files)."""
+    import numpy as np
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "pipe:1",
+    ]
+    proc = subprocess.run(cmd, input=audio_bytes, capture_output=True, check=True)
+    return np.frombuffer(proc.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def decode_audio_bytes(audio_bytes: bytes):
+    """
+    Decode uploaded WAV/MP3 bytes in memory into a 16 kHz mono float32 buffer.
+    Tries the WAV fast path, then PyAV (bundled with faster-whisper), then an ffmpeg pipe.
+    """
+    try:
+        audio = _decode_wav(audio_bytes)
+        if audio is not None:
+            return audio
+    except (wave.Error, EOFError):
+        pass  # not a plain PCM WAV
+
+    if HAS_FAST:
+        from faster_whisper.audio import decode_audio
+        return decode_audio(io.BytesIO(audio_bytes), sampling_rate=SAMPLE_RATE)
+    return _decode_ffmpeg(audio_bytes)
+
+
+def transcribe_stream(audio_bytes: bytes) -> Generator[str, None, None]:
+    """
+    Transcribe in-memory audio, yielding segment texts as soon as each is decoded.
+    """
+    start = time.perf_counter()
+    audio = decode_audio_bytes(audio_bytes)
+    metrics.observe("jarvis_transcription_seconds", time.perf_counter() - start, step="decode")
+    logger.info("Transcribing %.1fs of in-memory audio", len(audio) / SAMPLE_RATE)
+    backend, size, compute_type = registry.key()
+    start = time.perf_counter()
+    try:
+        with registry.acquire(backend, size, compute_type) as model:
+            if backend == "faster":
+                # faster-whisper yields segments lazily as it decodes
+                segments, _ = model.transcribe(audio)
+                for s in segments:
+                    yield s.text
+                return
+
+            # openai-whisper returns only when done: feed it one window at a time,
+            # carrying the tail of the transcript over as the prompt for continuity
+            window = WINDOW_SECONDS * SAMPLE_RATE
+            previous = ""
+            for i in range(0, len(audio), window):
+                r = model.transcribe(audio[i:i + window], initial_prompt=previous[-200:] or None, fp16=False)
+                text = r.get("text", "")
+                if text:
+                    previous += text
+                    yield text
+    finally:
+        metrics.observe("jarvis_transcription_seconds", time.perf_counter() - start, step="transcribe", backend=backend)
@@ -0,0 +1,80 @@
+# ui_stream.py
+import time
+import logging
+from typing import Callable, Dict, List, Optional
+
+from config import UI_MAX_FPS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class _Panel:
+    def __init__(self, render: Callable[[str], None]):
+        self.render = render
+        self.parts: List[str] = []
+        self.dirty = False
+        self.last_paint = 0.0
+        self.paints = 0
+
+    def text(self) -> str:
+        # fold pending chunks into one string so each join only covers new text once
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def paint(self):
+        self.render(self.text())
+        self.dirty = False
+        self.last_paint = time.monotonic()
+        self.paints += 1
+
+
+class ThrottledRenderer:
+    """
+    Coalesce streamed chunks per phase and repaint each panel at most `max_fps`
+    times a second instead of once per token.
+
+    `renderers` maps a phase to a callable that draws the full accumulated text
+    (e.g. lambda text: placeholder.code(text, language="python")). A stage's
+    panels ("coder_think", "coder", ...) are flushed in full when the stream
+    moves on to another stage and on flush(), so the last frame of every panel
+    shows the complete output.
+    """
+
+    def __init__(self, renderers: Dict[str, Callable[[str], None]], max_fps: float = UI_MAX_FPS):
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.panels = {phase: _Panel(render) for phase, render in renderers.items()}
+        self.stage: Optional[str] = None
+
+    def __contains__(self, phase: str) -> bool:
+        return phase in self.panels
+
+    def push(self, phase: str, chunk: str):
+        panel = self.panels[phase]
+        stage = phase.split("_", 1)[0]
+        if self.stage not in (None, stage):
+            # the previous stage has finished streaming: show it in full
+            for name in self.panels:
+                if name.split("_", 1)[0] == self.stage:
+                    self.flush(name)
+        self.stage = stage
+        if not chunk:
+            return
+        panel.parts.append(chunk)
+        panel.dirty = True
+        if time.monotonic() - panel.last_paint >= self.interval:
+            panel.paint()
+
+    def text(self, phase: str) -> str:
+        return self.panels[phase].text()
+
+    def flush(self, phase: Optional[str] = None):
+        """Paint pending text for one phase, or for every phase."""
+        for name in ([phase] if phase else list(self.panels)):
+            panel = self.panels[name]
+            if panel.dirty:
+                panel.paint()
+
+    def stats(self) -> Dict[str, int]:
+        return {phase: panel.paints for phase, panel in self.panels.items()}
@@ -1,18 +1,121 @@
 # vision_agent.py
-from typing import Dict, Any, List
-from llm import stream_ollama, run_ollama
+import json
+import re
+from typing import Dict, Any, List, Tuple
+from llm_calls import LLMCall, run_calls
 from cache import cache
-from config import VISION_MODEL
+from image_index import image_index
+from config import VISION_MODEL, VISION_TILE_SIZE, VISION_TILE_OVERLAP, VISION_TILE_MAX_WIDTH
+from streaming import emit
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Bump when the prompts below change so cached stage outputs are not reused.
+PROMPT_VERSION = "v2"
+
+TILE_SYSTEM_PROMPT = (
+    "You are a senior UI/UX analyst looking at ONE region of a larger screen. "
+    "List every UI component visible in this region as JSON: "
+    '{"components": [{"type": "button|input|link|text|image|checkbox|select|...", '
+    '"label": "visible text or accessible name", "locator_hint": "id/name/text useful for a locator", '
+    '"center": [x, y]}]}, where center is the approximate pixel position of the component within this region. '
+    "List repeated components (e.g. several product cards) once per occurrence. Output only the JSON."
+)
+
+
+def _parse_components(text: str) -> List[Dict[str, str]] | None:
+    """Pull the component list out of a region reply; None if it is not JSON."""
+    match = re.search(r"\{.*\}|\[.*\]", text or "", re.S)
+    if not match:
+        return None
+    try:
+        obj = json.loads(match.group(0))
+    except ValueError:
+        return None
+    items = obj.get("components", []) if isinstance(obj, dict) else obj
+    return [c for c in items if isinstance(c, dict)] if isinstance(items, list) else None
+
+
+# two sightings in an overlap band closer than this (page pixels) are one component
+SAME_SPOT_PX = 48
+
+
+def _intersection(a: List[int], b: List[int]) -> List[int] | None:
+    box = [max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])]
+    return box if box[0] < box[2] and box[1] < box[3] else None
+
+
+def _page_point(tile: Dict[str, Any], component: Dict[str, Any]) -> Tuple[float, float] | None:
+    """The component's reported centre in page coordinates, if it gave a usable one."""
+    center = component.get("center")
+    try:
+        x, y = float(center[0]), float(center[1])
+    except (TypeError, ValueError, IndexError, KeyError):
+        return None
+    return tile["box"][0] + x, tile["box"][1] + y
+
+
+def _same_component(tiles: List[Dict[str, Any]], prev: Dict[str, Any], tile_index: int,
+                    point: Tuple[float, float] | None) -> bool:
+    """Could `prev` (from an earlier tile) be the same on-screen component seen again in tile `tile_index`?"""
+    band = _intersection(tiles[prev["tile"]]["box"], tiles[tile_index]["box"])
+    if band is None:
+        return False
+    if point is None or prev["point"] is None:
+        # no positions to compare: a match between overlapping regions is taken as the same
+        return True
+    near_band = lambda p: (band[0] - SAME_SPOT_PX <= p[0] <= band[2] + SAME_SPOT_PX
+                           and band[1] - SAME_SPOT_PX <= p[1] <= band[3] + SAME_SPOT_PX)
+    close = abs(point[0] - prev["point"][0]) <= SAME_SPOT_PX and abs(point[1] - prev["point"][1]) <= SAME_SPOT_PX
+    return near_band(point) and near_band(prev["point"]) and close
+
+
+def merge_tile_components(tiles: List[Dict[str, Any]], replies: List[str]) -> str:
+    """
+    Merge per-region component lists into one structured vision output, in
+    reading order. A component is dropped as a duplicate only when an earlier,
+    overlapping region already reported it (at the same spot in the overlap,
+    when both gave positions); repeats within a region or across regions that
+    do not overlap are distinct components.
+    """
+    kept: List[Dict[str, Any]] = []
+    lines, unparsed = [], []
+    for i, (tile, reply) in enumerate(zip(tiles, replies), start=1):
+        components = _parse_components(reply)
+        if components is None:
+            if reply and reply.strip():
+                unparsed.append(f"- Region {i} {tile['box']}: {reply.strip()}")
+            continue
+        for c in components:
+            ctype = str(c.get("type", "element")).strip() or "element"
+            label = " ".join(str(c.get("label", "")).split())
+            key = (ctype.casefold(), label.casefold())
+            point = _page_point(tile, c)
+            # each earlier sighting absorbs at most one repeat per region
+            dup = next((prev for prev in kept if prev["key"] == key and prev["tile"] != i - 1
+                        and i - 1 not in prev["absorbed"] and _same_component(tiles, prev, i - 1, point)), None)
+            if dup is not None:
+                dup["absorbed"].add(i - 1)
+                continue
+            kept.append({"key": key, "tile": i - 1, "point": point, "absorbed": set()})
+            hint = str(c.get("locator_hint", "")).strip()
+            lines.append(f"- **{ctype}** \"{label}\"" + (f" — locator: `{hint}`" if hint else "") + f" (region {i})")
+
+    out = [f"## Components (merged from {len(tiles)} regions, top to bottom)", *(lines or ["- (none found)"])]
+    if unparsed:
+        out += ["", "## Unparsed region notes", *unparsed]
+    return "\n".join(out)
+
+
 def vision_node(state: Dict[str, Any]):
     """
-    1) Create a 'thinking' string (full, synchronous) that contains the model's analysis/chain-of-thought.
-    2) Then produce the final analysis/content (accumulated string).
+    1) Stream a 'thinking' string that contains the model's analysis/chain-of-thought.
+    2) Then stream the final analysis/content (accumulated string).
     3) Return two messages: a single 'vision_think' message, then the 'vision' final message.
+    Tokens are pushed out through the graph's custom stream as they arrive.
+    With user_image_tiles set, regions are analysed concurrently and merged instead.
     """
     messages = state.get("messages", []) or []
     # build a single user prompt joined from incoming user messages
@@ -28,49 +131,88 @@ def vision_node(state: Dict[str, Any]):
     user_prompt = user_prompt or state.get("metadata", {}).get("prompt", "")
 
     img_b64 = state.get("user_image_b64")
+    tiles = state.get("user_image_tiles") or []
+    images = [img_b64] if img_b64 else []
     image_hash = state.get("metadata", {}).get("image_hash")
+    image_phash = state.get("metadata", {}).get("image_phash")
+    image_thumb = state.get("metadata", {}).get("image_thumb")
 
-    # If full cached final exists, return think + final from cache quickly
-    cached = cache.get(image_hash, user_prompt)
-    if cached:
-        thinking = "[cached analysis — showing full analysis]"
+    # refine mode on the same design (or with no new image): the earlier analysis stands
+    refine = state.get("metadata", {}).get("refine") or {}
+    if refine.get("vision") and (not image_hash or image_hash == refine.get("image_hash")):
+        thinking = f"[reusing the analysis of session {refine.get('session_id')}]\n\n{refine.get('vision_think', '')}"
+        emit("vision_think", thinking)
+        emit("vision", refine["vision"])
         return {
             "messages": [
-                {"role": "assistant", "name": "vision_think", "content": str(thinking)},
-                {"role": "assistant", "name": "vision", "content": str(cached)}
+                {"role": "assistant", "name": "vision_think", "content": thinking},
+                {"role": "assistant", "name": "vision", "content": refine["vision"]}
             ]
         }
 
-    # THINK (synchronous): ask the model to "think" / analyze fully and return one block
-    think_prompt = [
-        {"role": "system", "content": "You are a senior UI/UX analyst. Produce a complete internal analysis. Do NOT include final code; this is your private thinking summary."},
-        {"role": "user", "content": f"Instructions / Context:\n{user_prompt}\n\nImage present: {'yes' if img_b64 else 'no'}"}
-    ]
+    def analyse() -> Tuple[str, str]:
+        # THINK: the model's internal analysis. GEN: the final structured output.
+        # GEN does not read THINK's output, so both calls run at once.
+        think_prompt = [
+            {"role": "system", "content": "You are a senior UI/UX analyst. Produce a complete internal analysis. Do NOT include final code; this is your private thinking summary."},
+            {"role": "user", "content": f"Instructions / Context:\n{user_prompt}\n\nImage present: {'yes' if img_b64 else 'no'}", "images": images}
+        ]
+        gen_prompt = [
+            {"role": "system", "content": "You are a senior UI/UX analyst. Now produce the final analysis output (short, actionable items, components, labels, structure)."},
+            {"role": "user", "content": f"Context:\n{user_prompt}\n\nPlease produce final structured output based on your analysis.", "images": images}
+        ]
 
-    # use run_ollama (sync) to get full thinking as one string
-    try:
-        thinking_raw = run_ollama(think_prompt, VISION_MODEL)
-        # run_ollama may return string or dict; ensure string
-        thinking = str(thinking_raw)
-    except Exception as e:
-        logger.exception("Vision thinking sync failed: %s", e)
-        thinking = "[Vision thinking failed]"
-
-    # GEN (streamed): Now produce the final analysis/result (we will accumulate to return)
-    gen_prompt = [
-        {"role": "system", "content": "You are a senior UI/UX analyst. Now produce the final analysis output (short, actionable items, components, labels, structure)."},
-        {"role": "user", "content": f"Context:\n{user_prompt}\n\nPlease produce final structured output based on your analysis."}
-    ]
-
-    acc = ""
-    for chunk in stream_ollama(gen_prompt, VISION_MODEL):
-        acc += chunk
-
-    # Save to cache (final output)
-    try:
-        cache.set(image_hash, user_prompt, acc)
-    except Exception:
-        logger.exception("Vision cache write failed")
+        out = run_calls([
+            LLMCall("think", VISION_MODEL, lambda deps: think_prompt, phase="vision_think",
+                    on_error="[Vision thinking failed]"),
+            LLMCall("gen", VISION_MODEL, lambda deps: gen_prompt, phase="vision"),
+        ])
+        return out["think"], out["gen"]
+
+    def analyse_tiles() -> Tuple[str, str]:
+        # one call per region, all independent; the merge is local
+        emit("vision_think", f"Analysing {len(tiles)} regions concurrently...\n")
+        calls = [
+            LLMCall(f"tile_{i}", VISION_MODEL, lambda deps, t=tile: [
+                {"role": "system", "content": TILE_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Instructions / Context:\n{user_prompt}\n\nRegion box (left, top, right, bottom): {t['box']}", "images": [t["b64"]]},
+            ], on_error="")
+            for i, tile in enumerate(tiles)
+        ]
+        out = run_calls(calls)
+        replies = [out[f"tile_{i}"] for i in range(len(tiles))]
+        thinking = "\n\n".join(f"### Region {i} {t['box']}\n{r}" for i, (t, r) in enumerate(zip(tiles, replies), start=1))
+        merged = merge_tile_components(tiles, replies)
+        emit("vision", merged)
+        return thinking, merged
+
+    # Stage cache with single-flight: identical concurrent requests share one model run
+    streamed = False
+
+    def compute() -> Tuple[str, str]:
+        nonlocal streamed
+        # a visually near-identical design (re-save, cursor, crop margin) may already be analysed
+        near = image_index.find(image_phash, image_thumb)
+        if near and near[0] != image_hash:
+            reused = cache.get_stage(stage, version, VISION_MODEL, near[0], user_prompt)
+            if reused:
+                logger.info("Reusing vision analysis of near-duplicate %s (distance %d)", near[0][:12], near[1])
+                return reused
+        streamed = True
+        return analyse_tiles() if tiles else analyse()
+
+    stage = "vision_tiled" if tiles else "vision"
+    # tiled analyses also depend on how the page was cut
+    version = (f"{PROMPT_VERSION}:t{VISION_TILE_SIZE}-{VISION_TILE_OVERLAP}-{VISION_TILE_MAX_WIDTH}"
+               if tiles else PROMPT_VERSION)
+    thinking, acc = cache.get_or_compute_stage(stage, version, VISION_MODEL, image_hash, user_prompt, compute)
+    image_index.add(image_phash, image_hash, image_thumb)
+
+    if not streamed:
+        # served from cache (or by another session's in-flight run): emit in one block
+        thinking = f"[cached analysis — showing full analysis]\n\n{thinking}"
+        emit("vision_think", thinking)
+        emit("vision", str(acc))
 
     return {
         "messages": [